@@ -0,0 +1,68 @@
+"""Benchmarks for the frame processing hot path, run from `src` with
+
+  python3 -m benchmark [--save baseline.json] [--compare baseline.json]
+
+`--quick` runs every benchmark for a few frames only, as smoke test.
+
+With `--compare` the exit code is 1, if a benchmark got slower than the
+baseline by more than the tolerance (p50 latency).
+"""
+from pathlib import Path
+import argparse
+import json
+import logging
+import sys
+import warnings
+
+from . import suite
+
+QUICK_FRAMES = 5
+
+
+def main():
+  parser = argparse.ArgumentParser(prog="benchmark")
+  parser.add_argument("-n", "--frames", type=int, default=500, help="Frames per benchmark")
+  parser.add_argument("-k", "--filter", default="", help="Only run benchmarks containing this")
+  parser.add_argument("--quick", action="store_true", help=f"Only run {QUICK_FRAMES} frames per benchmark")
+  parser.add_argument("--save", type=Path, help="Store results as new baseline")
+  parser.add_argument("--compare", type=Path, help="Compare results against baseline")
+  parser.add_argument(
+    "--tolerance", type=float, default=0.25,
+    help="Allowed relative p50 slowdown against the baseline"
+  )
+  args = parser.parse_args()
+
+  # parser resyncs and overflows of the synthetic data are expected
+  logging.disable(logging.WARNING)
+  warnings.simplefilter("ignore", RuntimeWarning)
+
+  results = {}
+  print(f"{'benchmark':40} {'p50 µs':>10} {'p90 µs':>10} {'p99 µs':>10} {'frames/s':>10}")
+  for result in suite.run(QUICK_FRAMES if args.quick else args.frames, args.filter):
+    s = results[result.name] = result.summary()
+    print(f"{result.name:40} {s['p50_us']:10.1f} {s['p90_us']:10.1f} {s['p99_us']:10.1f} {s['fps']:10.0f}")
+
+  if args.save is not None:
+    with open(args.save, "w") as f:
+      json.dump(results, f, indent=2)
+
+  if args.compare is not None:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+
+    regressions = []
+    for name, s in results.items():
+      if name not in baseline:
+        continue
+      ratio = s["p50_us"] / baseline[name]["p50_us"]
+      if ratio > 1 + args.tolerance:
+        regressions.append(f"{name}: p50 {baseline[name]['p50_us']:.1f} -> {s['p50_us']:.1f} µs ({ratio:.2f}x)")
+
+    for r in regressions:
+      print(f"REGRESSION {r}")
+    if regressions:
+      sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
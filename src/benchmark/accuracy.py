@@ -0,0 +1,85 @@
+"""Accuracy of the reduced precision temperature conversions against
+float64, run from `src` with
+
+  python3 -m benchmark.accuracy [--states 50] [--max-error 10]
+
+Every Y16 value of the range used by real frames is converted with
+randomly varied measure params (fpa, lens and shutter temperatures,
+curve coefficients). Errors are in Kelvin * 100, i.e. the unit of the
+output frames. With `--max-error` the exit code is 1, if any mode
+exceeds that error.
+
+The largest errors are found with k0 != 0 for the few pixels at the
+edge of saturation, where float32 rounds a huge k0 term differently.
+"""
+import argparse
+import sys
+import warnings
+import numpy as np
+
+from device.temputils import MobirAirTempUtils, Precision
+
+from . import synthetic
+
+
+def vary_state(seed: int):
+  state = synthetic.make_state(seed)
+  rng = np.random.default_rng(seed)
+
+  param = state.measureParam
+  param.realtimeTfpa = rng.uniform(20, 45)
+  param.lastShutterTfpa = param.realtimeTfpa + rng.uniform(-1, 1)
+  param.realtimeTlens = rng.uniform(20, 45)
+  param.lastShutterTlens = param.realtimeTlens + rng.uniform(-1, 1)
+  param.realtimeTshutter = rng.uniform(10, 60)
+  # with any k0 but 0 (nearly) all pixels saturate, so only every
+  # second state uses one, to cover both the linear range and saturation
+  param.k0 = int(rng.integers(-50, 50)) if seed % 2 else 0
+  param.k1 = int(rng.integers(-500, 500))
+  param.b = int(rng.integers(-100, 100))
+  param.kf = int(rng.integers(9000, 11000))
+  param.currChangeRTfpgIdx = int(rng.integers(0, synthetic.JWB_TAB_NUMBER))
+  return state
+
+
+def measure(states: int, lo: int, hi: int) -> dict[Precision, np.ndarray]:
+  y16 = np.arange(lo, hi, dtype="u2")
+  errors: dict[Precision, list[np.ndarray]] = {p: [] for p in Precision if p != Precision.FLOAT64}
+
+  for seed in range(states):
+    state = vary_state(seed)
+    temp = MobirAirTempUtils(state)
+
+    state.config.precision = Precision.FLOAT64
+    reference = temp.y16toKelvin(y16).astype("i4")
+
+    for precision, e in errors.items():
+      state.config.precision = precision
+      e.append(np.abs(temp.y16toKelvin(y16).astype("i4") - reference))
+
+  return {p: np.concatenate(e) for p, e in errors.items()}
+
+
+def main():
+  parser = argparse.ArgumentParser(prog="benchmark.accuracy")
+  parser.add_argument("--states", type=int, default=50, help="Number of varied states")
+  parser.add_argument("--lo", type=int, default=6000, help="Lowest Y16 value")
+  parser.add_argument("--hi", type=int, default=12000, help="Highest Y16 value")
+  parser.add_argument("--max-error", type=int, help="Allowed maximum error (Kelvin * 100)")
+  args = parser.parse_args()
+
+  # overflows of the int16 conversions are part of the reference
+  warnings.simplefilter("ignore", RuntimeWarning)
+
+  failed = False
+  print(f"{'precision':12} {'max':>8} {'mean':>8} {'p99':>8} {'differ %':>10}")
+  for precision, e in measure(args.states, args.lo, args.hi).items():
+    print(f"{precision.value:12} {e.max():8d} {e.mean():8.3f} {np.percentile(e, 99):8.1f} {np.mean(e > 0) * 100:10.3f}")
+    failed |= args.max_error is not None and e.max() > args.max_error
+
+  if failed:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
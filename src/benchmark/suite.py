@@ -0,0 +1,249 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
+import time
+import numpy as np
+
+from device.device_state import MobirAirState
+from device.image_processor import ThermalFrameProcessor
+from device.parser import MobirAirParser, MobirAirRingParser
+from device.pipeline import FunctionStage, MeasureParamStage, Pipeline
+from device.roi import Polygon, Rect
+from device.stream_server import StreamClient, StreamFormat, StreamServer
+from device.temputils import MobirAirTempLUT, MobirAirTempUtils, Precision
+from device.types import CustomParamLine, FixedParamLine, raw_to_dataclass
+
+from . import synthetic
+
+
+@dataclass
+class BenchmarkResult:
+  name: str
+  # latency of every single frame in ns
+  samples: np.ndarray
+
+  def summary(self) -> dict[str, float]:
+    us = self.samples / 1e3
+    return dict(
+      p50_us=float(np.percentile(us, 50)),
+      p90_us=float(np.percentile(us, 90)),
+      p99_us=float(np.percentile(us, 99)),
+      mean_us=float(np.mean(us)),
+      fps=float(1e9 / np.mean(self.samples)),
+    )
+
+
+BENCHMARKS: dict[str, Callable[[int], np.ndarray]] = {}
+
+
+def benchmark(name: str):
+  """Register a benchmark. It gets the number of frames to run and
+  returns the per frame latencies in ns.
+  """
+  def decorator(fn: Callable[[int], np.ndarray]):
+    BENCHMARKS[name] = fn
+    return fn
+  return decorator
+
+
+def run(frames: int, selection: str = "") -> list[BenchmarkResult]:
+  return [
+    BenchmarkResult(name, fn(frames))
+    for name, fn in BENCHMARKS.items()
+    if selection in name
+  ]
+
+
+def _time_each(fn: Callable[[], object], count: int) -> np.ndarray:
+  fn()  # warmup
+  samples = np.empty(count, dtype="i8")
+  for i in range(count):
+    t = time.perf_counter_ns()
+    fn()
+    samples[i] = time.perf_counter_ns() - t
+  return samples
+
+
+def _parse_benchmark(parser_cls: type, chunk_size: int):
+  def run(frames: int) -> np.ndarray:
+    state = synthetic.make_state()
+    stream = synthetic.make_stream(frames + 1)
+    chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+
+    if parser_cls is MobirAirRingParser:
+      parser = MobirAirRingParser(state, chunk_size=max(chunk_size, 8192))
+    else:
+      parser = parser_cls(state)
+
+    samples, elapsed = [], 0
+    for chunk in chunks:
+      t = time.perf_counter_ns()
+      frame = parser.parse_stream(chunk)
+      elapsed += time.perf_counter_ns() - t
+
+      if frame is not None:
+        samples.append(elapsed)
+        elapsed = 0
+
+    return np.array(samples, dtype="i8")
+  return run
+
+
+for _cls in [MobirAirParser, MobirAirRingParser]:
+  for _chunk_size in [1000, 8192, 16384, 22320]:
+    benchmark(f"parse_stream/{_cls.__name__}/{_chunk_size}")(_parse_benchmark(_cls, _chunk_size))
+
+
+def _image(state: MobirAirState) -> np.ndarray:
+  payload = np.frombuffer(synthetic.make_payload(), dtype="<u2").reshape((state.height, state.width))
+  return payload[state.refHeight:, :]
+
+
+@benchmark("doNUCbyTwoPoint")
+def _bench_nuc(frames: int) -> np.ndarray:
+  state = synthetic.make_state()
+  proc = ThermalFrameProcessor(state)
+  img = _image(state)
+  return _time_each(lambda: proc.doNUCbyTwoPoint(img), frames)
+
+
+@benchmark("y16toTemp/reference")
+def _bench_y16_reference(frames: int) -> np.ndarray:
+  state = synthetic.make_state()
+  temp = MobirAirTempUtils(state)
+  img = _image(state)
+  return _time_each(lambda: temp.y16toTemp(img), frames)
+
+
+def _kelvin_benchmark(precision: Precision):
+  def run(frames: int) -> np.ndarray:
+    state = synthetic.make_state()
+    state.config.precision = precision
+    temp = MobirAirTempUtils(state)
+    img = _image(state)
+    return _time_each(lambda: temp.y16toKelvin(img), frames)
+  return run
+
+
+for _precision in Precision:
+  benchmark(f"y16toKelvin/{_precision.value}")(_kelvin_benchmark(_precision))
+
+
+@benchmark("y16toTemp/lut")
+def _bench_y16_lut(frames: int) -> np.ndarray:
+  state = synthetic.make_state()
+  lut = MobirAirTempLUT(state)
+  img = _image(state)
+  return _time_each(lambda: lut.lookup(img), frames)
+
+
+@benchmark("y16toTemp/lut-rebuild")
+def _bench_y16_lut_rebuild(frames: int) -> np.ndarray:
+  """lookup with changed measure params, as after every sensor update
+  """
+  state = synthetic.make_state()
+  lut = MobirAirTempLUT(state)
+  img = _image(state)
+
+  def lookup():
+    state.measureParam.realtimeTlens += 0.01
+    lut.lookup(img)
+  return _time_each(lookup, frames)
+
+
+@benchmark("regions")
+def _bench_regions(frames: int) -> np.ndarray:
+  state = synthetic.make_state()
+  proc = ThermalFrameProcessor(state)
+  img = _image(state)
+  proc.regions.add("frame", Rect(0, 0, state.width, state.height - state.refHeight))
+  proc.regions.add("box", Rect(10, 10, 20, 15))
+  proc.regions.add("spot", Polygon([(50, 10), (90, 10), (70, 60)]))
+  return _time_each(lambda: proc.regions.compute(img, proc.toKelvin), frames)
+
+
+def _colormap_benchmark(pixelformat: str, agc: str):
+  def run(frames: int) -> np.ndarray:
+    # the output side isn't needed by the other benchmarks
+    from video.colormap import AutoGain, ColorMapper
+
+    state = synthetic.make_state()
+    image = MobirAirTempLUT(state).lookup(_image(state))
+    mapper = ColorMapper(state.width, state.height - state.refHeight, pixelformat, agc=AutoGain(agc))
+    out = np.empty(mapper.shape, dtype="u1")
+    return _time_each(lambda: mapper.apply(image, out), frames)
+  return run
+
+
+for _format in ["GREY", "YUYV", "RGB24"]:
+  for _agc in ["percentile", "equalize"]:
+    benchmark(f"colormap/{_format}/{_agc}")(_colormap_benchmark(_format, _agc))
+
+
+@benchmark("raw_to_dataclass")
+def _bench_header(frames: int) -> np.ndarray:
+  header = synthetic.make_header()
+  def decode():
+    raw_to_dataclass(FixedParamLine, header)
+    raw_to_dataclass(CustomParamLine, header)
+  return _time_each(decode, frames)
+
+
+@benchmark("stream/delta")
+def _bench_stream_delta(frames: int) -> np.ndarray:
+  """publish until two delta clients on localhost received the frame
+  """
+  state = synthetic.make_state()
+  proc = ThermalFrameProcessor(state)
+  parser = MobirAirParser(state)
+  processed = [proc.process(parser.parse_stream(synthetic.make_frame(seed=i % 16))) for i in range(frames)]
+
+  server = StreamServer(0, format=StreamFormat.Y16, queue_size=frames)
+  clients = [StreamClient("127.0.0.1", server.port, delta=True) for _ in range(2)]
+  while server.clients < len(clients):
+    time.sleep(1e-3)
+
+  samples = np.empty(frames, dtype="i8")
+  with ThreadPoolExecutor(len(clients)) as pool:
+    for i, frame in enumerate(processed):
+      t = time.perf_counter_ns()
+      received = pool.map(StreamClient.get, clients)
+      server.publish(frame)
+      list(received)
+      samples[i] = time.perf_counter_ns() - t
+
+  for client in clients:
+    client.close()
+  server.close()
+  return samples
+
+
+@benchmark("end-to-end")
+def _bench_end_to_end(frames: int) -> np.ndarray:
+  """parse and run the pipeline with temperature conversion and
+  measure param update, like the driver does for each frame (without
+  USB and outputs)
+  """
+  state = synthetic.make_state()
+  parser = MobirAirRingParser(state, chunk_size=16384)
+  pipeline = Pipeline(ThermalFrameProcessor(state), state.metrics, (state.height - state.refHeight, state.width), [
+    FunctionStage("temperature", lambda f: f.image),
+    MeasureParamStage(state),
+  ])
+
+  stream = synthetic.make_stream(frames + 1, shutter_every=250)
+  chunks = [stream[i:i + 16384] for i in range(0, len(stream), 16384)]
+
+  samples, elapsed = [], 0
+  for chunk in chunks:
+    t = time.perf_counter_ns()
+    raw_frame = parser.parse_stream(chunk)
+    if raw_frame is not None:
+      pipeline.run(raw_frame)
+    elapsed += time.perf_counter_ns() - t
+
+    if raw_frame is not None:
+      samples.append(elapsed)
+      elapsed = 0
+
+  return np.array(samples, dtype="i8")
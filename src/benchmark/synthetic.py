@@ -0,0 +1,102 @@
+import numpy as np
+
+from device.device_state import MobirAirState
+from device.parser import MobirAirParser
+
+
+WIDTH = 120
+HEIGHT = 92
+REF_HEIGHT = 2
+JWB_TAB_NUMBER = 4
+MODULE_TP = 2
+
+
+def make_state(seed: int = 0) -> MobirAirState:
+  """State with synthetic, but plausible calibration data as it would be
+  after `MobirAirDriver._init_state` and a first shutter.
+  """
+  rng = np.random.default_rng(seed)
+  state = MobirAirState(WIDTH, HEIGHT, REF_HEIGHT)
+
+  state.module_tp = MODULE_TP
+  state.jwbTabNumber = JWB_TAB_NUMBER
+  state.jwbTabArrShort = np.array([1500 + 1000 * i for i in range(JWB_TAB_NUMBER)], dtype="<u2")
+
+  # gain around 1.0 (2¹³) per pixel
+  state.allKdata = rng.normal(2**13, 300, (JWB_TAB_NUMBER, HEIGHT, WIDTH)).astype("<u2")
+
+  # monotonic curves, index i corresponds to i / 10 - 20 °C
+  curves = []
+  for i in range(JWB_TAB_NUMBER):
+    steps = np.linspace(4, 20, 1700) + i
+    curves.append(np.cumsum(steps) + 3000)
+  state.allCurveData = np.array(curves).astype("<u2")
+
+  state.shutterFrame = rng.normal(8000, 30, (HEIGHT - REF_HEIGHT, WIDTH)).astype("<u2")
+
+  param = state.measureParam
+  param.realtimeTshutter = param.lastShutterTshutter = 30.2
+  param.realtimeTfpa = 31.1
+  param.lastShutterTfpa = 31.0
+  param.realtimeTlens = 29.8
+  param.lastShutterTlens = 29.6
+  param.currChangeRTfpgIdx = 2
+  param.k0, param.k1, param.k2, param.k3, param.k4, param.k5 = 12, 300, 50, 3, 4, 5
+  param.b = 20
+  param.kf = 10000
+  param.tref = 25.0
+
+  return state
+
+
+def make_header(shuttering: bool = False, seed: int = 0) -> bytes:
+  """240 byte frame header with valid fixed and custom param lines
+  """
+  rng = np.random.default_rng(seed)
+  header = bytearray(MobirAirParser.FRAME_HEADER_LENGTH)
+
+  def put(location: int, value: int, length: int = 2):
+    header[location:location + length] = int(value).to_bytes(length, "little")
+
+  header[:4] = MobirAirParser.FRAME_START
+  put(0x4, WIDTH)
+  put(0x6, HEIGHT)
+  header[0x8:0x10] = b"MOBIRAIR"
+
+  # raw sensor values, resulting in ~30 °C
+  put(0x10, 9200 + rng.integers(-20, 20))
+  put(0x12, 9200 + rng.integers(-20, 20))
+  put(0x14, 9300 + rng.integers(-20, 20))
+  put(0x16, 16980 + rng.integers(-20, 20))
+  put(0x18, int(shuttering))
+
+  put(0x60, 0)
+  put(0x63, 1, 1)
+  put(0x64, 98, 1)
+  put(0x65, 79, 1)
+  put(0x66, (25 << 6) | 10)
+  put(0x6a, 0x50)
+  put(0x6c, 1)
+  put(0x6e, 30)
+
+  for location, value in zip(range(0x90, 0xa4, 2), [0, 12, 300, 50, 3, 4, 5, 20, 10000, 2500]):
+    put(location, value)
+
+  return bytes(header)
+
+
+def make_payload(seed: int = 0) -> bytes:
+  rng = np.random.default_rng(seed)
+  image = rng.normal(8100, 150, (HEIGHT, WIDTH)).clip(0, 2**16 - 1)
+  return image.astype("<u2").tobytes()
+
+
+def make_frame(shuttering: bool = False, seed: int = 0) -> bytes:
+  return make_header(shuttering, seed) + make_payload(seed)
+
+
+def make_stream(frames: int, seed: int = 0, shutter_every: int = 0) -> bytes:
+  return b"".join(
+    make_frame(shutter_every > 0 and i % shutter_every == 0, seed + i)
+    for i in range(frames)
+  )
@@ -0,0 +1,18 @@
+from pathlib import Path
+import subprocess
+import sys
+import unittest
+
+
+class BenchmarkSmokeTest(unittest.TestCase):
+  def test_quick_run(self):
+    # as a separate process, the way the suite is run
+    result = subprocess.run(
+      [sys.executable, "-m", "benchmark", "--quick"],
+      cwd=Path(__file__).parent.parent, capture_output=True, text=True, timeout=300)
+    self.assertEqual(result.returncode, 0, result.stderr)
+    self.assertIn("end-to-end", result.stdout)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,152 @@
+from typing import AsyncIterator, Callable, Optional, TypeVar
+import asyncio
+import concurrent.futures
+import logging
+
+from .device_state import MobirAirConfig
+from .driver import MobirAirDriver
+from .frame_queue import DropPolicy
+from .types import Frame
+from .usb_wrapper import MobirAirUSBWrapper
+
+T = TypeVar("T")
+
+
+class AsyncMobirAirDriver:
+  """asyncio interface of a `MobirAirDriver`.
+
+  Frames are handed from the driver's processing thread to the event
+  loop through a bounded queue of `queue_size` frames. When it is full,
+  `overflow` decides whether the processing thread waits for the
+  consumer (BLOCK, which propagates the backpressure to the driver's
+  frame queue), the oldest frame is replaced (DROP_OLDEST) or the new
+  frame is discarded (DROP_NEWEST).
+
+  Blocking USB commands are run in the default executor. Ending the
+  iteration of `frames` (break, cancellation, error) stops the stream
+  and clears the device like `MobirAirDriver.clear_device`, use
+  `contextlib.aclosing` to do so right away on break:
+
+    async with await AsyncMobirAirDriver.open() as camera:
+      async with aclosing(camera.frames()) as frames:
+        async for frame in frames:
+          ...
+  """
+  def __init__(self, driver: MobirAirDriver, queue_size: int = 4,
+               overflow: DropPolicy = DropPolicy.DROP_OLDEST) -> None:
+    if queue_size < 1:
+      raise ValueError("queue_size needs to be at least 1")
+
+    self.driver = driver
+    self.overflow = overflow
+    self.dropped = 0
+
+    self._queue: Optional[asyncio.Queue[Frame]] = None
+    self._queue_size = queue_size
+    self._loop: Optional[asyncio.AbstractEventLoop] = None
+    self._streaming = False
+
+    driver.set_frame_listener(self._on_frame)
+    driver.metrics.register("frames_not_consumed", lambda: self.dropped)
+
+  @classmethod
+  async def open(cls, config: Optional[MobirAirConfig] = None, usb: Optional[MobirAirUSBWrapper] = None,
+                 queue_size: int = 4, overflow: DropPolicy = DropPolicy.DROP_OLDEST) -> "AsyncMobirAirDriver":
+    """Create the driver (reset and calibration download) without
+    blocking the event loop
+    """
+    driver = await asyncio.get_running_loop().run_in_executor(None, MobirAirDriver, config, usb)
+    return cls(driver, queue_size, overflow)
+
+  async def __aenter__(self) -> "AsyncMobirAirDriver":
+    return self
+
+  async def __aexit__(self, *exc):
+    await self.close()
+
+  async def _run(self, fn: Callable[..., T], *args) -> T:
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+  @property
+  def streaming(self) -> bool:
+    return self._streaming
+
+  async def start_stream(self):
+    if self._streaming:
+      return
+
+    self._loop = asyncio.get_running_loop()
+    if self._queue is None:
+      self._queue = asyncio.Queue(self._queue_size)
+
+    # the stream might still be enabled from a previous run
+    await self._run(self.driver.stop_stream)
+    self._streaming = True
+    await self._run(self.driver.start_stream)
+
+  async def stop_stream(self):
+    """Stop the stream and clear the device, discarding queued frames
+    """
+    if not self._streaming:
+      return
+
+    self._streaming = False
+    # frees a processing thread waiting for space
+    self._drain()
+    await self._run(self.driver.stop_stream)
+    # waits for a read in flight, as it holds the driver's usb lock
+    await self._run(self.driver.clear_device)
+    self._drain()
+
+  def _drain(self):
+    while self._queue is not None and not self._queue.empty():
+      self._queue.get_nowait()
+
+  async def shutter(self, wait: bool = True, poll: float = 0.05):
+    """Run a shutter calibration, optionally waiting until it is done
+    (it needs frames to advance, so the stream has to be running)
+    """
+    self.driver.shutter()
+    while wait and self.driver.calibrating:
+      await asyncio.sleep(poll)
+
+  async def close(self):
+    await self.stop_stream()
+    await self._run(self.driver.stop)
+
+  async def frames(self) -> AsyncIterator[Frame]:
+    """Frames (detached, see `Frame.detach`), starting the stream if
+    needed. The stream is stopped when the iteration ends.
+    """
+    await self.start_stream()
+    try:
+      while True:
+        yield await self._queue.get()
+    finally:
+      await self.stop_stream()
+
+  ###### processing thread ######
+  def _on_frame(self, frame: Frame):
+    loop, queue = self._loop, self._queue
+    if not self._streaming or loop is None or queue is None:
+      return
+
+    frame = frame.detach()
+    try:
+      if self.overflow == DropPolicy.BLOCK:
+        asyncio.run_coroutine_threadsafe(queue.put(frame), loop).result()
+      else:
+        loop.call_soon_threadsafe(self._offer, queue, frame)
+    except (RuntimeError, asyncio.CancelledError, concurrent.futures.CancelledError) as e:
+      # event loop closed or stream stopped while waiting
+      logging.debug(f"async driver: frame discarded ({e!r})")
+
+  ###### event loop ######
+  def _offer(self, queue: asyncio.Queue, frame: Frame):
+    if queue.full():
+      if self.overflow == DropPolicy.DROP_NEWEST:
+        self.dropped += 1
+        return
+      queue.get_nowait()
+      self.dropped += 1
+    queue.put_nowait(frame)
@@ -0,0 +1,89 @@
+from pathlib import Path
+from typing import Optional
+import json
+import logging
+import os
+import re
+import numpy as np
+
+
+# calibration data already loaded in this process, by cache path. Drivers
+# of the same camera (e.g. after reconnecting) share the read-only arrays.
+_loaded: dict[Path, tuple[dict, np.ndarray, np.ndarray]] = {}
+
+
+def default_cache_dir() -> Path:
+  base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+  return Path(base) / "pymobirair"
+
+
+class CalibrationCache:
+  """On-disk cache for the calibration data of a single device (K data and
+  curves), keyed by its serial number.
+
+  The cached data is only used, when module tp and the jwb table, which
+  are cheap to retrieve from the device, still match. Arrays are stored
+  as `.npy` files and loaded memory-mapped.
+  """
+  VERSION = 1
+
+  def __init__(self, directory: Path | str, serial: bytes) -> None:
+    name = serial.decode("ascii", errors="replace").strip("\x00 ")
+    name = re.sub(r"[^A-Za-z0-9_-]", "_", name) or "unknown"
+    self.path = Path(directory) / name
+
+  def _meta(self, module_tp: int, jwbTabArrShort: np.ndarray) -> dict:
+    return dict(
+      version=self.VERSION,
+      module_tp=module_tp,
+      jwbTabArrShort=jwbTabArrShort.tolist(),
+    )
+
+  def load(self, module_tp: int, jwbTabArrShort: np.ndarray) -> Optional[tuple[np.ndarray, np.ndarray]]:
+    """Returns (allKdata, allCurveData) if the cache is valid for the
+    given device parameters, None otherwise.
+    """
+    loaded = _loaded.get(self.path)
+    if loaded is not None and loaded[0] == self._meta(module_tp, jwbTabArrShort):
+      return loaded[1], loaded[2]
+
+    try:
+      with open(self.path / "meta.json") as f:
+        meta = json.load(f)
+
+      if meta != self._meta(module_tp, jwbTabArrShort):
+        logging.info(f"calibration cache: {self.path} is outdated")
+        return None
+
+      kdata = np.load(self.path / "allKdata.npy", mmap_mode="r")
+      curve = np.load(self.path / "allCurveData.npy", mmap_mode="r")
+    except (OSError, ValueError) as e:
+      logging.info(f"calibration cache: couldn't load {self.path} ({e})")
+      return None
+
+    if kdata.shape[0] != len(jwbTabArrShort) or curve.shape[0] != len(jwbTabArrShort):
+      logging.warn(f"calibration cache: {self.path} has invalid shape")
+      return None
+
+    _loaded[self.path] = (meta, kdata, curve)
+    return kdata, curve
+
+  def store(self, module_tp: int, jwbTabArrShort: np.ndarray, allKdata: np.ndarray, allCurveData: np.ndarray):
+    self.path.mkdir(parents=True, exist_ok=True)
+
+    # write meta last, so that an interrupted store is never valid
+    meta_path = self.path / "meta.json"
+    meta_path.unlink(missing_ok=True)
+    _loaded.pop(self.path, None)
+
+    for name, data in [("allKdata", allKdata), ("allCurveData", allCurveData)]:
+      tmp = self.path / f"{name}.tmp.npy"
+      np.save(tmp, data)
+      os.replace(tmp, self.path / f"{name}.npy")
+
+    tmp = self.path / "meta.json.tmp"
+    with open(tmp, "w") as f:
+      json.dump(self._meta(module_tp, jwbTabArrShort), f)
+    os.replace(tmp, meta_path)
+
+    _loaded[self.path] = (self._meta(module_tp, jwbTabArrShort), allKdata, allCurveData)
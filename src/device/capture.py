@@ -0,0 +1,213 @@
+from enum import IntEnum
+from pathlib import Path
+from threading import Event, Lock
+from typing import BinaryIO, Optional
+import logging
+import mmap
+import struct
+import time
+import numpy as np
+import usb.core
+
+from .usb_wrapper import MobirAirUSBWrapper
+
+
+class RecordType(IntEnum):
+  WRITE = 0   # command written to the output endpoint
+  ARM = 1     # response to a retrieve_data command
+  STREAM = 2  # chunk read from the stream endpoint
+
+
+class CaptureWriter:
+  """Writes the raw USB traffic of a device into a capture file.
+
+  A capture file starts with `MAGIC`, followed by records consisting of
+  a `RECORD` header (type, time since capture start, command length,
+  data length), the command and the data.
+  """
+  MAGIC = b"MOBIRCAP\x01"
+  RECORD = struct.Struct("<BdII")
+
+  def __init__(self, path: Path | str) -> None:
+    self._file: BinaryIO = open(path, "wb")
+    self._file.write(self.MAGIC)
+    self._lock = Lock()
+    self._t_start = time.monotonic()
+
+  def write(self, type: RecordType, data, command: bytes = b""):
+    data = memoryview(data).cast("B")
+    with self._lock:
+      self._file.write(self.RECORD.pack(type, time.monotonic() - self._t_start, len(command), data.nbytes))
+      self._file.write(command)
+      self._file.write(data)
+
+  def close(self):
+    with self._lock:
+      self._file.close()
+
+
+class CaptureReader:
+  """Memory-maps a capture file and indexes its records.
+  """
+
+  def __init__(self, path: Path | str) -> None:
+    with open(path, "rb") as f:
+      self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self._data = np.frombuffer(self._mmap, dtype="u1")
+
+    if self._mmap[:len(CaptureWriter.MAGIC)] != CaptureWriter.MAGIC:
+      raise ValueError(f"{path} is not a capture file")
+
+    self.responses: dict[bytes, np.ndarray] = {}
+    # (timestamp, data) of every stream chunk
+    self.stream: list[tuple[float, np.ndarray]] = []
+
+    pos = len(CaptureWriter.MAGIC)
+    while pos + CaptureWriter.RECORD.size <= len(self._mmap):
+      type, t, cmd_len, data_len = CaptureWriter.RECORD.unpack_from(self._mmap, pos)
+      pos += CaptureWriter.RECORD.size
+      command = self._mmap[pos:pos + cmd_len]
+      data = self._data[pos + cmd_len:pos + cmd_len + data_len]
+      pos += cmd_len + data_len
+
+      if data.size < data_len:
+        logging.warn("capture: file is truncated")
+        break
+
+      if type == RecordType.ARM:
+        self.responses[command] = data
+      elif type == RecordType.STREAM:
+        self.stream.append((t, data))
+
+
+class _RecordingEndpoint:
+  def __init__(self, endpoint: usb.core.Endpoint, capture: CaptureWriter) -> None:
+    self._endpoint = endpoint
+    self._capture = capture
+
+  def write(self, data, timeout=None):
+    data = data.encode() if isinstance(data, str) else bytes(data)
+    self._capture.write(RecordType.WRITE, data)
+    return self._endpoint.write(data, timeout)
+
+  def __getattr__(self, name):
+    return getattr(self._endpoint, name)
+
+
+class RecordingUSBWrapper(MobirAirUSBWrapper):
+  """USB wrapper, that records all traffic into a capture file
+  """
+
+  def __init__(self, dev: usb.core.Device, capture: CaptureWriter, **kwargs) -> None:
+    self._capture = capture
+    super().__init__(dev, **kwargs)
+
+  @property
+  def epo(self):
+    return _RecordingEndpoint(self._endpoint_out, self._capture)
+
+  def read_into(self, buffer: np.ndarray, timeout: int = 200) -> int:
+    length = super().read_into(buffer, timeout)
+    self._capture.write(RecordType.STREAM, buffer[:length])
+    return length
+
+  def retrieve_data(self, command: bytes, length: int, timeouts: int = 3,
+                    out: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
+    data = super().retrieve_data(command, length, timeouts, out)
+    if data is not None:
+      self._capture.write(RecordType.ARM, data, command=command)
+    return data
+
+
+class _ReplayEndpoint:
+  wMaxPacketSize = 512
+
+  def __init__(self, wrapper: "ReplayUSBWrapper") -> None:
+    self._wrapper = wrapper
+
+  def write(self, data, timeout=None):
+    data = data.encode() if isinstance(data, str) else bytes(data)
+    self._wrapper._command(data)
+    return len(data)
+
+  def read(self, size_or_buffer, timeout=None):
+    raise usb.core.USBTimeoutError("replay: no data")
+
+
+class ReplayUSBWrapper(MobirAirUSBWrapper):
+  """USB wrapper replaying a capture file instead of talking to a device.
+
+  Parameter requests are answered with the recorded responses. The
+  recorded stream is played back between `StartX` and `StopX`, either
+  at recorded speed or as fast as possible. `finished` is set, once the
+  end of the capture has been reached (unless `loop` is set).
+  """
+
+  def __init__(self, path: Path | str, realtime: bool = True, loop: bool = False,
+               transfer_size: int = 16384) -> None:
+    self._capture = CaptureReader(path)
+    self.realtime = realtime
+    self.loop = loop
+
+    self.async_depth = 0
+    self.transfer_size = max([transfer_size] + [data.size for _, data in self._capture.stream])
+    self._async_reader = None
+
+    self._endpoint_in = self._endpoint_out = _ReplayEndpoint(self)
+
+    self._streaming = False
+    self._pos = 0
+    self._t_offset: Optional[float] = None
+    self.finished = Event()
+
+  def _command(self, command: bytes):
+    if command == b"StartX=1":
+      self._streaming = True
+      self._t_offset = None
+    elif command == b"StopX=1":
+      self._streaming = False
+
+  def _read_into_sync(self, buffer: np.ndarray, timeout: int) -> int:
+    stream = self._capture.stream
+
+    if self._pos >= len(stream) and self.loop:
+      self._pos = 0
+      self._t_offset = None
+
+    if not self._streaming or self._pos >= len(stream):
+      if self._pos >= len(stream):
+        self.finished.set()
+      time.sleep(timeout / 1e3)
+      raise usb.core.USBTimeoutError("replay: no data")
+
+    t, data = stream[self._pos]
+    self._pos += 1
+
+    if self.realtime:
+      if self._t_offset is None:
+        self._t_offset = time.monotonic() - t
+      delay = self._t_offset + t - time.monotonic()
+      if delay > 0:
+        time.sleep(delay)
+
+    if data.size > buffer.size:
+      raise ValueError(f"replay: chunk of {data.size} bytes doesn't fit into buffer")
+
+    buffer[:data.size] = data
+    return data.size
+
+  def retrieve_data(self, command: bytes, length: int, timeouts: int = 3,
+                    out: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
+    data = self._capture.responses.get(bytes(command))
+    if data is None or data.size < length:
+      logging.warn(f"replay: no recorded response for {bytes(command)!r}")
+      return None
+
+    if out is None:
+      return data[:length].copy()
+
+    out[:length] = data[:length]
+    return out[:length]
+
+  def __del__(self):
+    pass
@@ -1,13 +1,25 @@
+from pathlib import Path
 from typing import Optional
 from enum import Enum
 import numpy as np
 from dataclasses import dataclass, field
 
 from device.types import RawFrame
+from device.frame_queue import DropPolicy
+from device.calibration_cache import default_cache_dir
+from device.metrics import Metrics
+from device.temputils import Precision
+from device.stream_server import StreamFormat
 
 class UninitializedValueAccess(Exception):
   ...
 
+class ShutterGating(str, Enum):
+  """What happens with frames captured during a shutter calibration
+  """
+  SKIP = "skip"   # not delivered to listener and outputs
+  FLAG = "flag"   # delivered with `Frame.calibrating` set
+
 class FPATemps(float, Enum):
   TFPA_DEFAULT = 0.15
   TFPA_DELTA = 0.18
@@ -17,6 +29,51 @@ class FPATemps(float, Enum):
 class MobirAirConfig:
   doNUC: bool = True
   useCalib: bool = True
+  useTempLUT: bool = True
+  # no temperature images for video sink and frame bus, frames are only
+  # converted on access (e.g. region statistics)
+  statsOnly: bool = False
+  # arithmetic of the temperature conversion
+  precision: Precision = Precision.FLOAT64
+  useRingParser: bool = True
+
+  # bulk transfers kept in flight on the stream endpoint (0 = synchronous
+  # reads, straight into the ring parser without a copy)
+  asyncTransfers: int = 0
+  transferSize: int = 16384
+
+  # frames buffered between acquisition and processing
+  frameQueueSize: int = 4
+  frameDropPolicy: DropPolicy = DropPolicy.DROP_OLDEST
+
+  shutterGating: ShutterGating = ShutterGating.SKIP
+
+  # stream right away and download the calibration data in the background
+  # (frames aren't radiometric until then)
+  progressiveStartup: bool = False
+
+  # calibration data cache (None = disabled), refresh forces a new download
+  calibrationCacheDir: Optional[Path] = field(default_factory=default_cache_dir)
+  refreshCalibration: bool = False
+
+  # metrics export, as prometheus endpoint on localhost and / or file
+  metricsPort: Optional[int] = None
+  metricsFile: Optional[Path] = None
+  metricsInterval: float = 10
+
+  # shared memory frame bus for other local processes (None = disabled)
+  frameBusName: Optional[str] = None
+  frameBusSlots: int = 8
+
+  # network stream (None = disabled), see `StreamServer`
+  streamPort: Optional[int] = None
+  streamHost: str = "127.0.0.1"
+  streamFormat: StreamFormat = StreamFormat.KELVIN
+  streamQueueSize: int = 4
+
+  # radiometric recording of all processed frames (None = disabled)
+  recordingPath: Optional[Path] = None
+  recordingChunkFrames: int = 64
 
 @dataclass
 class MeasureParam:
@@ -96,6 +153,8 @@ class MobirAirState:
   # program config
   config: MobirAirConfig = field(default_factory=MobirAirConfig)
 
+  metrics: Metrics = field(default_factory=Metrics)
+
   # values
   kjLastShutterTlens: float = 0
   lastAvgShutter: float = 0
@@ -105,10 +164,23 @@ class MobirAirState:
 
   tFpaDelta: float = FPATemps.TFPA_DEFAULT
 
+  # (shutter frame, average) of the last `shutterMean` call
+  _shutterMean: Optional[tuple[np.ndarray, float]] = field(default=None, init=False, repr=False)
+
   def __post_init__(self):
     # initialize calibration / shutter frame
     self.shutterFrame = np.zeros((self.height - self.refHeight, self.width), dtype="<u2")
 
+  @property
+  def shutterMean(self) -> float:
+    """Average of the shutter frame, only computed once per shutter frame
+    (which is replaced, never modified in place)
+    """
+    cached = self._shutterMean
+    if cached is None or cached[0] is not self.shutterFrame:
+      cached = self._shutterMean = (self.shutterFrame, float(np.average(self.shutterFrame)))
+    return cached[1]
+
   def getCurrKArr(self) -> np.ndarray:
     if self.allKdata is None:
       raise Exception
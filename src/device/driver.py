@@ -1,19 +1,32 @@
+from contextlib import AbstractContextManager, contextmanager, nullcontext
 import logging
-from typing import Callable
+from typing import Callable, Optional
 import usb.core
 import numpy as np
 
-from device.device_state import FPATemps, MobirAirState
+from device.device_state import FPATemps, MobirAirConfig, MobirAirState
 from device.shutterhandling import ShutterHandler
 from device.temputils import MobirAirTempUtils
 from .usb_wrapper import MobirAirUSBWrapper
-from .types import Frame
-from .parser import MobirAirParser
+from .types import Frame, RawFrame
+from .parser import MobirAirParser, MobirAirRingParser
 from .image_processor import ThermalFrameProcessor
+from .frame_queue import FrameQueue
+from .frame_timing import FrameTiming
+from .frame_bus import FrameBus
+from .stream_server import StreamServer
+from .pipeline import (
+  AutoShutterStage, EveryStage, FrameBusStage, FunctionStage, ListenerStage, MeasureParamStage, Pipeline,
+  RecordingStage, ShutterGateStage, StreamStage, VideoSink, VideoSinkStage,
+)
+from .roi import Region
+from .recording import RadiometricWriter
+from .calibration_cache import CalibrationCache
+from .metrics import Metrics, MetricsFileWriter, MetricsServer
 from .protocol import MobirAirUSBProtocol
 import time
 
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 
 
 class MobirAirDriver:
@@ -21,28 +34,91 @@ class MobirAirDriver:
   HEIGHT = 92
   REF_HEIGHT = 2
 
-  def __init__(self) -> None:
-    self._listener = None
+  def __init__(self, config: Optional[MobirAirConfig] = None, usb: Optional[MobirAirUSBWrapper] = None) -> None:
+    """`usb` allows to use another usb backend (e.g. a `ReplayUSBWrapper`)
+    instead of the first device found.
+    """
+    self._t_created = time.perf_counter_ns()
+    self.serial = b""
 
-    self._state = MobirAirState(self.WIDTH, self.HEIGHT, self.REF_HEIGHT)
+    self._state = MobirAirState(
+      self.WIDTH, self.HEIGHT, self.REF_HEIGHT, config=config or MobirAirConfig())
 
-    dev = MobirAirUSBWrapper.find_device()
-    self._usb = MobirAirUSBWrapper(dev)
+    if usb is None:
+      dev = MobirAirUSBWrapper.find_device()
+      usb = MobirAirUSBWrapper(
+        dev, async_depth=self._state.config.asyncTransfers, transfer_size=self._state.config.transferSize)
+    self._usb = usb
     self._protocol = MobirAirUSBProtocol(self._usb)
 
-    self._parser = MobirAirParser(self._state)
+    config = self._state.config
+    self._frame_queue: FrameQueue[RawFrame] = FrameQueue(config.frameQueueSize, config.frameDropPolicy)
+    self._sequence = 0
+    self._timing = FrameTiming()
+
+    if config.useRingParser:
+      # payloads need to stay valid while queued and processed
+      self._parser = MobirAirRingParser(
+        self._state, frames=max(8, config.frameQueueSize + 3), chunk_size=self._usb.transfer_size)
+    else:
+      self._parser = MobirAirParser(self._state)
+      self._chunk = np.empty(self._usb.transfer_size, dtype="u1")
     self._img_proc = ThermalFrameProcessor(self._state)
     self._shutter = ShutterHandler(self._protocol, self._state)
     self._shutter.setShutterFinishCallback(self._afterShutterCallback)
 
     self._temp = MobirAirTempUtils(self._state)
 
+    self._recording = None
+    if config.recordingPath is not None:
+      self._recording = RadiometricWriter(
+        config.recordingPath, self._state, chunk_frames=config.recordingChunkFrames)
+      self._state.metrics.register("frames_not_recorded", lambda: self._recording.dropped)
+
+    self._bus = None
+    if config.frameBusName is not None:
+      self._bus = FrameBus(
+        config.frameBusName, self.WIDTH, self.HEIGHT - self.REF_HEIGHT, slots=config.frameBusSlots)
+
+    self._stream = None
+    if config.streamPort is not None:
+      self._stream = StreamServer(
+        config.streamPort, config.streamHost, config.streamFormat, queue_size=config.streamQueueSize)
+      self._state.metrics.register("stream_clients_dropped", lambda: self._stream.dropped_clients)
+
+    self._metrics = self._state.metrics
+    self._pipeline = self._make_pipeline()
+
+    self._metrics.register("frames_dropped", lambda: self._frame_queue.dropped)
+    self._metrics.register("frame_gaps", lambda: self._timing.gaps)
+    self._metrics.register("frames_missed", lambda: self._timing.missed)
+    self._metrics.register("parser_resyncs", lambda: self._parser.resyncs)
+    self._metrics.register("parser_discarded_bytes", lambda: self._parser.discarded_bytes)
+    self._metrics.register_gauge("frame_interval_seconds", lambda: self._timing.interval)
+    self._metrics.register_gauge("frame_jitter_seconds", lambda: self._timing.jitter)
+    self._metrics_server = None
+    self._metrics_writer = None
+    if config.metricsPort is not None:
+      self._metrics_server = MetricsServer(self._metrics, config.metricsPort)
+    if config.metricsFile is not None:
+      self._metrics_writer = MetricsFileWriter(self._metrics, config.metricsFile, config.metricsInterval)
+
+    # held by the receive thread while reading, and by downloads
+    # interleaved with the stream
+    self._usb_lock = Lock()
+    # calibration data downloaded in the background, installed by the
+    # processing thread
+    self._pending_calibration: Optional[tuple[np.ndarray, np.ndarray]] = None
+
     # register incoming data listener
     self._enable_recv_thread = Event()
     self._recv_thread = Thread(
       target=self._read_data_listener, args=(self._enable_recv_thread,))
     self._recv_thread.start()
 
+    self._proc_thread = Thread(target=self._process_data_listener)
+    self._proc_thread.start()
+
     # init state
     self._init_state()
 
@@ -60,6 +136,12 @@ class MobirAirDriver:
     time.sleep(0.1)
     del self._usb
 
+    if self._metrics_server is not None:
+      self._metrics_server.stop()
+    if self._metrics_writer is not None:
+      self._metrics_writer.stop()
+    self._pipeline.close()
+
   def clear_device(self):
     self._protocol.setShutter(True)
     self._protocol.setStream(False)
@@ -67,63 +149,218 @@ class MobirAirDriver:
     self._protocol.setStream(False)
     time.sleep(0.1)
 
-    while True:
+    # the receive thread mustn't restart the stream transfers in between
+    with self._usb_lock:
+      self._usb.cancel_stream()
+      self._usb.drain()
+
+
+  @contextmanager
+  def _stream_paused(self):
+    """Pause the stream (if running) for a transfer on the stream
+    endpoint, without the receive thread reading in between
+    """
+    with self._usb_lock:
+      streaming = self._enable_recv_thread.is_set()
+      if streaming:
+        self._protocol.setStream(False)
+        self._usb.cancel_stream()
+        self._usb.drain()
       try:
-        self._usb.epi.read(self._usb.epi.wMaxPacketSize, 100)
-      except usb.core.USBTimeoutError:
-        return
+        yield
+      finally:
+        if streaming:
+          self._timing.restart()
+          self._protocol.setStream(True)
+
+  def _make_pipeline(self) -> Pipeline:
+    """Default stages: recording, shutter gate, outputs and the
+    parameter / shutter updates
+    """
+    stats_only = self._state.config.statsOnly
+    pipeline = Pipeline(self._img_proc, self._state.metrics, (self.HEIGHT - self.REF_HEIGHT, self.WIDTH))
+
+    if self._recording is not None:
+      pipeline.add(RecordingStage(self._recording))
+    pipeline.add(ShutterGateStage(self._shutter, self._state))
+    if not stats_only:
+      pipeline.add(VideoSinkStage())
+    if self._bus is not None and not stats_only:
+      pipeline.add(FrameBusStage(self._bus))
+    if self._stream is not None and not stats_only:
+      pipeline.add(StreamStage(self._stream))
+    pipeline.add(ListenerStage())
+    pipeline.add(MeasureParamStage(self._state))
+    pipeline.add(EveryStage("change_r", self._changeR, 25))
+    pipeline.add(AutoShutterStage(self._shutter))
+
+    pipeline.add(FunctionStage("first_frame", self._first_frame), after="shutter_gate")
+    return pipeline
+
+  def _first_frame(self, frame: Frame):
+    ttff = (time.perf_counter_ns() - self._t_created) / 1e9
+    logging.info(f"first frame after {ttff:.2f}s")
+    self._metrics.set("time_to_first_frame_seconds", ttff)
+    self._pipeline.remove("first_frame")
+
+  @property
+  def pipeline(self) -> Pipeline:
+    """Stages run for every frame, filters (e.g. `TemporalDenoise`) are
+    added before the sink: `pipeline.add(stage, after="shutter_gate")`
+    """
+    return self._pipeline
 
   def set_frame_listener(self, listener: Callable[[Frame], None]):
-    self._listener = listener
+    self._pipeline["listener"].listener = listener
+
+  def set_video_sink(self, sink: Optional["VideoSink"]):
+    """Sink the temperature images are written into directly (e.g. a
+    `MmapLoopbackSink`). If it has no free buffer, the frame is skipped
+    for the sink, but still processed.
+    """
+    if "sink" not in self._pipeline:
+      if sink is not None:
+        logging.warn("stats only mode, the video sink isn't used")
+      return
+    self._pipeline["sink"].sink = sink
+
+  def add_region(self, name: str, region: Region):
+    """Register a region, whose statistics are added to every frame
+    (`Frame.regions`)
+    """
+    self._img_proc.regions.add(name, region)
+
+  def remove_region(self, name: str):
+    self._img_proc.regions.remove(name)
+
+  @property
+  def dropped_frames(self) -> int:
+    """Number of frames dropped between acquisition and processing
+    """
+    return self._frame_queue.dropped
+
+  @property
+  def frame_queue(self) -> FrameQueue:
+    return self._frame_queue
+
+  @property
+  def frame_bus(self) -> Optional[FrameBus]:
+    return self._bus
+
+  @property
+  def stream(self) -> Optional[StreamServer]:
+    return self._stream
+
+  @property
+  def timing(self) -> FrameTiming:
+    """Frame interval, jitter and gaps of the stream
+    """
+    return self._timing
+
+  @property
+  def metrics(self) -> Metrics:
+    return self._metrics
 
   def start_stream(self):
-    self._enable_recv_thread.set()
-    self._protocol.setStream(True)
-    self._shutter.doShutter()
+    # not in the middle of a calibration chunk downloaded in the background
+    with self._usb_lock:
+      self._timing.restart()
+      self._shutter.reset()
+      self._enable_recv_thread.set()
+      self._protocol.setStream(True)
+    # otherwise done, once the calibration data is installed
+    if self.calibrated:
+      self._shutter.doShutter()
 
   def stop_stream(self):
-    self._protocol.setStream(False)
-    self._enable_recv_thread.clear()
+    with self._usb_lock:
+      self._protocol.setStream(False)
+      self._enable_recv_thread.clear()
+      self._shutter.reset()
+      # transfers in flight would take the data of the next command
+      self._usb.cancel_stream()
+
+  def shutter(self):
+    """Request a shutter calibration, which runs with the next frames
+    """
+    if not self.calibrated:
+      logging.warn("calibration data not loaded yet, no shutter calibration")
+      return
+    self._shutter.doShutter()
+
+  @property
+  def calibrated(self) -> bool:
+    """Whether the calibration data is loaded (always, apart from the
+    start of a progressive startup)
+    """
+    return self._img_proc.radiometric
+
+  @property
+  def calibrating(self) -> bool:
+    return self._shutter.calibrating
 
 
   ###### stream functions ######
   def _read_data_listener(self, should_process: Event):
-    frames = 0
-
+    """Acquisition stage: reads and parses the stream and hands the
+    frames over to the processing stage. Never waits on processing,
+    unless the frame queue uses the blocking policy.
+    """
     while True:
       should_process.wait()
 
       try:
-        data = self._usb.epi.read(8192, timeout=200)
-        _t_start = time.monotonic_ns()
-        data = data.tobytes()
-
-        raw_frame = self._parser.parse_stream(data)
+        with self._usb_lock:
+          # the stream might have been stopped while waiting for the lock
+          if not should_process.is_set():
+            continue
+          raw_frame = self._read_frame()
 
         if raw_frame is not None:
-          frame = self._img_proc.process(raw_frame)
-
-          _t_end = time.monotonic_ns()
-          if _t_end - _t_start > 15e6:
-            logging.warn(f"Δt = {(_t_end - _t_start) / 1e6:.2f}ms")
-
-          if self._listener is not None:
-            self._listener(frame)
-
-          self._state.measureParam.setFromFrame(raw_frame, self._state.module_tp)
-          if frames % 25 == 0:
-            self._changeR()
-            frames = 0
-          frames += 1
-
-          self._shutter.automaticShutter()
+          self._metrics.inc("frames_received")
+          self._timing.update(raw_frame)
+          if not self._frame_queue.put(raw_frame):
+            logging.debug(f"frame queue full, dropped {self._frame_queue.dropped} frames so far")
 
       except usb.core.USBTimeoutError:
+        self._metrics.inc("timeouts")
         logging.warn("timeout")
       except usb.core.USBError as e:
         logging.error("Stopping receive")
         raise e
 
+  def _process_data_listener(self):
+    """Processing stage: runs the pipeline (image processing, outputs,
+    parameter / shutter updates) for every queued frame.
+    """
+    while True:
+      raw_frame = self._frame_queue.get()
+      self._pipeline.run(raw_frame)
+      self._metrics.inc("frames_processed")
+
+  def _read_frame(self) -> Optional[RawFrame]:
+    """Read the next chunk from the stream endpoint and feed it into
+    the parser. Returns the parsed frame (if complete), stamped with
+    the completion time of the chunk and its sequence number.
+    """
+    _t = time.perf_counter_ns()
+    if isinstance(self._parser, MobirAirRingParser):
+      length = self._usb.read_into(self._parser.writable(), timeout=200)
+      _t = self._metrics.observe("usb_read", _t)
+      raw_frame = self._parser.commit(length)
+    else:
+      length = self._usb.read_into(self._chunk, timeout=200)
+      _t = self._metrics.observe("usb_read", _t)
+      raw_frame = self._parser.parse_stream(self._chunk[:length].tobytes())
+
+    if raw_frame is not None:
+      self._sequence += 1
+      raw_frame.timestamp = self._usb.last_completion_ns
+      raw_frame.sequence = self._sequence
+
+    self._metrics.observe("parse", _t)
+    return raw_frame
+
   def _changeR(self):
     """Method to change detect index
     Seems to depend on the fpa temperature, using the
@@ -171,7 +408,8 @@ class MobirAirDriver:
       logging.debug(f"Setting new changeRidx: {changeRidx}")
       self._state.measureParam.currChangeRTfpgIdx = changeRidx
       self._protocol.setChangeR(changeRidx)
-      self._shutter.manualShutter()
+      if self.calibrated:
+        self._shutter.manualShutter()
 
 
   #### shuttering ####
@@ -191,7 +429,7 @@ class MobirAirDriver:
           self._state.y16_k1 = self._state.y16_k0
 
         lastLastAvgShutter = self._state.lastAvgShutter
-        self._state.lastAvgShutter = float(np.average(self._state.shutterFrame))
+        self._state.lastAvgShutter = self._state.shutterMean
 
         if lastLastAvgShutter == 0:
           lastLastAvgShutter = self._state.lastAvgShutter
@@ -209,12 +447,14 @@ class MobirAirDriver:
       else:
         self._state.tFpaDelta = FPATemps.TFPA_DELTA_EXCEPTION
     else:
-      self._state.lastAvgShutter = float(np.average(self._state.shutterFrame))
+      self._state.lastAvgShutter = self._state.shutterMean
       self._state.kjLastShutterTlens = self._state.measureParam.realtimeTlens
 
 
   ###### DATA ######
   def _init_state(self):
+    self.serial = self._protocol.getDeviceSN()
+
     # module tp
     self._state.module_tp = self._protocol.getModuleTP()
 
@@ -225,14 +465,67 @@ class MobirAirDriver:
     tabarr = self._protocol.getJwbTabArrShort(self._state.jwbTabNumber)
     self._state.jwbTabArrShort = np.frombuffer(tabarr, dtype="<u2")
 
+    config = self._state.config
+    cache = None
+    if config.calibrationCacheDir is not None:
+      cache = CalibrationCache(config.calibrationCacheDir, self.serial)
+
+      if not config.refreshCalibration:
+        cached = cache.load(self._state.module_tp, self._state.jwbTabArrShort)
+        if cached is not None:
+          logging.info(f"Using cached calibration data from {cache.path}")
+          self._state.allKdata, self._state.allCurveData = cached
+          return
+
+    if not config.progressiveStartup:
+      self._state.allKdata, self._state.allCurveData = self._download_calibration(cache)
+      return
+
+    # frames (not radiometric) are delivered until the data is installed
+    self._pipeline.remove("auto_shutter")
+    self._pipeline.add(
+      FunctionStage("calibration", self._install_calibration, always=True), before=self._pipeline.names[0])
+    Thread(target=self._load_calibration, args=(cache,), daemon=True).start()
+
+  def _download_calibration(self, cache: Optional[CalibrationCache],
+                            guard: Callable[[], AbstractContextManager] = nullcontext) -> tuple[np.ndarray, np.ndarray]:
     # get k data
-    kdata_raw = self._protocol.getAllKData(self.WIDTH, self.HEIGHT, self._state.jwbTabNumber)
+    kdata_raw = self._protocol.getAllKData(self.WIDTH, self.HEIGHT, self._state.jwbTabNumber, guard)
     kdata = np.frombuffer(kdata_raw, dtype="<u2") \
       .reshape((self._state.jwbTabNumber, self._state.height, self._state.width))
-    self._state.allKdata = kdata
 
     # get all curve data
-    curve_raw = self._protocol.getAllCurveData(self._state.jwbTabNumber)
+    curve_raw = self._protocol.getAllCurveData(self._state.jwbTabNumber, guard)
     curve = np.frombuffer(curve_raw, dtype="<u2") \
       .reshape((self._state.jwbTabNumber, 1700))
-    self._state.allCurveData = curve
+
+    if cache is not None:
+      cache.store(self._state.module_tp, self._state.jwbTabArrShort, kdata, curve)
+    return kdata, curve
+
+  def _load_calibration(self, cache: Optional[CalibrationCache]):
+    """Downloads the calibration data while streaming, every chunk in a
+    short pause of the stream
+    """
+    try:
+      self._pending_calibration = self._download_calibration(cache, self._stream_paused)
+    except Exception as e:
+      logging.error(f"couldn't download the calibration data ({e})")
+
+  def _install_calibration(self, frame: Frame):
+    """Switches to the NUC corrected, radiometric output between two
+    frames
+    """
+    if self._pending_calibration is None:
+      return
+
+    self._state.allKdata, self._state.allCurveData = self._pending_calibration
+    self._pending_calibration = None
+    # first stage, nothing of this frame is computed yet
+    frame.radiometric = True
+
+    self._pipeline.remove("calibration")
+    self._pipeline.add(AutoShutterStage(self._shutter))
+    self._metrics.set("time_to_calibration_seconds", (time.perf_counter_ns() - self._t_created) / 1e9)
+    logging.info("calibration data loaded")
+    self._shutter.doShutter()
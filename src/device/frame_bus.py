@@ -0,0 +1,241 @@
+from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
+from typing import Optional
+import logging
+import struct
+import sys
+import time
+import numpy as np
+
+from .types import CustomParamLine, FixedParamLine, Frame, raw_to_dataclass
+
+
+class FrameBusLayout:
+  """Layout of the shared memory segment.
+
+  The segment starts with a control block (`CONTROL`: magic, slot
+  count, image size, header length) followed by the sequence number of
+  the last published frame. Every slot holds the sequence number of its
+  frame, the timestamp, the raw frame header and the image.
+
+  A slot's sequence number is set to 0 while it is written, so readers
+  can detect frames that have been overwritten under them.
+  """
+  MAGIC = b"MOBIRBUS"
+  CONTROL = struct.Struct("<8sIIII")
+  CONTROL_SIZE = 64
+  SLOT_HEADER = 16
+  HEADER_LENGTH = 240
+
+  def __init__(self, slots: int, width: int, height: int) -> None:
+    self.slots = slots
+    self.width = width
+    self.height = height
+
+    self.image_size = width * height * 2
+    # keep slots 64 byte aligned
+    self.slot_size = -(-(self.SLOT_HEADER + self.HEADER_LENGTH + self.image_size) // 64) * 64
+    self.size = self.CONTROL_SIZE + slots * self.slot_size
+
+  def pack_control(self) -> bytes:
+    return self.CONTROL.pack(self.MAGIC, self.slots, self.width, self.height, self.HEADER_LENGTH)
+
+  @classmethod
+  def unpack_control(cls, buffer) -> "FrameBusLayout":
+    magic, slots, width, height, header_length = cls.CONTROL.unpack_from(buffer)
+    if magic != cls.MAGIC or header_length != cls.HEADER_LENGTH:
+      raise ValueError("shared memory segment is not a frame bus")
+    return cls(slots, width, height)
+
+  def views(self, buf: memoryview):
+    """numpy views of the write sequence number and of all slots
+    """
+    base = np.frombuffer(buf, dtype="u1", count=self.size)
+    write_seq = base[self.CONTROL.size:self.CONTROL.size + 8].view("<u8")
+
+    slots = base[self.CONTROL_SIZE:].reshape((self.slots, self.slot_size))
+    seqs = [s[0:8].view("<u8") for s in slots]
+    timestamps = [s[8:16].view("<i8") for s in slots]
+    headers = [s[16:16 + self.HEADER_LENGTH] for s in slots]
+    images = [
+      s[16 + self.HEADER_LENGTH:16 + self.HEADER_LENGTH + self.image_size]
+        .view("<u2").reshape((self.height, self.width))
+      for s in slots
+    ]
+    return write_seq, seqs, timestamps, headers, images
+
+
+class FrameBus:
+  """Publishes frames into a ring of slots in shared memory.
+
+  Any number of processes can subscribe with `FrameBusSubscriber` and
+  read the frames without copies or pickling. The publisher never waits
+  on subscribers, a slow subscriber misses frames instead. A segment
+  left over from a publisher that crashed is replaced.
+  """
+
+  def __init__(self, name: str, width: int, height: int, slots: int = 8) -> None:
+    self.layout = FrameBusLayout(slots, width, height)
+    try:
+      self._shm = shared_memory.SharedMemory(name, create=True, size=self.layout.size)
+    except FileExistsError:
+      # left over from a publisher that didn't exit cleanly
+      logging.warn(f"frame bus: removing stale segment {name}")
+      stale = shared_memory.SharedMemory(name, create=False)
+      stale.close()
+      stale.unlink()
+      self._shm = shared_memory.SharedMemory(name, create=True, size=self.layout.size)
+    self._shm.buf[:FrameBusLayout.CONTROL.size] = self.layout.pack_control()
+
+    self._write_seq, self._seqs, self._timestamps, self._headers, self._images = \
+      self.layout.views(self._shm.buf)
+    self._write_seq[0] = 0
+    for seq in self._seqs:
+      seq[0] = 0
+
+  @property
+  def name(self) -> str:
+    return self._shm.name
+
+  @property
+  def sequence(self) -> int:
+    return int(self._write_seq[0])
+
+  def publish(self, frame: Frame, timestamp_ns: Optional[int] = None):
+    seq = int(self._write_seq[0]) + 1
+    slot = seq % self.layout.slots
+
+    self._seqs[slot][0] = 0
+    self._timestamps[slot][0] = time.monotonic_ns() if timestamp_ns is None else timestamp_ns
+    self._headers[slot][:] = np.frombuffer(frame.header, dtype="u1", count=FrameBusLayout.HEADER_LENGTH)
+    self._images[slot][...] = frame.image
+    self._seqs[slot][0] = seq
+
+    self._write_seq[0] = seq
+
+  def close(self):
+    """Close and remove the shared memory segment
+    """
+    self._write_seq = self._seqs = self._timestamps = self._headers = self._images = None
+    self._shm.close()
+    self._shm.unlink()
+
+
+@dataclass
+class BusFrame:
+  """Frame read from a frame bus. `image` and `header` are views into
+  the shared memory, that stay valid as long as `valid` is True (i.e.
+  until the publisher wraps around). Copy them to keep them longer.
+  """
+  sequence: int
+  timestamp_ns: int
+  header: np.ndarray
+  image: np.ndarray
+  _slot_seq: np.ndarray
+
+  @property
+  def valid(self) -> bool:
+    return int(self._slot_seq[0]) == self.sequence
+
+  @property
+  def fixedParam(self) -> FixedParamLine:
+    return raw_to_dataclass(FixedParamLine, self.header.tobytes())
+
+  @property
+  def customParam(self) -> CustomParamLine:
+    return raw_to_dataclass(CustomParamLine, self.header.tobytes())
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+  """Attach to an existing segment without registering it with the
+  resource tracker, which would remove it once this process exits.
+  Only the publisher owns (and removes) the segment.
+  """
+  if sys.version_info >= (3, 13):
+    return shared_memory.SharedMemory(name, create=False, track=False)
+
+  register = resource_tracker.register
+  resource_tracker.register = lambda name, rtype: None
+  try:
+    return shared_memory.SharedMemory(name, create=False)
+  finally:
+    resource_tracker.register = register
+
+
+class FrameBusSubscriber:
+  """Reads the frames of a `FrameBus` from another process (or thread).
+
+  Frames are returned in order. If the subscriber falls more than the
+  number of slots behind, it skips ahead to the oldest frame still
+  available and counts the skipped frames in `missed`.
+  """
+
+  def __init__(self, name: str, poll_interval: float = 1e-3) -> None:
+    self._shm = _attach(name)
+
+    self.layout = FrameBusLayout.unpack_control(self._shm.buf)
+    self._write_seq, self._seqs, self._timestamps, self._headers, self._images = \
+      self.layout.views(self._shm.buf)
+
+    self.poll_interval = poll_interval
+    # start with the next published frame
+    self._next = int(self._write_seq[0]) + 1
+    self.missed = 0
+
+  def get(self, timeout: Optional[float] = None) -> Optional[BusFrame]:
+    """Return the next frame. Returns None on timeout.
+    """
+    t_end = None if timeout is None else time.monotonic() + timeout
+
+    while True:
+      frame = self.poll()
+      if frame is not None:
+        return frame
+      if t_end is not None and time.monotonic() >= t_end:
+        return None
+      time.sleep(self.poll_interval)
+
+  def poll(self) -> Optional[BusFrame]:
+    """Return the next frame, or None if there is no new one
+    """
+    while True:
+      latest = int(self._write_seq[0])
+      if latest < self._next:
+        return None
+
+      oldest = latest - self.layout.slots + 1
+      if self._next < oldest:
+        self.missed += oldest - self._next
+        self._next = oldest
+
+      seq = self._next
+      slot = seq % self.layout.slots
+      if int(self._seqs[slot][0]) != seq:
+        # overwritten while we looked, try again
+        continue
+
+      frame = BusFrame(
+        sequence=seq,
+        timestamp_ns=int(self._timestamps[slot][0]),
+        header=self._headers[slot],
+        image=self._images[slot],
+        _slot_seq=self._seqs[slot],
+      )
+      if not frame.valid:
+        continue
+
+      self._next = seq + 1
+      return frame
+
+  def latest(self) -> Optional[BusFrame]:
+    """Skip all pending frames and return the newest one
+    """
+    latest = int(self._write_seq[0])
+    if latest >= self._next:
+      self.missed += max(0, latest - self._next)
+      self._next = latest
+    return self.poll()
+
+  def close(self):
+    self._write_seq = self._seqs = self._timestamps = self._headers = self._images = None
+    self._shm.close()
@@ -0,0 +1,78 @@
+from collections import deque
+from enum import Enum
+from threading import Condition
+from typing import Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class DropPolicy(str, Enum):
+  BLOCK = "block"
+  DROP_OLDEST = "drop-oldest"
+  DROP_NEWEST = "drop-newest"
+
+
+class FrameQueue(Generic[T]):
+  """Bounded queue between the acquisition and the processing stage.
+
+  When the queue is full, `policy` decides whether the producer waits
+  for free space (BLOCK), the oldest queued item is replaced (DROP_OLDEST)
+  or the new item is discarded (DROP_NEWEST).
+  """
+
+  def __init__(self, maxsize: int = 4, policy: DropPolicy = DropPolicy.DROP_OLDEST) -> None:
+    if maxsize < 1:
+      raise ValueError("maxsize needs to be at least 1")
+
+    self.maxsize = maxsize
+    self.policy = policy
+
+    self._items: deque[T] = deque()
+    self._cond = Condition()
+
+    self.dropped_oldest = 0
+    self.dropped_newest = 0
+
+  @property
+  def dropped(self) -> int:
+    return self.dropped_oldest + self.dropped_newest
+
+  def __len__(self) -> int:
+    return len(self._items)
+
+  def put(self, item: T) -> bool:
+    """Add item to queue. Returns False, if an item had to be dropped.
+    """
+    with self._cond:
+      accepted = True
+
+      if len(self._items) >= self.maxsize:
+        if self.policy == DropPolicy.BLOCK:
+          self._cond.wait_for(lambda: len(self._items) < self.maxsize)
+        elif self.policy == DropPolicy.DROP_OLDEST:
+          self._items.popleft()
+          self.dropped_oldest += 1
+          accepted = False
+        else:
+          self.dropped_newest += 1
+          return False
+
+      self._items.append(item)
+      self._cond.notify_all()
+      return accepted
+
+  def get(self, timeout: Optional[float] = None) -> Optional[T]:
+    """Remove and return the oldest item. Returns None on timeout.
+    """
+    with self._cond:
+      if not self._cond.wait_for(lambda: len(self._items) > 0, timeout):
+        return None
+
+      item = self._items.popleft()
+      self._cond.notify_all()
+      return item
+
+  def clear(self):
+    with self._cond:
+      self._items.clear()
+      self._cond.notify_all()
@@ -0,0 +1,62 @@
+from typing import Optional
+
+from .types import RawFrame
+
+
+class FrameTiming:
+  """Running statistics of the frame arrival.
+
+  The frame interval is a moving average, the jitter the moving average
+  of the deviations from it (like the RTP interarrival jitter), both in
+  seconds. Lost frames show as gaps of the device frame counter, or
+  without one, as intervals longer than `gap_factor` times the average
+  interval. `missed` estimates the frames lost in the gaps.
+
+  `restart` continues with the next frame, without counting the time in
+  between as gap (e.g. after the stream has been paused).
+  """
+  # range of the device frame counter
+  COUNTER_MODULO = 2**16
+
+  def __init__(self, gap_factor: float = 1.5, smoothing: float = 1 / 16) -> None:
+    self.gap_factor = gap_factor
+    self.smoothing = smoothing
+
+    self.frames = 0
+    self.gaps = 0
+    self.missed = 0
+    self.interval = 0.0
+    self.jitter = 0.0
+
+    self._last_timestamp: Optional[int] = None
+    self._last_counter: Optional[int] = None
+
+  def restart(self):
+    self._last_timestamp = self._last_counter = None
+
+  def update(self, frame: RawFrame):
+    last_timestamp, self._last_timestamp = self._last_timestamp, frame.timestamp
+    last_counter, self._last_counter = self._last_counter, frame.deviceCounter
+    self.frames += 1
+    if last_timestamp is None or frame.timestamp is None:
+      return
+
+    dt = (frame.timestamp - last_timestamp) / 1e9
+    if frame.deviceCounter is not None and last_counter is not None:
+      lost = (frame.deviceCounter - last_counter - 1) % self.COUNTER_MODULO
+    elif self.interval > 0 and dt > self.gap_factor * self.interval:
+      lost = max(round(dt / self.interval) - 1, 1)
+    else:
+      lost = 0
+
+    if lost > 0:
+      # not a frame interval
+      self.gaps += 1
+      self.missed += lost
+      return
+
+    if self.interval == 0:
+      self.interval = dt
+      return
+    self.jitter += (abs(dt - self.interval) - self.jitter) * self.smoothing
+    self.interval += (dt - self.interval) * self.smoothing
@@ -1,67 +1,155 @@
 from device.device_state import MobirAirState
-from device.temputils import MobirAirTempUtils
+from device.temputils import MobirAirTempLUT, MobirAirTempUtils
+from device.roi import RegionStats, RegionStatsEngine
 from .types import Frame, RawFrame
+from typing import Optional
 import numpy as np
 import logging
+import time
 
 
 class ThermalFrameProcessor:
   def __init__(self, state: MobirAirState) -> None:
     self._state = state
     self._temp = MobirAirTempUtils(state)
+    self._temp_lut = MobirAirTempLUT(state)
+
+    shape = (state.height - state.refHeight, state.width)
+    self.regions = RegionStatsEngine(shape)
+    # reusable buffers of the NUC stage
+    self._acc = np.empty(shape, dtype="i8")
+    self._acc_f = np.empty(shape, dtype="f8")
+    self._nuc_out = np.empty(shape, dtype="<u2")
+
+    # gain / offset planes and what they have been computed from
+    self._planes_key: Optional[tuple] = None
+    self._gain: Optional[np.ndarray] = None
+    self._offset: Optional[np.ndarray] = None
+
+  def process(self, frame: RawFrame, out: Optional[np.ndarray] = None) -> Frame:
+    """Process raw frame into a (lazy) frame, whose temperature image
+    is written into `out` (e.g. a video buffer) if given. Only the
+    shutter frame is taken right away.
+    """
+    if frame.fixedParam.isShuttering:
+      self.updateShutterFrame(frame)
+
+    return Frame(frame, self, out, radiometric=self.radiometric)
 
-  def process(self, frame: RawFrame) -> Frame:
+  @property
+  def radiometric(self) -> bool:
+    """Whether the calibration data (K data and curves) is available
+    """
+    return self._state.allKdata is not None and self._state.allCurveData is not None
+
+  def rawImage(self, frame: RawFrame) -> np.ndarray:
     image = np.frombuffer(frame.payload, dtype="<u2") \
       .reshape((self._state.height, self._state.width))
     # remove reference rows, that are not used otherwise
-    image = image[self._state.refHeight:,:]
+    return image[self._state.refHeight:,:]
 
-    if frame.fixedParam.isShuttering:
-      self._handleShutter(image)
-    else:
-      image = self._normal_processing(image)
+  def regionStats(self, img: np.ndarray) -> dict[str, RegionStats]:
+    if not len(self.regions):
+      return {}
 
-    image = self._temperature_proc(image)
+    _t_start = time.perf_counter_ns()
+    stats = self.regions.compute(img, self.toKelvin)
+    self._state.metrics.observe("regions", _t_start)
+    return stats
 
-    return Frame(
-      image=image,
-      **frame.__dict__
-    )
+  def toKelvin(self, values: np.ndarray) -> np.ndarray:
+    """Temperatures (Kelvin * 100) of some Y16 values
+    """
+    if not self.radiometric:
+      return values
+    if self._state.config.useTempLUT:
+      return self._temp_lut.lookup(values)
+    return self._temp.y16toKelvin(values)
 
-  def _temperature_proc(self, img: np.ndarray):
+  def temperature(self, img: np.ndarray, out: Optional[np.ndarray] = None):
     """Get temps for raw frame and return them in Kelvin
     """
-    img = self._temp.y16toTemp(img)
-    return ((img + 273.15) * 100).astype("u2")
+    _t_start = time.perf_counter_ns()
+    if not self.radiometric:
+      # no curves yet, pass the Y16 values on
+      if out is None:
+        img = img.copy()
+      else:
+        out[...] = img
+        img = out
+    elif self._state.config.useTempLUT:
+      img = self._temp_lut.lookup(img, out)
+    else:
+      img = self._temp.y16toKelvin(img)
+      if out is not None:
+        out[...] = img
+        img = out
+
+    self._state.metrics.observe("temperature", _t_start)
+    return img
+
+  def updateShutterFrame(self, frame: RawFrame):
+    """Only take the shutter frame of a shuttering frame, without
+    processing it
+    """
+    self._handleShutter(self.rawImage(frame))
 
   def _handleShutter(self, img: np.ndarray):
-    self._state.shutterFrame = img
+    # the payload might only be a view into the parser buffer
+    self._state.shutterFrame = img.copy()
 
-  def _normal_processing(self, img: np.ndarray) -> np.ndarray:
-    if self._state.config.doNUC:
+  def correct(self, img: np.ndarray) -> np.ndarray:
+    """NUC / basic calibration of a raw image, into a reused buffer
+    """
+    _t_start = time.perf_counter_ns()
+    if self._state.config.doNUC and self._state.allKdata is not None:
       img = self.doNUCbyTwoPoint(img)
     elif self._state.config.useCalib:
       img = self.doBasicCalibration(img)
 
+    self._state.metrics.observe("nuc", _t_start)
+
     return img
 
+  def _nuc_planes(self) -> tuple[np.ndarray, np.ndarray]:
+    """Gain and offset planes of the two point NUC. They only change
+    with the shutter frame, the detect index or the K data.
+
+    `⌊ avgSingleB + (frame[i] - bArr[i]) * kArr[i] / 2¹³ ⌋` is evaluated
+    exactly in integers as `(frame[i] * gain[i] + offset[i]) >> 13`, with
+    `gain = kArr` and `offset = ⌊ avgSingleB * 2¹³ ⌋ - bArr * kArr`.
+    """
+    state = self._state
+    key = (state.shutterFrame, state.allKdata, state.measureParam.currChangeRTfpgIdx)
+    cached = self._planes_key
+    if cached is None or cached[0] is not key[0] or cached[1] is not key[1] or cached[2] != key[2]:
+      gain = state.getCurrKArr().astype("i8")
+      offset = np.floor(state.shutterMean * 2**13).astype("i8") - state.shutterFrame * gain
+
+      self._planes_key = key
+      self._gain, self._offset = gain, offset
+
+    return self._gain, self._offset
+
   def doNUCbyTwoPoint(self, img: np.ndarray) -> np.ndarray:
     if self._state.allKdata is None:
       logging.error("allKdata is none")
       return img
 
     # `∀i: y16arr[i] = ⌊ avgSingleB + (frame[i] - bArr[i]) * kArr[i] / 2¹³ ⌋`
-    avg = np.average(self._state.shutterFrame)
-    img = img.astype("i4")
-
-    return np.floor(
-      avg + (img - self._state.shutterFrame) * self._state.getCurrKArr() / 2**13
-    ).astype("u2")
+    gain, offset = self._nuc_planes()
+    acc = self._acc
+    np.multiply(img, gain, out=acc)
+    np.add(acc, offset, out=acc)
+    np.right_shift(acc, 13, out=acc)
+    np.copyto(self._nuc_out, acc, casting="unsafe")
+    return self._nuc_out
 
   def doBasicCalibration(self, img: np.ndarray) -> np.ndarray:
-    avg = np.average(self._state.shutterFrame)
-    img = img.astype("i4")
-
-    return (avg + (img - self._state.shutterFrame)).astype("<u2")
+    acc = self._acc_f
+    np.subtract(img, self._state.shutterFrame, out=acc)
+    np.add(acc, self._state.shutterMean, out=acc)
+    np.copyto(self._nuc_out, acc, casting="unsafe")
+    return self._nuc_out
 
 
@@ -0,0 +1,165 @@
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Optional
+import logging
+import usb.core
+
+from .device_state import MobirAirConfig
+from .driver import MobirAirDriver
+from .metrics import MetricsFileWriter, MetricsGroup, MetricsServer
+from .protocol import MobirAirUSBProtocol
+from .usb_wrapper import MobirAirUSBWrapper
+
+
+def serial_name(serial: bytes) -> str:
+  return serial.decode("ascii", errors="replace").strip("\x00 ")
+
+
+@dataclass
+class CameraInfo:
+  location: str
+  # None, if the camera is used by another process
+  serial: Optional[str]
+
+
+class MobirAirDeviceManager:
+  """Runs several cameras in one process.
+
+  Every camera gets its own driver (and therefore its own acquisition
+  and processing pipeline). Cameras are selected by their USB location
+  (`<bus>-<port>.<port>…`) or serial number. The serial numbers are only
+  known after querying a device, which is done without resetting it and
+  skipped for devices used by another process. Only the cameras opened
+  are reset.
+
+  Per camera outputs in `config` are made unique by appending the
+  serial (frame bus name, recording path) or by counting up (stream
+  port, in the order the cameras are opened), metrics of all cameras are
+  exported together with a `camera` label.
+  """
+
+  def __init__(self, config: Optional[MobirAirConfig] = None) -> None:
+    self.config = config or MobirAirConfig()
+    self.drivers: dict[str, MobirAirDriver] = {}
+
+    # opened devices by location
+    self._usb: dict[str, MobirAirUSBWrapper] = {}
+    self._serials: dict[str, str] = {}
+
+    self.metrics = MetricsGroup()
+    self._metrics_server = None
+    self._metrics_writer = None
+    if self.config.metricsPort is not None:
+      self._metrics_server = MetricsServer(self.metrics, self.config.metricsPort)
+    if self.config.metricsFile is not None:
+      self._metrics_writer = MetricsFileWriter(self.metrics, self.config.metricsFile, self.config.metricsInterval)
+
+  @staticmethod
+  def location(dev: usb.core.Device) -> str:
+    ports = ".".join(str(p) for p in (dev.port_numbers or ()))
+    return f"{dev.bus}-{ports}"
+
+  @staticmethod
+  def find_devices() -> list[usb.core.Device]:
+    return list(usb.core.find(find_all=True, idVendor=0x0525))
+
+  def _serial(self, dev: usb.core.Device) -> Optional[str]:
+    """Serial of the device, None if it is used by another process
+    """
+    location = self.location(dev)
+    if location not in self._serials:
+      try:
+        wrapper = MobirAirUSBWrapper(dev, reset=False)
+      except usb.core.USBError as e:
+        logging.info(f"manager: camera at {location} is in use ({e})")
+        return None
+
+      # the stream might still be enabled from a previous run
+      protocol = MobirAirUSBProtocol(wrapper)
+      protocol.setStream(False)
+      wrapper.drain()
+      self._serials[location] = serial_name(protocol.getDeviceSN())
+      del wrapper
+
+    return self._serials[location]
+
+  def _open_usb(self, dev: usb.core.Device) -> MobirAirUSBWrapper:
+    location = self.location(dev)
+    if location not in self._usb:
+      wrapper = MobirAirUSBWrapper(
+        dev, async_depth=self.config.asyncTransfers, transfer_size=self.config.transferSize)
+
+      # the stream might still be enabled from a previous run
+      MobirAirUSBProtocol(wrapper).setStream(False)
+      self._usb[location] = wrapper
+
+    return self._usb[location]
+
+  def enumerate(self) -> list[CameraInfo]:
+    return [CameraInfo(self.location(dev), self._serial(dev)) for dev in self.find_devices()]
+
+  def _camera_config(self, serial: str) -> MobirAirConfig:
+    config = self.config
+    return replace(
+      config,
+      metricsPort=None,
+      metricsFile=None,
+      frameBusName=None if config.frameBusName is None else f"{config.frameBusName}-{serial}",
+      streamPort=None if config.streamPort is None else config.streamPort + len(self.drivers),
+      recordingPath=None if config.recordingPath is None
+        else Path(config.recordingPath).with_stem(f"{Path(config.recordingPath).stem}-{serial}"),
+    )
+
+  def open(self, selector: Optional[str] = None) -> MobirAirDriver:
+    """Open the camera with the given location or serial (the first one
+    not yet opened, if None).
+    """
+    devices = self.find_devices()
+    # locations are known without querying the devices
+    if any(self.location(dev) == selector for dev in devices):
+      devices = [dev for dev in devices if self.location(dev) == selector]
+
+    for dev in devices:
+      location = self.location(dev)
+      serial = self._serial(dev)
+      if serial is None or (selector is not None and selector not in (location, serial)):
+        continue
+
+      if serial in self.drivers:
+        if selector is None:
+          continue
+        return self.drivers[serial]
+
+      logging.info(f"manager: opening camera {serial} at {location}")
+      driver = MobirAirDriver(self._camera_config(serial), self._open_usb(dev))
+
+      self.drivers[serial] = driver
+      self.metrics.add(serial, driver.metrics)
+      return driver
+
+    raise Exception(f"camera {selector or ''} not found")
+
+  def open_all(self) -> list[MobirAirDriver]:
+    for camera in self.enumerate():
+      if camera.serial is not None:
+        self.open(camera.location)
+    return list(self.drivers.values())
+
+  def start(self):
+    for driver in self.drivers.values():
+      driver.stop_stream()
+      driver.start_stream()
+
+  def stop(self):
+    for driver in self.drivers.values():
+      try:
+        driver.stop()
+      except Exception as e:
+        logging.error(f"manager: couldn't stop camera {serial_name(driver.serial)} ({e})")
+    self.drivers.clear()
+    self._usb.clear()
+
+    if self._metrics_server is not None:
+      self._metrics_server.stop()
+    if self._metrics_writer is not None:
+      self._metrics_writer.stop()
@@ -0,0 +1,214 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import Callable
+import logging
+import os
+import time
+
+
+class Histogram:
+  """Latency histogram with fixed buckets. Observing a value is a
+  bisect over the bucket bounds and two additions.
+  """
+  BOUNDS = (
+    50e-6, 100e-6, 250e-6, 500e-6,
+    1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3, 50e-3, 100e-3, 250e-3, 500e-3,
+    1, 2.5, 5,
+  )
+
+  def __init__(self) -> None:
+    self._bounds_ns = [int(b * 1e9) for b in self.BOUNDS]
+    # last bucket is +Inf
+    self.counts = [0] * (len(self.BOUNDS) + 1)
+    self.sum_ns = 0
+
+  def observe_ns(self, value: int):
+    self.counts[bisect_left(self._bounds_ns, value)] += 1
+    self.sum_ns += value
+
+  @property
+  def count(self) -> int:
+    return sum(self.counts)
+
+
+class Metrics:
+  """Per stage timings and counters of the driver.
+
+  Stages are timed with `observe` (taking the start time from
+  `time.perf_counter_ns`), counters with `inc` and gauges with `set`.
+  Values owned by other objects (e.g. drop counters) can be exposed
+  with `register` and `register_gauge`.
+
+  The acquisition, processing and executor threads all update the
+  values, so updates and snapshots are done under a lock.
+  """
+  PREFIX = "mobirair"
+
+  def __init__(self) -> None:
+    self.stages: dict[str, Histogram] = {}
+    self.counters: dict[str, int] = {}
+    self.gauges: dict[str, float] = {}
+    self._collected: dict[str, Callable[[], float]] = {}
+    self._collected_gauges: dict[str, Callable[[], float]] = {}
+    self._lock = Lock()
+
+  def observe(self, stage: str, t_start_ns: int) -> int:
+    """Record the time since `t_start_ns` for stage. Returns the current time.
+    """
+    t = time.perf_counter_ns()
+    with self._lock:
+      hist = self.stages.get(stage)
+      if hist is None:
+        hist = self.stages[stage] = Histogram()
+      hist.observe_ns(t - t_start_ns)
+    return t
+
+  def inc(self, counter: str, value: int = 1):
+    with self._lock:
+      self.counters[counter] = self.counters.get(counter, 0) + value
+
+  def set(self, gauge: str, value: float):
+    with self._lock:
+      self.gauges[gauge] = value
+
+  def register(self, counter: str, getter: Callable[[], float]):
+    self._collected[counter] = getter
+
+  def register_gauge(self, gauge: str, getter: Callable[[], float]):
+    self._collected_gauges[gauge] = getter
+
+  def samples(self, labels: dict[str, str] = {}) -> list[tuple[str, str, str]]:
+    """(metric, type, sample line) of all values, with additional `labels`
+    """
+    extra = "".join(f'{key}="{value}",' for key, value in labels.items())
+    metric = f"{self.PREFIX}_stage_seconds"
+    with self._lock:
+      stages = [(stage, list(hist.counts), hist.sum_ns) for stage, hist in self.stages.items()]
+      counters = dict(self.counters)
+      gauges = dict(self.gauges)
+
+    samples = []
+    for stage, counts, sum_ns in stages:
+      cumulative = 0
+      for bound, count in zip(Histogram.BOUNDS + (float("inf"),), counts):
+        cumulative += count
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        samples.append((metric, "histogram", f'{metric}_bucket{{{extra}stage="{stage}",le="{le}"}} {cumulative}'))
+      samples.append((metric, "histogram", f'{metric}_sum{{{extra}stage="{stage}"}} {sum_ns / 1e9}'))
+      samples.append((metric, "histogram", f'{metric}_count{{{extra}stage="{stage}"}} {cumulative}'))
+
+    counters.update({name: getter() for name, getter in self._collected.items()})
+    for name, value in sorted(counters.items()):
+      metric = f"{self.PREFIX}_{name}_total"
+      selector = f"{{{extra[:-1]}}}" if extra else ""
+      samples.append((metric, "counter", f"{metric}{selector} {value}"))
+
+    gauges.update({name: getter() for name, getter in self._collected_gauges.items()})
+    for name, value in sorted(gauges.items()):
+      metric = f"{self.PREFIX}_{name}"
+      selector = f"{{{extra[:-1]}}}" if extra else ""
+      samples.append((metric, "gauge", f"{metric}{selector} {value}"))
+
+    return samples
+
+  def render(self) -> str:
+    """Prometheus text exposition format
+    """
+    return render_samples(self.samples())
+
+
+class MetricsGroup:
+  """Metrics of several drivers, exposed together with a label
+  (e.g. `camera`) telling them apart
+  """
+
+  def __init__(self, label: str = "camera") -> None:
+    self.label = label
+    self.members: dict[str, Metrics] = {}
+
+  def add(self, name: str, metrics: Metrics):
+    self.members[name] = metrics
+
+  def render(self) -> str:
+    samples = []
+    for name, metrics in list(self.members.items()):
+      samples += metrics.samples({self.label: name})
+    return render_samples(samples)
+
+
+def render_samples(samples: list[tuple[str, str, str]]) -> str:
+  """Prometheus text exposition format, with the samples of each metric
+  grouped below its TYPE line
+  """
+  grouped: dict[tuple[str, str], list[str]] = {}
+  for metric, type, line in samples:
+    grouped.setdefault((metric, type), []).append(line)
+
+  lines = []
+  for (metric, type), metric_lines in grouped.items():
+    lines.append(f"# TYPE {metric} {type}")
+    lines += metric_lines
+  return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+  """Serves the metrics on http://<host>:<port>/metrics
+  """
+
+  def __init__(self, metrics: Metrics | MetricsGroup, port: int, host: str = "127.0.0.1") -> None:
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path != "/metrics":
+          self.send_error(404)
+          return
+
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    self._server = ThreadingHTTPServer((host, port), Handler)
+    self._thread = Thread(target=self._server.serve_forever, daemon=True)
+    self._thread.start()
+    logging.info(f"metrics: serving on http://{host}:{self._server.server_port}/metrics")
+
+  @property
+  def port(self) -> int:
+    return self._server.server_port
+
+  def stop(self):
+    self._server.shutdown()
+
+
+class MetricsFileWriter:
+  """Periodically writes the metrics into a file (replaced atomically)
+  """
+
+  def __init__(self, metrics: Metrics | MetricsGroup, path: Path | str, interval: float = 10) -> None:
+    self._metrics = metrics
+    self._path = Path(path)
+    self._interval = interval
+    self._stop = Event()
+    self._thread = Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def _run(self):
+    while not self._stop.wait(self._interval):
+      self.write()
+
+  def write(self):
+    tmp = self._path.with_name(self._path.name + ".tmp")
+    with open(tmp, "w") as f:
+      f.write(self._metrics.render())
+    os.replace(tmp, self._path)
+
+  def stop(self):
+    self._stop.set()
+    self.write()
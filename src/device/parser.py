@@ -1,4 +1,6 @@
 from typing import Optional
+import time
+import numpy as np
 
 from device.device_state import MobirAirState
 
@@ -9,11 +11,20 @@ class MobirAirParser:
   FRAME_START = bytes.fromhex("55aa2700")
   FRAME_HEADER_LENGTH = 240
   IMAGE_DEPTH = 2
+  # header offset of a 16 bit frame counter (None, no counter is known
+  # in the headers of this camera)
+  FRAME_COUNTER: Optional[int] = None
 
   def __init__(self, state: MobirAirState) -> None:
     self._stream: bytearray = bytearray()
     self.width = state.width
     self.height = state.height
+    self._metrics = state.metrics
+
+    # times the frame start had to be searched for, and the bytes
+    # discarded doing so
+    self.resyncs = 0
+    self.discarded_bytes = 0
 
   def parse_stream(self, raw: bytes) -> Optional[RawFrame]:
     self._stream.extend(raw)
@@ -21,7 +32,7 @@ class MobirAirParser:
 
     if i >= 0 and (len(self._stream) - i) >= self.frame_size:
       if i > 0:
-        logging.warn(f"parser: i started with offset {i}")
+        self._resynced(i)
 
       frame_data = self._stream[i:i + self.frame_size]
       # resize stream data
@@ -30,22 +41,125 @@ class MobirAirParser:
 
     return None
 
-  def _parse_frame(self, raw: bytes) -> RawFrame:
-    header = raw[:self.FRAME_HEADER_LENGTH]
+  def _resynced(self, discarded: int):
+    logging.warn(f"parser: resynchronized, discarded {discarded} bytes")
+    self.resyncs += 1
+    self.discarded_bytes += discarded
+
+  def _parse_frame(self, raw: bytes | memoryview) -> RawFrame:
+    _t_start = time.perf_counter_ns()
+    header = bytes(raw[:self.FRAME_HEADER_LENGTH])
     fixedParam = FixedParamLine.new(header)
 
     if fixedParam.width != self.width or fixedParam.height != self.height:
       raise Exception(f"Frame parser came across frame with invalid size {fixedParam.width}x{fixedParam.height}")
 
     customParam = CustomParamLine.new(header)
+    deviceCounter = None
+    if self.FRAME_COUNTER is not None:
+      deviceCounter = int.from_bytes(header[self.FRAME_COUNTER:self.FRAME_COUNTER + 2], "little")
+    self._metrics.observe("header_decode", _t_start)
 
     return RawFrame(
       header=header,
       payload=raw[self.FRAME_HEADER_LENGTH:],
       fixedParam=fixedParam,
-      customParam=customParam
+      customParam=customParam,
+      deviceCounter=deviceCounter,
     )
 
   @property
   def frame_size(self):
     return self.width * self.height * self.IMAGE_DEPTH + self.FRAME_HEADER_LENGTH
+
+
+class MobirAirRingParser(MobirAirParser):
+  """Stream parser working on a preallocated ring buffer.
+
+  USB reads land directly in the buffer (see `writable` and `commit`),
+  only newly arrived bytes are searched for the frame start and the
+  returned `RawFrame` payloads are `memoryview`s into the buffer.
+
+  A payload stays valid until the buffer wrapped around, which
+  happens at the earliest after `frames - 1` subsequent frames.
+  """
+
+  def __init__(self, state: MobirAirState, frames: int = 8, chunk_size: int = 8192) -> None:
+    super().__init__(state)
+    self.chunk_size = chunk_size
+
+    self._buffer = bytearray(frames * self.frame_size + chunk_size)
+    self._array = np.frombuffer(self._buffer, dtype="u1")
+    self._view = memoryview(self._buffer)
+
+    # [_read_pos, _write_pos) is data not yet consumed, everything
+    # before _search_pos has already been searched for FRAME_START
+    self._read_pos = 0
+    self._write_pos = 0
+    self._search_pos = 0
+    # whether a frame starts at _read_pos
+    self._synced = False
+    # bytes skipped since the last frame
+    self._skipped = 0
+    self._frame_size = self.frame_size
+
+  def writable(self, size: Optional[int] = None) -> np.ndarray:
+    """Returns the buffer region the next `size` bytes should be written to.
+    The written amount needs to be reported using `commit` afterwards.
+    """
+    size = self.chunk_size if size is None else size
+    self._reserve(size)
+    return self._array[self._write_pos:self._write_pos + size]
+
+  def commit(self, length: int) -> Optional[RawFrame]:
+    self._write_pos += length
+    return self._next_frame()
+
+  def parse_stream(self, raw: bytes) -> Optional[RawFrame]:
+    length = len(raw)
+    self._reserve(length)
+    self._view[self._write_pos:self._write_pos + length] = raw
+    return self.commit(length)
+
+  def _reserve(self, size: int):
+    if self._write_pos + size > len(self._buffer):
+      self._wrap_around()
+      if self._write_pos + size > len(self._buffer):
+        raise ValueError(f"parser: {size} bytes don't fit into ring buffer")
+
+  def _wrap_around(self):
+    # move the unconsumed tail to the front, this overwrites the oldest frames
+    remaining = self._write_pos - self._read_pos
+    self._array[:remaining] = self._array[self._read_pos:self._write_pos]
+
+    self._search_pos -= self._read_pos
+    self._read_pos = 0
+    self._write_pos = remaining
+
+  def _next_frame(self) -> Optional[RawFrame]:
+    if not self._synced:
+      start = max(self._search_pos, self._read_pos)
+      i = self._buffer.find(self.FRAME_START, start, self._write_pos)
+
+      if i < 0:
+        # keep the last bytes, they could contain the start of a sync word
+        self._search_pos = max(self._read_pos, self._write_pos - len(self.FRAME_START) + 1)
+        self._skipped += self._search_pos - self._read_pos
+        self._read_pos = self._search_pos
+        return None
+
+      self._skipped += i - self._read_pos
+      if self._skipped > 0:
+        self._resynced(self._skipped)
+        self._skipped = 0
+
+      self._read_pos = self._search_pos = i
+      self._synced = True
+
+    i = self._read_pos
+    if self._write_pos - i < self._frame_size:
+      return None
+
+    self._read_pos = self._search_pos = i + self._frame_size
+    self._synced = False
+    return self._parse_frame(self._view[i:i + self._frame_size])
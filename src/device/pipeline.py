@@ -0,0 +1,414 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+from typing import Callable, Generator, Iterable, Optional, Protocol
+import logging
+import time
+import numpy as np
+
+from .device_state import MobirAirState, ShutterGating
+from .frame_bus import FrameBus
+from .image_processor import ThermalFrameProcessor
+from .metrics import Metrics
+from .recording import RadiometricWriter
+from .shutterhandling import ShutterHandler
+from .stream_server import StreamServer
+from .types import Frame, RawFrame
+
+
+class VideoSink(Protocol):
+  def dequeue(self) -> Optional[np.ndarray]:
+    ...
+
+  def queue(self, image: np.ndarray, timestamp_ns: Optional[int] = None):
+    ...
+
+  def close(self):
+    ...
+
+
+# buffer name -> (shape, dtype)
+BufferSpec = dict[str, tuple[tuple[int, ...], str]]
+
+
+class Stage:
+  """A processing stage of the `Pipeline`.
+
+  `__call__` gets every frame and returns False to drop it, i.e. to
+  skip the following stages, apart from those marked `always` (e.g.
+  parameter updates). Buffers the stage needs are declared by
+  `buffers` and handed to `setup` once, when the stage is added.
+
+  NUC correction and temperature conversion are lazy properties of the
+  frame, so filters replace `frame.y16` before `frame.image` is read
+  by a later stage.
+  """
+  name = "stage"
+  # also run for frames dropped by an earlier stage
+  always = False
+
+  def buffers(self, shape: tuple[int, int]) -> BufferSpec:
+    return {}
+
+  def setup(self, buffers: dict[str, np.ndarray]):
+    pass
+
+  def __call__(self, frame: Frame) -> bool:
+    raise NotImplementedError
+
+  def close(self):
+    pass
+
+
+class FunctionStage(Stage):
+  """Stage calling `fn(frame)`, which drops the frame by returning False
+  """
+
+  def __init__(self, name: str, fn: Callable[[Frame], Optional[bool]], always: bool = False) -> None:
+    self.name = name
+    self.always = always
+    self._fn = fn
+
+  def __call__(self, frame: Frame) -> bool:
+    return self._fn(frame) is not False
+
+
+class GeneratorStage(Stage):
+  """Stage driven by a generator, which receives the frames by `send`
+  and yields False to drop them. Handy for stages keeping state:
+
+    def every_second():
+      keep = True
+      while True:
+        frame = yield keep
+        keep = not keep
+  """
+
+  def __init__(self, name: str, generator: Generator[Optional[bool], Frame, None], always: bool = False) -> None:
+    self.name = name
+    self.always = always
+    self._generator = generator
+    next(generator)
+
+  def __call__(self, frame: Frame) -> bool:
+    return self._generator.send(frame) is not False
+
+  def close(self):
+    self._generator.close()
+
+
+class ExecutorStage(Stage):
+  """Runs another stage (typically a sink) on its own thread, so it
+  never holds back the pipeline. Frames are detached before they are
+  handed over; with `max_pending` frames in flight, further frames are
+  skipped for this stage (`dropped`).
+  """
+
+  def __init__(self, stage: Stage, max_pending: int = 2) -> None:
+    self.name = stage.name
+    self.stage = stage
+    self.max_pending = max_pending
+    self.dropped = 0
+
+    self._pending = BoundedSemaphore(max_pending)
+    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"stage-{stage.name}")
+
+  def buffers(self, shape: tuple[int, int]) -> BufferSpec:
+    return self.stage.buffers(shape)
+
+  def setup(self, buffers: dict[str, np.ndarray]):
+    self.stage.setup(buffers)
+
+  def _run(self, frame: Frame):
+    try:
+      self.stage(frame)
+    except Exception as e:
+      logging.error(f"pipeline: stage {self.name} failed ({e})")
+    finally:
+      self._pending.release()
+
+  def __call__(self, frame: Frame) -> bool:
+    if not self._pending.acquire(blocking=False):
+      self.dropped += 1
+      return True
+
+    self._executor.submit(self._run, frame.detach())
+    return True
+
+  def close(self):
+    self._executor.shutdown(wait=True)
+    self.stage.close()
+
+
+class Pipeline:
+  """Ordered stages the processing thread runs for every frame.
+
+  Stages can be added, reordered and removed while frames are
+  processed (the list is replaced, never modified in place). Every
+  stage is timed with its name as metrics stage. A stage raising an
+  exception drops the frame (counted as `stage_errors`).
+  """
+  # warn about frames taking longer
+  SLOW_FRAME = 15e6
+
+  def __init__(self, processor: ThermalFrameProcessor, metrics: Metrics, shape: tuple[int, int],
+               stages: Iterable[Stage] = ()) -> None:
+    self._processor = processor
+    self._metrics = metrics
+    self.shape = shape
+    self._stages: list[Stage] = []
+
+    for stage in stages:
+      self.add(stage)
+
+  @property
+  def stages(self) -> list[Stage]:
+    return list(self._stages)
+
+  @property
+  def names(self) -> list[str]:
+    return [s.name for s in self._stages]
+
+  def __getitem__(self, name: str) -> Stage:
+    for stage in self._stages:
+      if stage.name == name:
+        return stage
+    raise KeyError(name)
+
+  def __contains__(self, name: str) -> bool:
+    return name in self.names
+
+  def add(self, stage: Stage, before: Optional[str] = None, after: Optional[str] = None):
+    """Add stage at the end or before / after the stage with that name
+    """
+    specs = stage.buffers(self.shape)
+    stage.setup({name: np.zeros(shape, dtype=dtype) for name, (shape, dtype) in specs.items()})
+
+    stages = list(self._stages)
+    if before is not None:
+      stages.insert(self.names.index(before), stage)
+    elif after is not None:
+      stages.insert(self.names.index(after) + 1, stage)
+    else:
+      stages.append(stage)
+    self._stages = stages
+
+  def remove(self, name: str) -> Stage:
+    stage = self[name]
+    self._stages = [s for s in self._stages if s is not stage]
+    return stage
+
+  def run(self, raw_frame: RawFrame) -> Frame:
+    _t_start = time.monotonic_ns()
+    frame = self._processor.process(raw_frame)
+
+    keep = True
+    for stage in self._stages:
+      if keep or stage.always:
+        _t = time.perf_counter_ns()
+        try:
+          keep = stage(frame) and keep
+        except Exception as e:
+          # drop the frame, but keep the processing thread alive
+          logging.error(f"pipeline: stage {stage.name} failed ({e})")
+          self._metrics.inc("stage_errors")
+          keep = False
+        self._metrics.observe(stage.name, _t)
+
+    _t_end = time.monotonic_ns()
+    if keep and _t_end - _t_start > self.SLOW_FRAME:
+      logging.warn(f"Δt = {(_t_end - _t_start) / 1e6:.2f}ms")
+    return frame
+
+  def close(self):
+    for stage in self._stages:
+      try:
+        stage.close()
+      except Exception as e:
+        logging.error(f"pipeline: couldn't close stage {stage.name} ({e})")
+
+
+###### stages of the driver ######
+class RecordingStage(Stage):
+  """Radiometric recording of the raw frames, starting with the first
+  frame the calibration data is available for
+  """
+  name = "recording"
+
+  def __init__(self, writer: RadiometricWriter) -> None:
+    self.writer = writer
+
+  def __call__(self, frame: Frame) -> bool:
+    if not frame.radiometric:
+      return True
+    self.writer.write(frame.rawFrame, frame.timestamp)
+    return True
+
+  def close(self):
+    self.writer.close()
+
+
+class ShutterGateStage(Stage):
+  """Advances the shutter calibration and flags (or drops) frames
+  captured during it
+  """
+  name = "shutter_gate"
+
+  def __init__(self, shutter: ShutterHandler, state: MobirAirState) -> None:
+    self._shutter = shutter
+    self._state = state
+
+  def __call__(self, frame: Frame) -> bool:
+    frame.calibrating = self._shutter.on_frame(frame.rawFrame, frame.timestamp)
+    if frame.calibrating:
+      self._state.metrics.inc("frames_calibrating")
+    return not (frame.calibrating and self._state.config.shutterGating == ShutterGating.SKIP)
+
+
+class TemporalDenoise(Stage):
+  """Exponential moving average of the NUC corrected values. It is reset
+  by a shutter calibration (the NUC jumps then), so it belongs after the
+  shutter gate.
+  """
+  name = "denoise"
+  # sees the calibrating frames, even if they are skipped
+  always = True
+
+  def __init__(self, alpha: float = 0.5) -> None:
+    if not 0 < alpha <= 1:
+      raise ValueError("alpha needs to be in (0, 1]")
+    self.alpha = alpha
+    self._reset = True
+
+  def buffers(self, shape: tuple[int, int]) -> BufferSpec:
+    return dict(average=(shape, "f4"), scratch=(shape, "f4"), out=(shape, "<u2"))
+
+  def setup(self, buffers: dict[str, np.ndarray]):
+    self._average = buffers["average"]
+    self._scratch = buffers["scratch"]
+    self._out = buffers["out"]
+
+  def __call__(self, frame: Frame) -> bool:
+    if frame.calibrating:
+      self._reset = True
+      return True
+
+    y16 = frame.y16
+    if self._reset:
+      self._reset = False
+      np.copyto(self._average, y16)
+      return True
+
+    # average += alpha * (y16 - average)
+    np.subtract(y16, self._average, out=self._scratch)
+    self._scratch *= self.alpha
+    self._average += self._scratch
+    np.rint(self._average, out=self._scratch)
+    np.copyto(self._out, self._scratch, casting="unsafe")
+    frame.y16 = self._out
+    return True
+
+
+class VideoSinkStage(Stage):
+  """Writes the temperature images into a `VideoSink`. If it has no
+  free buffer, the frame is skipped for the sink.
+  """
+  name = "sink"
+
+  def __init__(self, sink: Optional[VideoSink] = None) -> None:
+    self.sink = sink
+
+  def __call__(self, frame: Frame) -> bool:
+    sink = self.sink
+    buffer = sink.dequeue() if sink is not None else None
+    if buffer is not None:
+      sink.queue(frame.imageInto(buffer), frame.timestamp)
+    return True
+
+  def close(self):
+    if self.sink is not None:
+      self.sink.close()
+
+
+class FrameBusStage(Stage):
+  name = "bus"
+
+  def __init__(self, bus: FrameBus) -> None:
+    self.bus = bus
+
+  def __call__(self, frame: Frame) -> bool:
+    self.bus.publish(frame, frame.timestamp)
+    return True
+
+  def close(self):
+    self.bus.close()
+
+
+class StreamStage(Stage):
+  name = "stream"
+
+  def __init__(self, server: StreamServer) -> None:
+    self.server = server
+
+  def __call__(self, frame: Frame) -> bool:
+    self.server.publish(frame, frame.timestamp)
+    return True
+
+  def close(self):
+    self.server.close()
+
+
+class ListenerStage(Stage):
+  name = "listener"
+
+  def __init__(self, listener: Optional[Callable[[Frame], None]] = None) -> None:
+    self.listener = listener
+
+  def __call__(self, frame: Frame) -> bool:
+    if self.listener is not None:
+      self.listener(frame)
+    return True
+
+
+class MeasureParamStage(Stage):
+  """Takes the sensor temperatures etc. of every frame
+  """
+  name = "measure_param"
+  always = True
+
+  def __init__(self, state: MobirAirState) -> None:
+    self._state = state
+
+  def __call__(self, frame: Frame) -> bool:
+    self._state.measureParam.setFromFrame(frame.rawFrame, self._state.module_tp)
+    return True
+
+
+class EveryStage(Stage):
+  """Calls `fn` every `interval` frames
+  """
+  always = True
+
+  def __init__(self, name: str, fn: Callable[[], None], interval: int) -> None:
+    self.name = name
+    self._fn = fn
+    self.interval = interval
+    self._frames = 0
+
+  def __call__(self, frame: Frame) -> bool:
+    if self._frames % self.interval == 0:
+      self._fn()
+      self._frames = 0
+    self._frames += 1
+    return True
+
+
+class AutoShutterStage(Stage):
+  name = "auto_shutter"
+  always = True
+
+  def __init__(self, shutter: ShutterHandler) -> None:
+    self._shutter = shutter
+
+  def __call__(self, frame: Frame) -> bool:
+    self._shutter.automaticShutter()
+    return True
@@ -1,3 +1,9 @@
+from contextlib import AbstractContextManager, nullcontext
+from typing import Callable
+import logging
+import time
+import numpy as np
+
 from .usb_wrapper import MobirAirUSBWrapper
 
 class USBReadFailedException(Exception):
@@ -10,11 +16,21 @@ class MobirAirUSBProtocol:
     self._usb = usb
     pass
 
-  def get_arm_param(self, address, length) -> bytes:
+  def get_arm_param(self, address, length,
+                    guard: Callable[[], AbstractContextManager] = nullcontext) -> np.ndarray:
+    """Download `length` bytes of parameter memory, returned as uint8 array.
+    All chunks are received directly into a single preallocated buffer.
+
+    Every chunk is downloaded within a `guard()` context, e.g. to pause
+    the stream in between.
+    """
     def to_bytes(v: int) -> bytes:
       return v.to_bytes(2, "little", signed=False)
 
-    buffer = bytearray()
+    # every chunk needs space for its padding to full packets
+    buffer = np.empty(length + self._usb.padded_length(1), dtype="u1")
+    _t_start = time.monotonic()
+
     for s in range(address, address + length, self.MAX_GET_ARM_LENGTH):
       caddress = s // 0x800
       coffset = address % 0x100
@@ -23,12 +39,17 @@ class MobirAirUSBProtocol:
       cmd_args = to_bytes(caddress) + to_bytes(coffset) + to_bytes(clength)
       cmd = b"GetArmParam=" + cmd_args
 
-      data = self._usb.retrieve_data(cmd, clength)
+      pos = s - address
+      with guard():
+        data = self._usb.retrieve_data(cmd, clength, out=buffer[pos:])
       if data is None:
         raise USBReadFailedException
-      buffer.extend(data)
 
-    return buffer
+    _dt = time.monotonic() - _t_start
+    if length >= self.MAX_GET_ARM_LENGTH:
+      logging.debug(f"downloaded {length} bytes in {_dt:.2f}s ({length / _dt / 1e3:.0f} kB/s)")
+
+    return buffer[:length]
 
 
   def setStream(self, state: bool):
@@ -51,22 +72,24 @@ class MobirAirUSBProtocol:
     self._usb.epo.write(cmd)
 
   ##### data from device #####
-  def getAllKData(self, width: int, height: int, number: int) -> bytes:
+  def getAllKData(self, width: int, height: int, number: int,
+                  guard: Callable[[], AbstractContextManager] = nullcontext) -> np.ndarray:
     img_size = 2 * width * height * number
-    return self.get_arm_param(300 * 0x800, img_size)
+    return self.get_arm_param(300 * 0x800, img_size, guard)
 
-  def getAllCurveData(self, number: int) -> bytes:
+  def getAllCurveData(self, number: int,
+                      guard: Callable[[], AbstractContextManager] = nullcontext) -> np.ndarray:
     size = number * 1700 * 2
-    return self.get_arm_param(462 * 0x800, size)
+    return self.get_arm_param(462 * 0x800, size, guard)
 
   def getJwbTabNum(self) -> int:
     return int.from_bytes(self.get_arm_param(488 * 0x800, 2), byteorder="little")
 
-  def getJwbTabArrShort(self, number: int) -> bytes:
+  def getJwbTabArrShort(self, number: int) -> np.ndarray:
     return self.get_arm_param(487 * 0x800, number * 2)
 
   def getDeviceSN(self) -> bytes:
-    return self.get_arm_param(489 * 0x800, 14)
+    return self.get_arm_param(489 * 0x800, 14).tobytes()
 
   def getModuleTP(self) -> int:
-    return self.get_arm_param(490 * 0x800, 1)[0]
+    return int(self.get_arm_param(490 * 0x800, 1)[0])
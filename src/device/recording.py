@@ -0,0 +1,407 @@
+from dataclasses import asdict
+from pathlib import Path
+from threading import Thread
+from typing import BinaryIO, Optional
+import io
+import json
+import logging
+import mmap
+import struct
+import time
+import zlib
+import numpy as np
+
+from .device_state import MobirAirState
+from .frame_queue import DropPolicy, FrameQueue
+from .image_processor import ThermalFrameProcessor
+from .types import CustomParamLine, FixedParamLine, Frame, RawFrame, raw_to_dataclass
+
+
+class RecordingFormat:
+  """Container format of radiometric recordings.
+
+  The file starts with `MAGIC` and `HEADER` (width, height, reference
+  rows, header size, frames per chunk), followed by records of `RECORD`
+  (type, length):
+
+  - CALIBRATION: zlib compressed `.npz` with the calibration data
+  - CHUNK: `CHUNK` (first frame, frame count, snapshot length) followed
+    by the zlib compressed state snapshot (json) and frame data
+
+  The frame data of a chunk consists of the timestamps, the per frame
+  parameters (`FRAME_PARAMS`), the shutter frame at chunk start, the
+  headers and the payloads. Payloads are delta encoded against the
+  previous frame of the chunk and byte shuffled before compression.
+
+  On close, an INDEX record (`INDEX_HEADER` with the number of chunks and
+  frames, chunk offsets, frame timestamps) and the `TRAILER` pointing to
+  it are appended. Recordings without index (e.g. after a crash) are
+  indexed by scanning the chunks.
+  """
+  MAGIC = b"MOBIRREC\x01"
+  HEADER = struct.Struct("<IIIII")
+  RECORD = struct.Struct("<BQ")
+  CHUNK = struct.Struct("<QII")
+  INDEX_HEADER = struct.Struct("<QQ")
+  TRAILER = struct.Struct("<Q8s")
+  TRAILER_MAGIC = b"MOBIREND"
+
+  CALIBRATION = 0
+  CHUNK_RECORD = 1
+  INDEX = 2
+
+  # measure params, that are not taken from the frame header
+  FRAME_PARAMS = ("lastShutterTfpa", "lastShutterTlens", "kj", "currChangeRTfpgIdx")
+  # state values snapshotted at chunk start
+  STATE_VALUES = ("kjLastShutterTlens", "lastAvgShutter", "y16_k0", "y16_k1", "tFpaDelta")
+
+
+class _Chunk:
+  def __init__(self, first: int, frames: int, header_size: int, payload_size: int) -> None:
+    self.first = first
+    self.count = 0
+    self.snapshot: Optional[dict] = None
+    self.shutterFrame: Optional[np.ndarray] = None
+    self.timestamps = np.empty(frames, dtype="<i8")
+    self.params = np.empty((frames, len(RecordingFormat.FRAME_PARAMS)), dtype="<f8")
+    self.headers = np.empty((frames, header_size), dtype="u1")
+    self.payloads = np.empty((frames, payload_size // 2), dtype="<u2")
+
+
+class RadiometricWriter:
+  """Records the raw frames together with everything needed to compute
+  their temperatures later on (see `RadiometricReader`).
+
+  `write` only copies the frame into the current chunk. Full chunks are
+  compressed and written by a background thread. If it can't keep up,
+  whole chunks are dropped instead of blocking the caller.
+  """
+
+  def __init__(self, path: Path | str, state: MobirAirState, chunk_frames: int = 64,
+               level: int = 6, header_size: int = 240) -> None:
+    self._state = state
+    self.chunk_frames = chunk_frames
+    self.level = level
+    self.header_size = header_size
+    self.payload_size = state.width * state.height * 2
+
+    self._file: BinaryIO = open(path, "wb")
+    self._file.write(RecordingFormat.MAGIC)
+    self._file.write(RecordingFormat.HEADER.pack(
+      state.width, state.height, state.refHeight, header_size, chunk_frames))
+
+    self._frames = 0
+    self._chunk: Optional[_Chunk] = None
+    self._calibration_written = False
+
+    self._chunk_offsets: list[int] = []
+    self._timestamps: list[np.ndarray] = []
+    self.dropped = 0
+
+    self._queue: FrameQueue[Optional[_Chunk]] = FrameQueue(4, DropPolicy.DROP_NEWEST)
+    self._thread = Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def write(self, frame: RawFrame, timestamp_ns: Optional[int] = None):
+    """Add frame to the recording. Needs to be called before the frame
+    is processed, as it snapshots the state the frame is processed with.
+    """
+    if len(frame.payload) != self.payload_size or len(frame.header) != self.header_size:
+      logging.warn("recording: skipping frame with unexpected size")
+      return
+
+    chunk = self._chunk
+    if chunk is None:
+      chunk = self._chunk = _Chunk(self._frames, self.chunk_frames, self.header_size, self.payload_size)
+      chunk.snapshot = self._snapshot()
+      chunk.shutterFrame = self._state.shutterFrame
+
+    i = chunk.count
+    param = self._state.measureParam
+    chunk.timestamps[i] = time.monotonic_ns() if timestamp_ns is None else timestamp_ns
+    chunk.params[i] = [getattr(param, name) for name in RecordingFormat.FRAME_PARAMS]
+    chunk.headers[i] = np.frombuffer(frame.header, dtype="u1")
+    chunk.payloads[i] = np.frombuffer(frame.payload, dtype="<u2")
+    chunk.count += 1
+    self._frames += 1
+
+    if chunk.count == self.chunk_frames:
+      self._flush()
+
+  def _snapshot(self) -> dict:
+    return dict(
+      measureParam=asdict(self._state.measureParam),
+      **{name: float(getattr(self._state, name)) for name in RecordingFormat.STATE_VALUES},
+    )
+
+  def _flush(self):
+    chunk, self._chunk = self._chunk, None
+    if chunk is None or chunk.count == 0:
+      return
+
+    if not self._queue.put(chunk):
+      # frame numbers continue with the next chunk written
+      self._frames -= chunk.count
+      self.dropped += chunk.count
+      logging.warn(f"recording: writer can't keep up, dropped {self.dropped} frames so far")
+
+  def close(self):
+    """Write pending chunks and the index and close the file
+    """
+    self._flush()
+    self._queue.policy = DropPolicy.BLOCK
+    self._queue.put(None)
+    self._thread.join()
+
+    timestamps = np.concatenate(self._timestamps) if self._timestamps else np.empty(0, dtype="<i8")
+    offset = self._write_record(
+      RecordingFormat.INDEX,
+      RecordingFormat.INDEX_HEADER.pack(len(self._chunk_offsets), len(timestamps)),
+      np.array(self._chunk_offsets, dtype="<u8").tobytes(), timestamps.tobytes())
+    self._file.write(RecordingFormat.TRAILER.pack(offset, RecordingFormat.TRAILER_MAGIC))
+    self._file.close()
+
+  ###### background thread ######
+  def _run(self):
+    while True:
+      chunk = self._queue.get()
+      if chunk is None:
+        return
+
+      if not self._calibration_written:
+        self._write_calibration()
+        self._calibration_written = True
+
+      self._write_chunk(chunk)
+
+  def _write_record(self, type: int, *parts: bytes) -> int:
+    offset = self._file.tell()
+    self._file.write(RecordingFormat.RECORD.pack(type, sum(len(p) for p in parts)))
+    for part in parts:
+      self._file.write(part)
+    return offset
+
+  def _write_calibration(self):
+    state = self._state
+    buffer = io.BytesIO()
+    np.savez(
+      buffer,
+      module_tp=np.array(-1 if state.module_tp is None else state.module_tp),
+      jwbTabArrShort=state.jwbTabArrShort,
+      allKdata=state.allKdata,
+      allCurveData=state.allCurveData,
+    )
+    self._write_record(RecordingFormat.CALIBRATION, zlib.compress(buffer.getvalue(), self.level))
+
+  def _write_chunk(self, chunk: _Chunk):
+    n = chunk.count
+    payloads = chunk.payloads[:n]
+    deltas = payloads.copy()
+    np.subtract(payloads[1:], payloads[:-1], out=deltas[1:])
+    shuffled = deltas.view("u1").reshape(-1, 2).T
+
+    data = zlib.compress(b"".join([
+      chunk.timestamps[:n].tobytes(),
+      chunk.params[:n].tobytes(),
+      np.ascontiguousarray(chunk.shutterFrame, dtype="<u2").tobytes(),
+      chunk.headers[:n].tobytes(),
+      shuffled.tobytes(),
+    ]), self.level)
+    snapshot = zlib.compress(json.dumps(chunk.snapshot).encode())
+
+    offset = self._write_record(
+      RecordingFormat.CHUNK_RECORD,
+      RecordingFormat.CHUNK.pack(chunk.first, n, len(snapshot)), snapshot, data)
+    self._file.flush()
+
+    self._chunk_offsets.append(offset)
+    self._timestamps.append(chunk.timestamps[:n].copy())
+
+
+class RadiometricReader:
+  """Memory-maps a radiometric recording for random access.
+
+  Frames are addressed by number (`frame`, `temperature`) or found by
+  time (`find`). Seeking costs decoding a single chunk.
+  """
+
+  def __init__(self, path: Path | str) -> None:
+    with open(path, "rb") as f:
+      self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic = RecordingFormat.MAGIC
+    if self._mmap[:len(magic)] != magic:
+      raise ValueError(f"{path} is not a radiometric recording")
+    self.width, self.height, self.refHeight, self.header_size, self.chunk_frames = \
+      RecordingFormat.HEADER.unpack_from(self._mmap, len(magic))
+    self._data_start = len(magic) + RecordingFormat.HEADER.size
+
+    self._calibration: Optional[dict[str, np.ndarray]] = None
+    self._cached: Optional[tuple[int, dict]] = None
+    self._state: Optional[MobirAirState] = None
+    self._proc: Optional[ThermalFrameProcessor] = None
+
+    if not self._read_index():
+      logging.info(f"recording: {path} has no index, scanning it")
+      self._scan()
+
+  def _records(self, pos: int):
+    while pos + RecordingFormat.RECORD.size <= len(self._mmap):
+      type, length = RecordingFormat.RECORD.unpack_from(self._mmap, pos)
+      start = pos + RecordingFormat.RECORD.size
+      if start + length > len(self._mmap):
+        logging.warn("recording: file is truncated")
+        return
+      yield pos, type, start, length
+      pos = start + length
+
+  def _read_index(self) -> bool:
+    size = RecordingFormat.TRAILER.size
+    if len(self._mmap) < self._data_start + size:
+      return False
+    offset, magic = RecordingFormat.TRAILER.unpack_from(self._mmap, len(self._mmap) - size)
+    if magic != RecordingFormat.TRAILER_MAGIC:
+      return False
+
+    type, _ = RecordingFormat.RECORD.unpack_from(self._mmap, offset)
+    if type != RecordingFormat.INDEX:
+      return False
+
+    pos = offset + RecordingFormat.RECORD.size
+    chunks, frames = RecordingFormat.INDEX_HEADER.unpack_from(self._mmap, pos)
+    pos += RecordingFormat.INDEX_HEADER.size
+    self._offsets = np.frombuffer(self._mmap, dtype="<u8", count=chunks, offset=pos)
+    self.timestamps = np.frombuffer(self._mmap, dtype="<i8", count=frames, offset=pos + chunks * 8)
+    return True
+
+  def _scan(self):
+    offsets, timestamps = [], []
+    for pos, type, start, _ in self._records(self._data_start):
+      if type != RecordingFormat.CHUNK_RECORD:
+        continue
+      offsets.append(pos)
+      timestamps.append(self._decode_chunk(pos)["timestamps"])
+
+    self._offsets = np.array(offsets, dtype="<u8")
+    self.timestamps = np.concatenate(timestamps) if timestamps else np.empty(0, dtype="<i8")
+
+  def __len__(self) -> int:
+    return len(self.timestamps)
+
+  def find(self, timestamp_ns: int) -> int:
+    """Number of the last frame recorded at or before `timestamp_ns`
+    """
+    return max(int(np.searchsorted(self.timestamps, timestamp_ns, side="right")) - 1, 0)
+
+  @property
+  def calibration(self) -> dict[str, np.ndarray]:
+    if self._calibration is None:
+      for _, type, start, length in self._records(self._data_start):
+        if type == RecordingFormat.CALIBRATION:
+          data = zlib.decompress(self._mmap[start:start + length])
+          self._calibration = dict(np.load(io.BytesIO(data)))
+          break
+      else:
+        raise ValueError("recording has no calibration data")
+    return self._calibration
+
+  def make_state(self) -> MobirAirState:
+    """State with the recorded calibration data
+    """
+    calib = self.calibration
+    state = MobirAirState(self.width, self.height, self.refHeight)
+    state.module_tp = None if int(calib["module_tp"]) < 0 else int(calib["module_tp"])
+    state.jwbTabArrShort = calib["jwbTabArrShort"]
+    state.jwbTabNumber = len(state.jwbTabArrShort)
+    state.allKdata = calib["allKdata"]
+    state.allCurveData = calib["allCurveData"]
+    return state
+
+  def _decode_chunk(self, offset: int) -> dict:
+    if self._cached is not None and self._cached[0] == offset:
+      return self._cached[1]
+
+    _, length = RecordingFormat.RECORD.unpack_from(self._mmap, offset)
+    pos = offset + RecordingFormat.RECORD.size
+    first, n, snapshot_len = RecordingFormat.CHUNK.unpack_from(self._mmap, pos)
+    pos += RecordingFormat.CHUNK.size
+    snapshot = json.loads(zlib.decompress(self._mmap[pos:pos + snapshot_len]))
+    pos += snapshot_len
+    data = memoryview(zlib.decompress(self._mmap[pos:offset + RecordingFormat.RECORD.size + length]))
+
+    def take(dtype: str, count: int) -> np.ndarray:
+      nonlocal data
+      nbytes = np.dtype(dtype).itemsize * count
+      array = np.frombuffer(data, dtype=dtype, count=count)
+      data = data[nbytes:]
+      return array
+
+    pixels = self.width * self.height
+    timestamps = take("<i8", n)
+    params = take("<f8", n * len(RecordingFormat.FRAME_PARAMS)).reshape((n, -1))
+    shutter = take("<u2", pixels - self.refHeight * self.width) \
+      .reshape((self.height - self.refHeight, self.width))
+    headers = take("u1", n * self.header_size).reshape((n, self.header_size))
+    deltas = np.frombuffer(data, dtype="u1").reshape((2, -1)).T.copy().view("<u2").reshape((n, pixels))
+    payloads = np.cumsum(deltas, axis=0, dtype="<u2")
+
+    chunk = dict(
+      first=first, snapshot=snapshot, timestamps=timestamps, params=params,
+      shutterFrame=shutter, headers=headers, payloads=payloads,
+    )
+    self._cached = (offset, chunk)
+    return chunk
+
+  def _chunk_of(self, index: int) -> tuple[dict, int]:
+    if not 0 <= index < len(self):
+      raise IndexError(f"frame {index} out of range")
+    # all chunks but the last are full (the numbers in the chunks skip
+    # dropped chunks in older recordings)
+    c = index // self.chunk_frames
+    return self._decode_chunk(int(self._offsets[c])), index - c * self.chunk_frames
+
+  def frame(self, index: int) -> RawFrame:
+    chunk, i = self._chunk_of(index)
+    return self._raw_frame(chunk, i, index)
+
+  def _raw_frame(self, chunk: dict, i: int, index: int) -> RawFrame:
+    header = chunk["headers"][i].tobytes()
+    return RawFrame(
+      header=header,
+      payload=chunk["payloads"][i].tobytes(),
+      fixedParam=raw_to_dataclass(FixedParamLine, header),
+      customParam=raw_to_dataclass(CustomParamLine, header),
+      timestamp=int(self.timestamps[index]),
+      sequence=index,
+    )
+
+  def temperature(self, index: int) -> Frame:
+    """Process frame `index` into a temperature image, with the state it
+    has been recorded with.
+    """
+    if self._state is None:
+      self._state = self.make_state()
+      self._proc = ThermalFrameProcessor(self._state)
+    state = self._state
+    chunk, i = self._chunk_of(index)
+
+    snapshot = chunk["snapshot"]
+    for name, value in snapshot["measureParam"].items():
+      setattr(state.measureParam, name, value)
+    for name in RecordingFormat.STATE_VALUES:
+      setattr(state, name, snapshot[name])
+    state.shutterFrame = chunk["shutterFrame"]
+
+    # replay the parameter and shutter updates of the previous frames
+    for k in range(i):
+      frame = self._raw_frame(chunk, k, index - i + k)
+      if frame.fixedParam.isShuttering:
+        state.shutterFrame = chunk["payloads"][k] \
+          .reshape((state.height, state.width))[state.refHeight:, :]
+      state.measureParam.setFromFrame(frame, state.module_tp)
+
+    for name, value in zip(RecordingFormat.FRAME_PARAMS, chunk["params"][i]):
+      setattr(state.measureParam, name, type(getattr(state.measureParam, name))(value))
+
+    # computed now, the state is replayed again for the next frame
+    return self._proc.process(self._raw_frame(chunk, i, index)).compute()
@@ -0,0 +1,153 @@
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Callable, Sequence, Union
+import numpy as np
+
+
+@dataclass(frozen=True)
+class Rect:
+  x: int
+  y: int
+  width: int
+  height: int
+
+  def mask(self, shape: tuple[int, int]) -> np.ndarray:
+    mask = np.zeros(shape, dtype=bool)
+    mask[max(0, self.y):self.y + self.height, max(0, self.x):self.x + self.width] = True
+    return mask
+
+
+@dataclass(frozen=True)
+class Polygon:
+  """Polygon with (x, y) vertices, containing the pixels whose centers
+  are inside (even-odd rule)
+  """
+  points: Sequence[tuple[float, float]]
+
+  def mask(self, shape: tuple[int, int]) -> np.ndarray:
+    y, x = np.mgrid[0:shape[0], 0:shape[1]] + 0.5
+    inside = np.zeros(shape, dtype=bool)
+
+    points = list(self.points)
+    for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]):
+      if y0 == y1:
+        continue
+      crosses = (y0 <= y) != (y1 <= y)
+      xs = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+      inside ^= crosses & (x < xs)
+
+    return inside
+
+
+@dataclass(frozen=True)
+class Mask:
+  values: np.ndarray
+
+  def mask(self, shape: tuple[int, int]) -> np.ndarray:
+    if self.values.shape != shape:
+      raise ValueError(f"mask has shape {self.values.shape}, expected {shape}")
+    return self.values.astype(bool)
+
+
+Region = Union[Rect, Polygon, Mask]
+
+
+@dataclass
+class RegionStats:
+  """Statistics of a region, temperatures in Kelvin * 100 like the
+  frame image and spots as (x, y)
+  """
+  pixels: int
+  min: float
+  max: float
+  mean: float
+  hotspot: tuple[int, int]
+  coldspot: tuple[int, int]
+
+
+@dataclass
+class _Layout:
+  names: list[str] = field(default_factory=list)
+  # flat pixel indices of all regions, concatenated
+  indices: np.ndarray = field(default_factory=lambda: np.empty(0, dtype="i8"))
+  # start of every region in `indices`
+  starts: np.ndarray = field(default_factory=lambda: np.empty(0, dtype="i8"))
+
+
+class RegionStatsEngine:
+  """Per region statistics (min, max, mean, hot and cold spot) of Y16
+  images.
+
+  Regions are rasterized into flat index arrays once, when they are
+  added. A frame costs a single gather of the pixels of all regions, one
+  conversion of these pixels to temperatures (a table lookup with the
+  temperature LUT) and a few reductions per region. The conversion isn't
+  linear, so the mean is taken over the temperatures, not the Y16 values.
+  """
+
+  def __init__(self, shape: tuple[int, int]) -> None:
+    self.shape = shape
+    self._regions: dict[str, np.ndarray] = {}
+    self._lock = Lock()
+    # replaced as a whole, so `compute` never sees a partial update
+    self._layout = _Layout()
+
+  def __len__(self) -> int:
+    return len(self._layout.names)
+
+  @property
+  def names(self) -> list[str]:
+    return list(self._layout.names)
+
+  def add(self, name: str, region: Region):
+    indices = np.flatnonzero(region.mask(self.shape))
+    if len(indices) == 0:
+      raise ValueError(f"region {name} contains no pixels")
+
+    with self._lock:
+      self._regions[name] = indices
+      self._rebuild()
+
+  def remove(self, name: str):
+    with self._lock:
+      self._regions.pop(name, None)
+      self._rebuild()
+
+  def _rebuild(self):
+    names = list(self._regions)
+    arrays = [self._regions[n] for n in names]
+    self._layout = _Layout(
+      names,
+      np.concatenate(arrays) if arrays else np.empty(0, dtype="i8"),
+      np.cumsum([0] + [len(a) for a in arrays[:-1]], dtype="i8"),
+    )
+
+  def compute(self, y16: np.ndarray, to_kelvin: Callable[[np.ndarray], np.ndarray]) -> dict[str, RegionStats]:
+    """Statistics of all regions of `y16`, `to_kelvin` converts Y16
+    values into temperatures (Kelvin * 100)
+    """
+    layout = self._layout
+    if not layout.names:
+      return {}
+
+    temps = to_kelvin(np.take(y16, layout.indices)).astype("f8")
+    ends = np.append(layout.starts[1:], len(temps))
+    mean = np.add.reduceat(temps, layout.starts) / (ends - layout.starts)
+
+    stats = {}
+    for i, name in enumerate(layout.names):
+      t = temps[layout.starts[i]:ends[i]]
+      hot, cold = t.argmax(), t.argmin()
+      stats[name] = RegionStats(
+        pixels=len(t),
+        min=t[cold],
+        max=t[hot],
+        mean=mean[i],
+        hotspot=self._spot(layout.indices[layout.starts[i] + hot]),
+        coldspot=self._spot(layout.indices[layout.starts[i] + cold]),
+      )
+    return stats
+
+  def _spot(self, index: int) -> tuple[int, int]:
+    width = self.shape[1]
+    return (int(index % width), int(index // width))
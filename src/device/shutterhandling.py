@@ -1,52 +1,175 @@
 import time
+from enum import Enum
+from queue import SimpleQueue
 from typing import Callable, Optional
 from device.device_state import MobirAirState
 from device.protocol import MobirAirUSBProtocol
-from threading import Thread, Lock
+from device.types import RawFrame
+from threading import Lock, Thread
 import logging
 
 
+class ShutterPhase(Enum):
+  IDLE = 0
+  PENDING = 1   # requested, starts with the next frame
+  CLOSING = 2   # shutter closed, waiting for it to settle
+  NUC = 3       # NUC running on the device
+  OPENING = 4   # shutter opened, waiting for the first regular frame
+
+
 class ShutterHandler:
+  """Shutter / NUC calibration as a state machine.
+
+  The machine is advanced by `on_frame` for every received frame, using
+  the time the frame has been received instead of sleeping. USB
+  commands are sent by a single worker thread, so the caller is never
+  blocked. `on_frame` returns whether the frame has been captured
+  during a calibration and therefore shouldn't be used as is.
+
+  Calibrations can be requested from any thread, the phase transitions
+  are guarded by a lock. A phase not left within `PHASE_TIMEOUT` (wall
+  clock, e.g. as the stream stopped) aborts the calibration.
+  """
+  CLOSE_DELAY = 0.4
+  NUC_DELAY = 2
+  OPEN_TIMEOUT = 1
+  PHASE_TIMEOUT = 5
+
   def __init__(self, protocol: MobirAirUSBProtocol, state: MobirAirState) -> None:
     self._protocol = protocol
     self._state: MobirAirState = state
 
     self.useNUC = True
-    self._previous_shutter = 0
-    self._thread_lock = Lock()
+    self.phase = ShutterPhase.IDLE
+    self._lock = Lock()
+    self._phase_since = 0.
+    # wall clock time the phase has been entered
+    self._phase_entered = 0.
+    self._previous_shutter = 0.
+    self._t_start = 0
 
     self._shutter_finish_callback: Optional[Callable[[bool],None]] = None
 
+    self._commands: SimpleQueue[Callable[[], None]] = SimpleQueue()
+    self._worker = Thread(target=self._run, daemon=True)
+    self._worker.start()
+
   def setShutterFinishCallback(self, callback: Callable[[bool], None]):
     self._shutter_finish_callback = callback
 
-  def doShutter(self):
-    with self._thread_lock:
-      logging.info("Doing calibration")
-      self._previous_shutter = time.time()
-      self._protocol.setShutter(True)
-      time.sleep(0.4)
+  def _run(self):
+    while True:
+      command = self._commands.get()
+      try:
+        command()
+      except Exception as e:
+        logging.error(f"shutter: command failed ({e})")
 
-      self._state.measureParam.lastShutterTfpa = self._state.measureParam.realtimeTfpa
-      self._state.measureParam.lastShutterTlens = self._state.measureParam.realtimeTlens
+  def _enter(self, phase: ShutterPhase, now: float):
+    self.phase = phase
+    self._phase_since = now
+    self._phase_entered = time.monotonic()
 
-      if (self.useNUC):
-        self._protocol.doNUC()
-        time.sleep(2)
+  def _abort(self):
+    if self.active:
+      self._commands.put(lambda: self._protocol.setShutter(False))
+    self.phase = ShutterPhase.IDLE
 
-      self._protocol.setShutter(False)
-      if self._shutter_finish_callback is not None:
-        self._shutter_finish_callback(self.useNUC)
+  def _expire(self):
+    if self.phase != ShutterPhase.IDLE and time.monotonic() - self._phase_entered > self.PHASE_TIMEOUT:
+      logging.warn(f"shutter: calibration stuck in {self.phase.name}, aborted")
+      self._abort()
+
+  def reset(self):
+    """Abort a running calibration (opening the shutter again), e.g.
+    when the stream is stopped or restarted
+    """
+    with self._lock:
+      self._abort()
+
+  @property
+  def calibrating(self) -> bool:
+    with self._lock:
+      self._expire()
+      return self.phase != ShutterPhase.IDLE
+
+  @property
+  def active(self) -> bool:
+    return self.phase not in (ShutterPhase.IDLE, ShutterPhase.PENDING)
+
+  def doShutter(self):
+    """Request a calibration, which starts with the next frame
+    """
+    with self._lock:
+      self._expire()
+      if self.phase == ShutterPhase.IDLE:
+        self._previous_shutter = time.monotonic()
+        self.phase = ShutterPhase.PENDING
+        self._phase_entered = self._previous_shutter
 
   @property
   def canDoShutter(self):
-    return (time.time() - self._previous_shutter) > 5
+    return self.phase == ShutterPhase.IDLE and (time.monotonic() - self._previous_shutter) > 5
 
   def manualShutter(self):
     if self.canDoShutter:
-      Thread(target=self.doShutter).start()
-
+      self.doShutter()
 
   def automaticShutter(self):
-    if (time.time() - self._previous_shutter) > 30:
-      Thread(target=self.doShutter).start()
+    if (time.monotonic() - self._previous_shutter) > 30:
+      self.doShutter()
+
+  def on_frame(self, frame: RawFrame, t_ns: Optional[int] = None) -> bool:
+    """Advance the calibration with a received frame. Returns True, if the
+    frame has been captured during the calibration.
+    """
+    now = time.monotonic() if t_ns is None else t_ns / 1e9
+    with self._lock:
+      self._expire()
+      calibrating, finished = self._advance(frame.fixedParam.isShuttering, now)
+
+    # outside of the lock, the callback might request another calibration
+    if finished:
+      if self._shutter_finish_callback is not None:
+        self._shutter_finish_callback(self.useNUC)
+      self._state.metrics.observe("shutter", self._t_start)
+    return calibrating
+
+  def _advance(self, shuttering: bool, now: float) -> tuple[bool, bool]:
+    """Phase transition for a frame, returns whether the frame has been
+    captured during the calibration and whether the calibration finished
+    """
+    elapsed = now - self._phase_since
+
+    if self.phase == ShutterPhase.IDLE:
+      return shuttering, False
+
+    if self.phase == ShutterPhase.PENDING:
+      logging.info("Doing calibration")
+      self._t_start = time.perf_counter_ns()
+      self._previous_shutter = time.monotonic()
+      self._commands.put(lambda: self._protocol.setShutter(True))
+      self._enter(ShutterPhase.CLOSING, now)
+
+    elif self.phase == ShutterPhase.CLOSING and elapsed >= self.CLOSE_DELAY:
+      self._state.measureParam.lastShutterTfpa = self._state.measureParam.realtimeTfpa
+      self._state.measureParam.lastShutterTlens = self._state.measureParam.realtimeTlens
+
+      if self.useNUC:
+        self._commands.put(self._protocol.doNUC)
+        self._enter(ShutterPhase.NUC, now)
+      else:
+        self._open(now)
+
+    elif self.phase == ShutterPhase.NUC and elapsed >= self.NUC_DELAY:
+      self._open(now)
+
+    elif self.phase == ShutterPhase.OPENING and (not shuttering or elapsed >= self.OPEN_TIMEOUT):
+      self._enter(ShutterPhase.IDLE, now)
+      return shuttering, True
+
+    return True, False
+
+  def _open(self, now: float):
+    self._commands.put(lambda: self._protocol.setShutter(False))
+    self._enter(ShutterPhase.OPENING, now)
@@ -0,0 +1,403 @@
+from dataclasses import dataclass
+from enum import Enum
+from queue import Empty, Full, Queue
+from socketserver import BaseRequestHandler, ThreadingTCPServer
+from threading import Lock, Thread
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+import base64
+import hashlib
+import logging
+import select
+import socket
+import struct
+import time
+import zlib
+import numpy as np
+
+from .types import CustomParamLine, FixedParamLine, Frame, raw_to_dataclass
+
+
+class StreamFormat(str, Enum):
+  # sensor values (before NUC)
+  RAW = "raw"
+  # NUC corrected values
+  Y16 = "y16"
+  # temperatures (Kelvin * 100)
+  KELVIN = "kelvin"
+
+
+class StreamProtocol:
+  """Binary framing of the stream.
+
+  Raw TCP clients start with `HELLO` (magic and flags), WebSocket
+  clients with the usual upgrade request (`?delta=1` for the delta
+  flag). Every frame is then sent as one message (one binary WebSocket
+  message): `MESSAGE` (magic, format, flags, header length, sequence,
+  timestamp, width, height, payload length), the raw frame header and
+  the payload.
+
+  The payload is the little endian uint16 image or, with `DELTA` set,
+  the zlib compressed difference (modulo 2^16) to the previous frame
+  (sequence - 1). Clients asking for delta compression get a full frame
+  whenever they have missed the previous one.
+  """
+  MAGIC = b"MIR1"
+  HELLO = struct.Struct("<4sB3x")
+  MESSAGE = struct.Struct("<4sBBHQqHHI")
+
+  # flags
+  DELTA = 1
+
+  FORMATS = list(StreamFormat)
+
+  @staticmethod
+  def websocket_accept(key: str) -> str:
+    digest = hashlib.sha1((key + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11").encode()).digest()
+    return base64.b64encode(digest).decode()
+
+  # websocket opcodes
+  WS_BINARY = 0x2
+  WS_CLOSE = 0x8
+  WS_PING = 0x9
+  WS_PONG = 0xa
+
+  @staticmethod
+  def websocket_header(length: int, opcode: int = WS_BINARY) -> bytes:
+    """Header of an unmasked message (server to client)
+    """
+    if length < 126:
+      return struct.pack("!BB", 0x80 | opcode, length)
+    if length < 2**16:
+      return struct.pack("!BBH", 0x80 | opcode, 126, length)
+    return struct.pack("!BBQ", 0x80 | opcode, 127, length)
+
+  @staticmethod
+  def websocket_read(sock: socket.socket) -> tuple[int, bytes]:
+    """Read a masked message (client to server), returns opcode and payload
+    """
+    def recv(length: int) -> bytes:
+      data = sock.recv(length, socket.MSG_WAITALL)
+      if len(data) != length:
+        raise ConnectionError("stream: connection closed")
+      return data
+
+    b0, b1 = recv(2)
+    length = b1 & 0x7f
+    if length == 126:
+      length, = struct.unpack("!H", recv(2))
+    elif length == 127:
+      length, = struct.unpack("!Q", recv(8))
+    if length > 2**16:
+      raise ValueError(f"message of {length} bytes")
+
+    mask = recv(4) if b1 & 0x80 else bytes(4)
+    payload = np.frombuffer(recv(length), dtype="u1") ^ np.resize(np.frombuffer(mask, dtype="u1"), length)
+    return b0 & 0x0f, payload.tobytes()
+
+
+class _Message:
+  """A published frame, shared by all clients. The delta payload is
+  computed by the first client needing it.
+  """
+
+  def __init__(self, sequence: int, timestamp: int, format: StreamFormat, header: bytes,
+               image: np.ndarray, previous: Optional[np.ndarray]) -> None:
+    self.sequence = sequence
+    self.timestamp = timestamp
+    self.format = format
+    self.header = header
+    self.image = image
+    self._previous = previous
+    self._delta: Optional[bytes] = None
+    self._lock = Lock()
+    # the previous frame is released, once the delta is computed
+    self.has_delta = previous is not None
+
+  def delta(self) -> bytes:
+    with self._lock:
+      if self._delta is None:
+        diff = np.subtract(self.image, self._previous, dtype="<u2")
+        self._delta = zlib.compress(diff, 1)
+        self._previous = None
+      return self._delta
+
+  def buffers(self, delta: bool) -> list:
+    """Message as list of buffers (no copies of header and image)
+    """
+    payload = self.delta() if delta else memoryview(self.image).cast("B")
+    height, width = self.image.shape
+    prefix = StreamProtocol.MESSAGE.pack(
+      StreamProtocol.MAGIC, StreamProtocol.FORMATS.index(self.format),
+      StreamProtocol.DELTA if delta else 0, len(self.header),
+      self.sequence, self.timestamp, width, height, len(payload))
+    return [prefix, self.header, payload]
+
+
+def sendmsg_all(sock: socket.socket, buffers: list):
+  """Scatter-gather send of all buffers, continuing after partial sends
+  """
+  views = [memoryview(b).cast("B") for b in buffers]
+  while views:
+    sent = sock.sendmsg(views)
+    while views and sent >= len(views[0]):
+      sent -= len(views[0])
+      views.pop(0)
+    if views and sent:
+      views[0] = views[0][sent:]
+
+
+class _TCPServer(ThreadingTCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+
+
+class _Client:
+  def __init__(self, address, queue_size: int, delta: bool, websocket: bool) -> None:
+    self.address = address
+    self.delta = delta
+    self.websocket = websocket
+    self.queue: Queue[_Message] = Queue(queue_size)
+    self.closed = False
+    self.last_sequence = -1
+
+
+class StreamServer:
+  """Serves the frames to clients on the local network, over raw TCP or
+  WebSocket (see `StreamProtocol`, `StreamClient` reads it). Messages of
+  WebSocket clients are read in between the frames, pings are answered
+  and a close ends the connection; anything else is ignored.
+
+  `publish` copies the image once per frame, clients are sent that
+  buffer and the header with scatter-gather I/O. Every client has a
+  queue of `queue_size` frames, a client that lets it overflow (or
+  doesn't take a frame within `send_timeout`) is disconnected, so slow
+  clients never hold back the driver.
+  """
+
+  def __init__(self, port: int, host: str = "127.0.0.1", format: StreamFormat = StreamFormat.KELVIN,
+               queue_size: int = 4, send_timeout: float = 1) -> None:
+    self.format = format
+    self.queue_size = queue_size
+    self.send_timeout = send_timeout
+    self.dropped_clients = 0
+
+    # replaced as a whole, `publish` iterates without a lock
+    self._clients: list[_Client] = []
+    self._lock = Lock()
+    self._sequence = 0
+    self._previous: Optional[np.ndarray] = None
+
+    server = self
+
+    class Handler(BaseRequestHandler):
+      def handle(self):
+        server._serve(self.request, self.client_address)
+
+    self._server = _TCPServer((host, port), Handler)
+    self._thread = Thread(target=self._server.serve_forever, daemon=True)
+    self._thread.start()
+    logging.info(f"stream: serving {format.value} frames on {host}:{self.port}")
+
+  @property
+  def port(self) -> int:
+    return self._server.server_address[1]
+
+  @property
+  def clients(self) -> int:
+    return len(self._clients)
+
+  def _image(self, frame: Frame) -> np.ndarray:
+    if self.format == StreamFormat.RAW:
+      return frame.rawY16
+    if self.format == StreamFormat.Y16:
+      return frame.y16
+    return frame.image
+
+  def publish(self, frame: Frame, timestamp_ns: Optional[int] = None):
+    self._sequence += 1
+    if not self._clients:
+      self._previous = None
+      return
+
+    # the only copy, the frame buffers are reused
+    image = np.array(self._image(frame), dtype="<u2", order="C")
+    message = _Message(
+      self._sequence, time.monotonic_ns() if timestamp_ns is None else timestamp_ns,
+      self.format, bytes(frame.header), image, self._previous)
+    self._previous = image
+
+    for client in self._clients:
+      try:
+        client.queue.put_nowait(message)
+      except Full:
+        logging.warn(f"stream: client {client.address} too slow, disconnecting")
+        self._drop(client)
+
+  def _drop(self, client: _Client):
+    with self._lock:
+      if client.closed:
+        return
+      client.closed = True
+      self._clients = [c for c in self._clients if c is not client]
+      self.dropped_clients += 1
+
+  def _handshake(self, sock: socket.socket, address) -> Optional[_Client]:
+    sock.settimeout(2)
+    start = sock.recv(4, socket.MSG_WAITALL)
+
+    if start == StreamProtocol.MAGIC:
+      rest = sock.recv(StreamProtocol.HELLO.size - 4, socket.MSG_WAITALL)
+      _, flags = StreamProtocol.HELLO.unpack(start + rest)
+      return _Client(address, self.queue_size, bool(flags & StreamProtocol.DELTA), websocket=False)
+
+    if start != b"GET ":
+      return None
+
+    request = start
+    while b"\r\n\r\n" not in request:
+      data = sock.recv(1024)
+      if not data or len(request) > 8192:
+        return None
+      request += data
+
+    lines = request.split(b"\r\n\r\n")[0].decode("latin-1").split("\r\n")
+    path = lines[0].split(" ")[1]
+    headers = {k.strip().lower(): v.strip() for k, _, v in (l.partition(":") for l in lines[1:])}
+    if "sec-websocket-key" not in headers:
+      return None
+
+    sock.sendall((
+      "HTTP/1.1 101 Switching Protocols\r\n"
+      "Upgrade: websocket\r\n"
+      "Connection: Upgrade\r\n"
+      f"Sec-WebSocket-Accept: {StreamProtocol.websocket_accept(headers['sec-websocket-key'])}\r\n\r\n"
+    ).encode())
+    delta = parse_qs(urlsplit(path).query).get("delta", ["0"])[0] == "1"
+    return _Client(address, self.queue_size, delta, websocket=True)
+
+  def _serve(self, sock: socket.socket, address):
+    try:
+      client = self._handshake(sock, address)
+    except (OSError, ValueError, struct.error) as e:
+      logging.debug(f"stream: handshake with {address} failed ({e})")
+      return
+    if client is None:
+      logging.debug(f"stream: {address} is no stream client")
+      return
+
+    logging.info(f"stream: client {address} connected")
+    sock.settimeout(self.send_timeout)
+    with self._lock:
+      self._clients = self._clients + [client]
+
+    try:
+      while not client.closed:
+        if client.websocket and not self._websocket_receive(sock, client):
+          logging.info(f"stream: client {address} closed the connection")
+          break
+
+        try:
+          message = client.queue.get(timeout=0.5)
+        except Empty:
+          continue
+
+        delta = client.delta and message.has_delta and client.last_sequence == message.sequence - 1
+        buffers = message.buffers(delta)
+        if client.websocket:
+          buffers.insert(0, StreamProtocol.websocket_header(sum(len(memoryview(b).cast("B")) for b in buffers)))
+        sendmsg_all(sock, buffers)
+        client.last_sequence = message.sequence
+    except socket.timeout:
+      logging.warn(f"stream: client {address} too slow, disconnecting")
+      self._drop(client)
+    except (OSError, ValueError) as e:
+      logging.info(f"stream: client {address} disconnected ({e})")
+    finally:
+      with self._lock:
+        client.closed = True
+        self._clients = [c for c in self._clients if c is not client]
+
+  def _websocket_receive(self, sock: socket.socket, client: _Client) -> bool:
+    """Handle the messages the client has sent, returns False once it
+    closed the connection
+    """
+    while select.select([sock], [], [], 0)[0]:
+      opcode, payload = StreamProtocol.websocket_read(sock)
+      if opcode == StreamProtocol.WS_PING:
+        sendmsg_all(sock, [StreamProtocol.websocket_header(len(payload), StreamProtocol.WS_PONG), payload])
+      elif opcode == StreamProtocol.WS_CLOSE:
+        # echo the status code
+        sendmsg_all(sock, [StreamProtocol.websocket_header(len(payload[:2]), StreamProtocol.WS_CLOSE), payload[:2]])
+        return False
+    return True
+
+  def close(self):
+    for client in self._clients:
+      client.closed = True
+    self._server.shutdown()
+    self._server.server_close()
+
+
+@dataclass
+class StreamFrame:
+  """Frame received from a `StreamServer`
+  """
+  sequence: int
+  timestamp_ns: int
+  format: StreamFormat
+  header: bytes
+  image: np.ndarray
+
+  @property
+  def fixedParam(self) -> FixedParamLine:
+    return raw_to_dataclass(FixedParamLine, self.header)
+
+  @property
+  def customParam(self) -> CustomParamLine:
+    return raw_to_dataclass(CustomParamLine, self.header)
+
+
+class StreamClient:
+  """Raw TCP client of a `StreamServer`, decoding delta compressed
+  frames. Frames missed in between show as gaps of the sequence.
+  """
+
+  def __init__(self, host: str, port: int, delta: bool = False, timeout: Optional[float] = 5) -> None:
+    self._sock = socket.create_connection((host, port), timeout=timeout)
+    self._sock.sendall(StreamProtocol.HELLO.pack(StreamProtocol.MAGIC, StreamProtocol.DELTA if delta else 0))
+    self._previous: Optional[StreamFrame] = None
+    # frames received as delta
+    self.deltas = 0
+
+  def _recv(self, length: int) -> bytes:
+    data = self._sock.recv(length, socket.MSG_WAITALL)
+    if len(data) != length:
+      raise ConnectionError("stream: connection closed")
+    return data
+
+  def get(self) -> StreamFrame:
+    magic, format, flags, header_length, sequence, timestamp, width, height, length = \
+      StreamProtocol.MESSAGE.unpack(self._recv(StreamProtocol.MESSAGE.size))
+    if magic != StreamProtocol.MAGIC:
+      raise ValueError("stream: invalid message")
+
+    header = self._recv(header_length)
+    payload = self._recv(length)
+
+    if flags & StreamProtocol.DELTA:
+      previous = self._previous
+      if previous is None or previous.sequence != sequence - 1:
+        raise ValueError("stream: delta to a frame not received")
+      diff = np.frombuffer(zlib.decompress(payload), dtype="<u2").reshape((height, width))
+      image = np.add(previous.image, diff, dtype="<u2")
+      self.deltas += 1
+    else:
+      image = np.frombuffer(payload, dtype="<u2").reshape((height, width))
+
+    frame = StreamFrame(sequence, timestamp, StreamProtocol.FORMATS[format], header, image)
+    self._previous = frame
+    return frame
+
+  def close(self):
+    self._sock.close()
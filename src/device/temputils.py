@@ -1,6 +1,21 @@
+from enum import Enum
+from functools import lru_cache
+from typing import Optional
 import numpy as np
 
+
+class Precision(str, Enum):
+  """Arithmetic used for the temperature conversion
+  """
+  FLOAT64 = "float64"  # reference
+  FLOAT32 = "float32"
+  FIXED = "fixed"      # integers, with Q16 fixed point coefficients
+
+
 class MobirAirTempUtils:
+  # fractional bits of the fixed point coefficients
+  Q = 16
+
   def __init__(self, state: "MobirAirState") -> None:
     self._state = state
 
@@ -8,6 +23,7 @@ class MobirAirTempUtils:
     return self._state.currCurve[int(shutterTemp * 10)]
 
   @staticmethod
+  @lru_cache(maxsize=1024)
   def getFpaTemp(fpaTemp: int, module_tp: int) -> float:
     """ realtimeTfpa from the camera itself isn't the value
     that is further used, but instead a transformed value of it.
@@ -24,6 +40,7 @@ class MobirAirTempUtils:
     return int(v_) / 100
 
   @staticmethod
+  @lru_cache(maxsize=1024)
   def getParamTemp(temp: int) -> float:
     t0 = 127.361304901973
     t1 = -0.018218076216914 * temp
@@ -32,12 +49,27 @@ class MobirAirTempUtils:
     poly = t3 + t2 + t1 + t0
     return int(poly * 100) / 100
 
+  @property
+  def precision(self) -> Precision:
+    return self._state.config.precision
+
+  def y16toKelvin(self, y16: np.ndarray) -> np.ndarray:
+    """Convert y16 raw data frame into temperatures (Kelvin * 100)
+    """
+    if self.precision == Precision.FIXED:
+      return (self._y16toCentiCelsiusFixed(y16) + 27315).astype("u2")
+    return ((self.y16toTemp(y16) + 273.15) * 100).astype("u2")
+
   def y16toTemp(self, y16: np.ndarray):
     """Convert y16 raw data frame into temperatures (°C)
     """
+    if self.precision == Precision.FIXED:
+      return self._y16toCentiCelsiusFixed(y16) / 100
+
+    dtype = np.float32 if self.precision == Precision.FLOAT32 else np.float64
     param = self._state.measureParam
 
-    rawTemp = y16 - np.average(self._state.shutterFrame)
+    rawTemp = y16.astype(dtype) - dtype(self._state.shutterMean)
 
     _temp = rawTemp - int((
       (param.kj / 100) * (param.realtimeTlens - param.lastShutterTlens)
@@ -46,6 +78,38 @@ class MobirAirTempUtils:
     _tcurr = self.calcSingleCurveTempArr(self._state.currCurve, _temp)
     _tnear = self.calcSingleCurveTempArr(self._state.nearCurve, _temp)
 
+    _w1, _w2 = self._curveWeights()
+    return _tcurr * dtype(_w1) + _tnear * dtype(_w2)
+
+  def conversionKey(self) -> tuple:
+    """The scalar inputs of `y16toTemp`, reduced the way the conversion
+    uses them (truncated lens offset, shutter curve index, ...). Equal
+    keys give equal temperatures for the same shutter frame and curves.
+    """
+    param = self._state.measureParam
+    deltaTlens = param.realtimeTlens - param.lastShutterTlens
+    _noidea0 = (deltaTlens**3 * param.k3) / 100 \
+      + (deltaTlens**2 * param.k4) / 100 \
+      + deltaTlens * param.k5 \
+      + (param.realtimeTfpa - param.lastShutterTfpa) * param.k2
+
+    return (
+      int((param.kj / 100) * deltaTlens),
+      int(param.realtimeTshutter * 10 + 200),
+      int(_noidea0 // 100_000),
+      # enters linearly (k0, k1 terms and the curve weights), at the
+      # 0.01 °C resolution of the sensor
+      param.realtimeTfpa,
+      param.tref,
+      param.currChangeRTfpgIdx,
+      param.k0, param.k1, param.b, param.kf,
+      self.precision,
+    )
+
+  def _curveWeights(self) -> tuple[float, float]:
+    """Weights of the current and near curve, depending on the fpa temp
+    """
+    param = self._state.measureParam
     _jwbArr = self._state.jwbTabArrShort
     _i = param.currChangeRTfpgIdx
     if _i == 0:
@@ -59,7 +123,71 @@ class MobirAirTempUtils:
         _t2 = param.realtimeTfpa * 100 - _jwbArr[_i - 1]
 
     _td = _t1 + _t2
-    return _tcurr * (1 - _t1 / _td) + _tnear * (1 - _t2 / _td)
+    return float(1 - _t1 / _td), float(1 - _t2 / _td)
+
+  def _y16toCentiCelsiusFixed(self, y16: np.ndarray) -> np.ndarray:
+    """Integer version of `y16toTemp`, returning °C * 100 (int64)
+    """
+    param = self._state.measureParam
+    Q = self.Q
+
+    _temp = (y16.astype("i8") << Q) - round(self._state.shutterMean * 2**Q) - (int((
+      (param.kj / 100) * (param.realtimeTlens - param.lastShutterTlens)
+    )) << Q)
+
+    _tcurr = self.calcSingleCurveTempArrFixed(self._state.currCurve, _temp)
+    _tnear = self.calcSingleCurveTempArrFixed(self._state.nearCurve, _temp)
+
+    _w1, _w2 = self._curveWeights()
+    return (_tcurr * round(_w1 * 2**Q) + _tnear * round(_w2 * 2**Q)) >> Q
+
+  def calcSingleCurveTempArrFixed(self, curveArr: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Integer version of `calcSingleCurveTempArr` for `values` in Q16
+    fixed point, returning °C * 100 (int64).
+
+    The per pixel terms are linear in `values`, so their coefficients are
+    calculated once per frame. The k1 coefficient is limited to 30 bit to
+    stay in the int64 range. The k0 term is instead limited by clipping
+    `values` to where the product fits, as it saturates long before.
+    """
+    param = self._state.measureParam
+    Q = self.Q
+    limit = 2**30
+    # bound of the k0 product, beyond the saturation of all other terms
+    product = 2**62
+
+    _idx = int(param.realtimeTshutter * 10 + 200)
+    assert 0 < _idx and _idx < len(curveArr), f"{_idx} is out of bounds"
+    cal_val = int(curveArr[_idx])
+
+    deltaTfpaRef = param.realtimeTfpa - param.tref
+    deltaTfpaK2 = (param.realtimeTfpa - param.lastShutterTfpa) * param.k2
+    deltaTlens = param.realtimeTlens - param.lastShutterTlens
+
+    _noidea0 = (deltaTlens**3 * param.k3) / 100 \
+      + (deltaTlens**2 * param.k4) / 100 \
+      + deltaTlens * param.k5 \
+      + deltaTfpaK2
+
+    # k1raw = int16(trunc(values * deltaTfpaRef * k1 / 3 * 100)), Q8 coefficient
+    c1 = int(np.clip(round(deltaTfpaRef * param.k1 / 3 * 100 * 2**8), -limit, limit))
+    k1raw = values * c1
+    k1raw = (np.sign(k1raw) * (np.abs(k1raw) >> (Q + 8))).astype("i2")
+
+    # values * deltaTfpaRef² * k0 * 1e4, Q16 coefficient
+    c0 = int(np.clip(round(deltaTfpaRef**2 * param.k0 * 1e4 * 2**Q), -product, product))
+    _k0values = values if c0 == 0 else np.clip(values, -(product // abs(c0)), product // abs(c0))
+    _noidea1 = values + ((_k0values * c0) >> Q) \
+      + (((k1raw >> 0x19) - np.sign(k1raw)).astype("i8") << Q) \
+      + (int(_noidea0 // 100_000) << Q)
+
+    _v3 = np.clip(_noidea1, -0x8000 << Q, 0x7fff << Q)
+    _v5 = (_v3 * param.kf) // (10_000 << Q) + cal_val
+
+    _cache = np.clip(_v5, curveArr[0], curveArr[-1])
+
+    i = curveArr.searchsorted(_cache, side="left")
+    return i * 10 - 2000 + param.b
 
   def calcSingleCurveTempArr(self, curveArr: np.ndarray, values: np.ndarray):
     param = self._state.measureParam
@@ -98,7 +226,94 @@ class MobirAirTempUtils:
     _cache = np.clip(_v6, curveArr[0], curveArr[-1])
 
     i = curveArr.searchsorted(_cache, side="left")
-    curve_temp = i / 10.0 - 20
+    curve_temp = (i / 10.0 - 20).astype(values.dtype)
 
     return curve_temp + param.b / 100
 
+
+# all Y16 values, shared by the tables of all cameras
+_Y16 = np.arange(2**16, dtype="u2")
+_Y16.setflags(write=False)
+
+
+class MobirAirTempLUT:
+  """Lookup table mapping Y16 values onto the final temperature
+  (Kelvin * 100).
+
+  Apart from the pixel value itself, all inputs of `y16toTemp` are
+  scalars (measure param, detect index, shutter frame average). The
+  table is therefore only rebuilt, when one of those changes as seen by
+  the conversion (`conversionKey`), and the per frame conversion is
+  reduced to a single gather. Other parameters of the frames (emission,
+  distance, ...) don't cause a rebuild, neither do changes of the
+  shutter temperature below 0.1 °C. A change of the fpa temperature or
+  of the lens temperature (by 0.01 °C with the default kj) still
+  rebuilds the window in use.
+
+  Only the window of Y16 values the frames actually use (plus `MARGIN`)
+  is filled, as a frame covers just a small part of the 16 bit range.
+  """
+  SIZE = 2**16
+  MARGIN = 256
+
+  def __init__(self, state: "MobirAirState") -> None:
+    self._state = state
+    self._temp = MobirAirTempUtils(state)
+
+    self._y16 = _Y16
+    self._table = np.zeros(self.SIZE, dtype="u2")
+    # filled window [_lo, _hi) of the table
+    self._lo = 0
+    self._hi = 0
+
+    self._param_key: Optional[tuple] = None
+    self._shutterFrame: Optional[np.ndarray] = None
+    self._curveData: Optional[np.ndarray] = None
+    self._jwbArr: Optional[np.ndarray] = None
+
+  @property
+  def isStale(self) -> bool:
+    return self._hi == 0 \
+      or self._shutterFrame is not self._state.shutterFrame \
+      or self._curveData is not self._state.allCurveData \
+      or self._jwbArr is not self._state.jwbTabArrShort \
+      or self._param_key != self._key()
+
+  def _key(self) -> tuple:
+    return self._temp.conversionKey()
+
+  def rebuild(self, lo: int = 0, hi: int = SIZE):
+    """Recalculate the table for the Y16 values in [lo, hi)
+    """
+    self._param_key = self._key()
+    self._shutterFrame = self._state.shutterFrame
+    self._curveData = self._state.allCurveData
+    self._jwbArr = self._state.jwbTabArrShort
+
+    self._lo, self._hi = max(0, lo), min(self.SIZE, hi)
+    self._fill(self._lo, self._hi)
+
+  def _fill(self, lo: int, hi: int):
+    self._table[lo:hi] = self._temp.y16toKelvin(self._y16[lo:hi])
+
+  def _ensure(self, lo: int, hi: int):
+    if self.isStale:
+      self.rebuild(lo - self.MARGIN, hi + self.MARGIN)
+      return
+
+    # extend the window, without touching the values already calculated
+    if lo < self._lo:
+      new_lo = max(0, lo - self.MARGIN)
+      self._fill(new_lo, self._lo)
+      self._lo = new_lo
+    if hi > self._hi:
+      new_hi = min(self.SIZE, hi + self.MARGIN)
+      self._fill(self._hi, new_hi)
+      self._hi = new_hi
+
+  def lookup(self, y16: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Convert y16 raw data frame into temperatures (Kelvin * 100),
+    optionally written into `out`
+    """
+    self._ensure(int(y16.min()), int(y16.max()) + 1)
+    return np.take(self._table, y16, out=out)
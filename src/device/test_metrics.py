@@ -0,0 +1,45 @@
+from threading import Thread
+import sys
+import time
+import unittest
+
+from device.metrics import Metrics
+
+
+class MetricsTest(unittest.TestCase):
+  THREADS = 4
+  UPDATES = 20_000
+
+  def setUp(self):
+    # switch threads often, to interleave the updates
+    self._interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+
+  def tearDown(self):
+    sys.setswitchinterval(self._interval)
+
+  def test_concurrent_updates(self):
+    metrics = Metrics()
+
+    def update():
+      for _ in range(self.UPDATES):
+        metrics.inc("frames")
+        metrics.observe("stage", time.perf_counter_ns())
+
+    threads = [Thread(target=update) for _ in range(self.THREADS)]
+    for thread in threads:
+      thread.start()
+    # rendered while updated, as by the metrics server
+    while any(thread.is_alive() for thread in threads):
+      metrics.render()
+    for thread in threads:
+      thread.join()
+
+    total = self.THREADS * self.UPDATES
+    self.assertEqual(metrics.counters["frames"], total)
+    self.assertEqual(metrics.stages["stage"].count, total)
+    self.assertIn(f"mobirair_frames_total {total}", metrics.render())
+
+
+if __name__ == "__main__":
+  unittest.main()
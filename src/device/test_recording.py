@@ -0,0 +1,113 @@
+from pathlib import Path
+import tempfile
+import unittest
+import warnings
+import numpy as np
+
+from benchmark import synthetic
+from device.image_processor import ThermalFrameProcessor
+from device.recording import RadiometricReader, RadiometricWriter, RecordingFormat
+from device.types import CustomParamLine, FixedParamLine, RawFrame, raw_to_dataclass
+
+
+def make_raw_frame(shuttering: bool, seed: int) -> RawFrame:
+  header = bytearray(synthetic.make_header(shuttering, seed))
+  # k0 = 0, with any other k0 (nearly) all pixels saturate
+  header[0x92:0x94] = bytes(2)
+  header = bytes(header)
+  return RawFrame(
+    header=header,
+    payload=synthetic.make_payload(seed),
+    fixedParam=raw_to_dataclass(FixedParamLine, header),
+    customParam=raw_to_dataclass(CustomParamLine, header),
+  )
+
+
+class RecordingRoundTripTest(unittest.TestCase):
+  FRAMES = 20
+  CHUNK_FRAMES = 8
+  # at a chunk start, inside a chunk and in the last (partial) chunk
+  SHUTTER_FRAMES = (0, 5, 11, 16, 18)
+
+  def setUp(self):
+    # overflows of the int16 conversions are part of the processing
+    warnings.simplefilter("ignore", RuntimeWarning)
+    self._dir = tempfile.TemporaryDirectory()
+    self.path = Path(self._dir.name) / "recording.bin"
+
+    state = synthetic.make_state()
+    state.measureParam.k0 = 0
+    proc = ThermalFrameProcessor(state)
+    writer = RadiometricWriter(self.path, state, chunk_frames=self.CHUNK_FRAMES)
+
+    # processed as by the driver pipeline: shutter frame, recording,
+    # temperature and the parameter updates of the frame
+    self.frames, self.timestamps, self.temperatures = [], [], []
+    for i in range(self.FRAMES):
+      shuttering = i in self.SHUTTER_FRAMES
+      raw = make_raw_frame(shuttering, i)
+      frame = proc.process(raw)
+      if shuttering:
+        # as updated after a shutter by the driver
+        param = state.measureParam
+        param.lastShutterTlens = param.realtimeTlens
+        param.lastShutterTfpa = param.realtimeTfpa
+        param.kj += 7
+        param.currChangeRTfpgIdx = i % synthetic.JWB_TAB_NUMBER
+
+      timestamp = 1_000_000 + 10_000 * i
+      writer.write(raw, timestamp)
+      self.frames.append(raw)
+      self.timestamps.append(timestamp)
+      self.temperatures.append(frame.compute().image.copy())
+      state.measureParam.setFromFrame(raw, state.module_tp)
+
+    writer.close()
+
+  def tearDown(self):
+    self._dir.cleanup()
+
+  def assertRecorded(self, reader: RadiometricReader):
+    self.assertEqual(len(reader), self.FRAMES)
+    np.testing.assert_array_equal(reader.timestamps, self.timestamps)
+    for i, raw in enumerate(self.frames):
+      with self.subTest(frame=i):
+        frame = reader.frame(i)
+        self.assertEqual(frame.header, raw.header)
+        self.assertEqual(frame.payload, raw.payload)
+        self.assertEqual(frame.timestamp, self.timestamps[i])
+        self.assertEqual(frame.sequence, i)
+
+  def test_frames(self):
+    self.assertRecorded(RadiometricReader(self.path))
+
+  def test_frames_without_index(self):
+    # as after a crash, before the writer was closed
+    data = self.path.read_bytes()
+    self.path.write_bytes(data[:-RecordingFormat.TRAILER.size])
+    self.assertRecorded(RadiometricReader(self.path))
+
+  def test_out_of_range(self):
+    reader = RadiometricReader(self.path)
+    with self.assertRaises(IndexError):
+      reader.frame(self.FRAMES)
+
+  def test_find(self):
+    reader = RadiometricReader(self.path)
+    for i, timestamp in enumerate(self.timestamps):
+      with self.subTest(frame=i):
+        self.assertEqual(reader.find(timestamp), i)
+        self.assertEqual(reader.find(timestamp + 5_000), i)
+    self.assertEqual(reader.find(0), 0)
+    self.assertEqual(reader.find(2**62), self.FRAMES - 1)
+
+  def test_temperature(self):
+    reader = RadiometricReader(self.path)
+    # backwards, so that every frame is replayed from its chunk start
+    for i in reversed(range(self.FRAMES)):
+      with self.subTest(frame=i):
+        np.testing.assert_array_equal(reader.temperature(i).image, self.temperatures[i])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+import numpy as np
+
+from device.roi import Polygon, Rect, RegionStatsEngine
+
+
+def to_kelvin(y16: np.ndarray) -> np.ndarray:
+  # non-linear, like the curves of the camera
+  return (np.sqrt(y16.astype("f8")) * 300).astype("u2")
+
+
+class RegionStatsEngineTest(unittest.TestCase):
+  def test_stats_of_temperatures(self):
+    shape = (90, 120)
+    y16 = np.random.default_rng(0).integers(1000, 20000, shape, dtype="u2")
+    regions = dict(
+      rect=Rect(10, 20, 30, 15),
+      polygon=Polygon([(60, 10), (110, 30), (70, 80)]),
+      pixel=Rect(5, 5, 1, 1),
+    )
+
+    engine = RegionStatsEngine(shape)
+    for name, region in regions.items():
+      engine.add(name, region)
+    stats = engine.compute(y16, to_kelvin)
+
+    temps = to_kelvin(y16)
+    for name, region in regions.items():
+      with self.subTest(region=name):
+        mask = region.mask(shape)
+        s = stats[name]
+        self.assertEqual(s.pixels, mask.sum())
+        self.assertEqual(s.min, temps[mask].min())
+        self.assertEqual(s.max, temps[mask].max())
+        self.assertAlmostEqual(s.mean, temps[mask].astype("f8").mean())
+        self.assertEqual(temps[s.hotspot[1], s.hotspot[0]], s.max)
+        self.assertEqual(temps[s.coldspot[1], s.coldspot[0]], s.min)
+
+  def test_remove(self):
+    engine = RegionStatsEngine((10, 10))
+    engine.add("a", Rect(0, 0, 2, 2))
+    engine.add("b", Rect(5, 5, 2, 2))
+    engine.remove("a")
+    self.assertEqual(list(engine.compute(np.ones((10, 10), dtype="u2"), to_kelvin)), ["b"])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import socket
+import struct
+import time
+import unittest
+import numpy as np
+
+from device.stream_server import StreamClient, StreamFormat, StreamProtocol, StreamServer
+
+
+class StreamServerDeltaTest(unittest.TestCase):
+  FRAMES = 8
+
+  def setUp(self):
+    self.server = StreamServer(0, format=StreamFormat.Y16, queue_size=self.FRAMES)
+    self.clients = [StreamClient("127.0.0.1", self.server.port, delta=True) for _ in range(2)]
+    while self.server.clients < len(self.clients):
+      time.sleep(1e-3)
+
+  def tearDown(self):
+    for client in self.clients:
+      client.close()
+    self.server.close()
+
+  def test_every_delta_client_gets_deltas(self):
+    rng = np.random.default_rng(0)
+    header = bytes(240)
+
+    with ThreadPoolExecutor(len(self.clients)) as pool:
+      for _ in range(self.FRAMES):
+        y16 = rng.integers(0, 2**16, (90, 120), dtype="u2")
+        received = pool.map(StreamClient.get, self.clients)
+        self.server.publish(SimpleNamespace(y16=y16, header=header))
+
+        for frame in received:
+          np.testing.assert_array_equal(frame.image, y16)
+
+    self.assertEqual([c.deltas for c in self.clients], [self.FRAMES - 1] * len(self.clients))
+
+
+class StreamServerWebSocketTest(unittest.TestCase):
+  def setUp(self):
+    self.server = StreamServer(0)
+    self.sock = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+    self.sock.sendall(
+      b"GET / HTTP/1.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+      b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n\r\n")
+
+    response = b""
+    while b"\r\n\r\n" not in response:
+      response += self.sock.recv(1024)
+    self.assertTrue(response.startswith(b"HTTP/1.1 101"))
+
+  def tearDown(self):
+    self.sock.close()
+    self.server.close()
+
+  def send(self, opcode: int, payload: bytes):
+    mask = b"\x01\x02\x03\x04"
+    masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    self.sock.sendall(bytes([0x80 | opcode, 0x80 | len(payload)]) + mask + masked)
+
+  def test_ping_is_answered(self):
+    self.send(StreamProtocol.WS_PING, b"hello")
+    self.assertEqual(self.sock.recv(7, socket.MSG_WAITALL), bytes([0x8a, 5]) + b"hello")
+
+  def test_close_ends_connection(self):
+    self.send(StreamProtocol.WS_CLOSE, struct.pack("!H", 1000))
+    self.assertEqual(self.sock.recv(4, socket.MSG_WAITALL), bytes([0x88, 2]) + struct.pack("!H", 1000))
+    self.assertEqual(self.sock.recv(1), b"")
+    self.assertEqual(self.server.clients, 0)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import warnings
+import numpy as np
+
+from benchmark import synthetic
+from device.temputils import MobirAirTempLUT, MobirAirTempUtils, Precision
+
+
+def make_state():
+  state = synthetic.make_state()
+  # with any other k0 (nearly) all pixels saturate
+  state.measureParam.k0 = 0
+  return state
+
+
+class TempLUTTest(unittest.TestCase):
+  def setUp(self):
+    # overflows of the int16 conversions are part of the reference
+    warnings.simplefilter("ignore", RuntimeWarning)
+    self.rng = np.random.default_rng(0)
+
+  def assertMatchesConversion(self, state, lut: MobirAirTempLUT):
+    y16 = self.rng.integers(6000, 12000, (90, 120), dtype="u2")
+    np.testing.assert_array_equal(lut.lookup(y16), MobirAirTempUtils(state).y16toKelvin(y16))
+
+  def test_lookup_equals_conversion(self):
+    for precision in Precision:
+      with self.subTest(precision=precision):
+        state = make_state()
+        state.config.precision = precision
+        self.assertMatchesConversion(state, MobirAirTempLUT(state))
+
+  def test_follows_sensor_updates(self):
+    # one value at a time, so that no other change rebuilds the table
+    steps = dict(realtimeTlens=0.004, realtimeTshutter=0.03, realtimeTfpa=0.01, lastShutterTlens=0.004, emission=1)
+    for name, step in steps.items():
+      with self.subTest(name=name):
+        state = make_state()
+        lut = MobirAirTempLUT(state)
+        for _ in range(10):
+          setattr(state.measureParam, name, getattr(state.measureParam, name) + step)
+          self.assertMatchesConversion(state, lut)
+
+  def test_new_shutter_frame(self):
+    state = make_state()
+    lut = MobirAirTempLUT(state)
+    self.assertMatchesConversion(state, lut)
+
+    state.shutterFrame = state.shutterFrame + 50
+    self.assertMatchesConversion(state, lut)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,99 @@
+from dataclasses import dataclass
+import dataclasses
+import unittest
+import numpy as np
+
+from benchmark import synthetic
+from device.types import CustomParamLine, FixedParamLine, HeaderDecoder, bitfield, bytefield
+
+
+def decode_fields(cls: type, raw: bytes):
+  """Field by field decoding, as done before the decoders were compiled
+  """
+  values = {}
+  for field in dataclasses.fields(cls):
+    meta = field.metadata
+    segment = raw[meta["location"]:meta["location"] + meta["length"]]
+
+    if field.type == str:
+      values[field.name] = segment.decode("ascii")
+      continue
+
+    if "bits" in meta:
+      val = int.from_bytes(segment, byteorder="little", signed=False)
+      val = (val & meta["bits"]) >> (bin(meta["bits"]).rindex("1") - 1)
+    else:
+      val = int.from_bytes(segment, byteorder=meta["order"], signed=meta["signed"])
+    values[field.name] = bool(val) if field.type == bool else val
+
+  return cls(**values)
+
+
+@dataclass(slots=True)
+class _Header:
+  flag: bool = bytefield(0x6, length=1)
+  byte: int = bytefield(0x7, length=1, signed=True)
+  word: int = bytefield(0x8, signed=True)
+  big: int = bytefield(0xa, order="big", signed=True)
+  big_unsigned: int = bytefield(0xa, order="big")
+  dword: int = bytefield(0xc, length=4, signed=True)
+  # overlaps dword, so it needs a second struct format
+  dword_low: int = bytefield(0xc)
+  qword: int = bytefield(0x10, length=8, signed=True)
+  low: int = bitfield(0x18, 0x003f)
+  high: int = bitfield(0x18, 0x7fc0)
+  bit: bool = bitfield(0x1a, 0b1)
+  name: str = bytefield(0x20, 6)
+
+
+class HeaderDecoderTest(unittest.TestCase):
+  CLASSES = [_Header, FixedParamLine, CustomParamLine]
+
+  def headers(self, count: int) -> list[bytes]:
+    rng = np.random.default_rng(0)
+    headers = []
+    for _ in range(count):
+      raw = bytearray(rng.integers(0, 256, 240, dtype="u1").tobytes())
+      # ascii for the string fields
+      raw[0x20:0x26] = b"HEADER"
+      raw[0x8:0x10] = b"MOBIRAIR"
+      headers.append(bytes(raw))
+    return headers + [synthetic.make_header(shuttering=True)]
+
+  def test_decode_equals_field_decoding(self):
+    for cls in self.CLASSES:
+      for raw in self.headers(50):
+        with self.subTest(cls=cls.__name__):
+          self.assertEqual(HeaderDecoder.of(cls).decode(raw), decode_fields(cls, raw))
+
+  def test_decode_batch(self):
+    headers = self.headers(20)
+    # headers every 300 bytes, as in a stream of frames
+    stride = 300
+    raw = b"".join(h + bytes(stride - len(h)) for h in headers)
+
+    for cls in self.CLASSES:
+      batch = HeaderDecoder.of(cls).decode_batch(raw, stride)
+      self.assertEqual(len(batch), len(headers))
+
+      for row, header in zip(batch, headers):
+        expected = dataclasses.asdict(decode_fields(cls, header))
+        for name, value in expected.items():
+          with self.subTest(cls=cls.__name__, field=name):
+            if isinstance(value, str):
+              # numpy bytes drop trailing NULs
+              self.assertEqual(row[name].decode("ascii"), value.rstrip("\x00"))
+            else:
+              self.assertEqual(row[name], value)
+
+  def test_invalid_field(self):
+    @dataclass
+    class Invalid:
+      value: int = bytefield(0x0, length=3)
+
+    with self.assertRaises(TypeError):
+      HeaderDecoder(Invalid)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,9 +1,12 @@
-from typing import Type
+from functools import cached_property
+from typing import Callable, Optional, Type
 import dataclasses
+import struct
 from dataclasses import dataclass
 import numpy as np
 
 from device.temputils import MobirAirTempUtils
+from device.roi import RegionStats
 
 def bytefield(location: int, length: int = 2, order: str = "little", signed: bool = False):
   return dataclasses.field(
@@ -15,7 +18,7 @@ def bitfield(location: int, bits: int, length: int = 2):
     metadata=dict(location=location, bits=bits, length=length)
   )
 
-@dataclass()
+@dataclass(slots=True)
 class FixedParamLine:
   width: int = bytefield(0x4)
   height: int = bytefield(0x6)
@@ -49,7 +52,7 @@ class FixedParamLine:
     return MobirAirTempUtils.getParamTemp(self._startupShutterTemp)
 
 
-@dataclass()
+@dataclass(slots=True)
 class CustomParamLine:
   temp_range: int = bytefield(0x60)
 
@@ -86,42 +89,285 @@ class CustomParamLine:
 @dataclass()
 class RawFrame:
   header: bytes
-  payload: bytes
+  payload: bytes | memoryview
   fixedParam: FixedParamLine
   customParam: CustomParamLine
+  # completion of the USB transfer finishing the frame (`time.monotonic_ns`)
+  timestamp: Optional[int] = None
+  # number of the frame in the stream, counted by the driver
+  sequence: int = 0
+  # frame counter of the device, if its header has one
+  deviceCounter: Optional[int] = None
 
   @property
   def raw(self) -> bytes:
     return self.header + self.payload
 
 
-@dataclass()
-class Frame(RawFrame):
-  image: np.ndarray
+class Frame:
+  """Processed frame, a lazy view of a `RawFrame`.
+
+  The raw Y16 image, the NUC corrected Y16 image, the temperature image
+  and the region statistics are each computed on first access and then
+  memoized. They are computed with the processor state at that time, so
+  they should be accessed while the frame is delivered (listener,
+  sinks). `y16` is a buffer of the processor reused by the next frame.
+  """
+
+  def __init__(self, rawFrame: RawFrame, processor: "ThermalFrameProcessor",
+               out: Optional[np.ndarray] = None, calibrating: bool = False,
+               radiometric: bool = True) -> None:
+    self.rawFrame = rawFrame
+    # captured during a shutter calibration
+    self.calibrating = calibrating
+    # False while the calibration data is loaded, `image` holds the
+    # (basic calibrated) Y16 values then
+    self.radiometric = radiometric
+    self._processor = processor
+    self._out = out
+
+  @property
+  def header(self) -> bytes:
+    return self.rawFrame.header
+
+  @property
+  def timestamp(self) -> Optional[int]:
+    """Time the frame has been received (`time.monotonic_ns`)
+    """
+    return self.rawFrame.timestamp
+
+  @property
+  def sequence(self) -> int:
+    return self.rawFrame.sequence
+
+  @property
+  def payload(self) -> bytes | memoryview:
+    return self.rawFrame.payload
+
+  @property
+  def fixedParam(self) -> FixedParamLine:
+    return self.rawFrame.fixedParam
+
+  @property
+  def customParam(self) -> CustomParamLine:
+    return self.rawFrame.customParam
+
+  @property
+  def raw(self) -> bytes:
+    return self.rawFrame.raw
+
+  @cached_property
+  def rawY16(self) -> np.ndarray:
+    """Sensor values, without the reference rows
+    """
+    return self._processor.rawImage(self.rawFrame)
+
+  @cached_property
+  def y16(self) -> np.ndarray:
+    """NUC corrected Y16 values (the raw ones while shuttering)
+    """
+    if self.fixedParam.isShuttering:
+      return self.rawY16
+    return self._processor.correct(self.rawY16)
+
+  @cached_property
+  def image(self) -> np.ndarray:
+    """Temperatures (Kelvin * 100), written into `out` if given
+    """
+    return self._processor.temperature(self.y16, self._out)
+
+  def imageInto(self, out: np.ndarray) -> np.ndarray:
+    """Temperature image written into `out` (converted right into it,
+    unless it has already been computed)
+    """
+    if "image" in self.__dict__:
+      np.copyto(out, self.image)
+    else:
+      self._out = out
+      self.compute()
+    return out
+
+  def compute(self) -> "Frame":
+    """Compute the images now, with the current processor state
+    """
+    self.__dict__["image"] = self._processor.temperature(self.y16, self._out)
+    return self
+
+  @cached_property
+  def regions(self) -> dict[str, RegionStats]:
+    """Statistics of the registered regions
+    """
+    return self._processor.regionStats(self.y16)
+
+  def detach(self) -> "Frame":
+    """Copy of the frame, that stays valid after the delivery (e.g. to
+    hand it over to another thread). Images and region statistics are
+    computed, the payload and reused buffers are copied.
+    """
+    raw = self.rawFrame
+    frame = Frame(
+      dataclasses.replace(raw, payload=bytes(raw.payload)),
+      self._processor, calibrating=self.calibrating, radiometric=self.radiometric)
+
+    frame.__dict__.update(
+      y16=self.y16.copy(),
+      image=self.image.copy() if self._out is not None else self.image,
+      regions=self.regions,
+    )
+    return frame
 
 
 def raw_to_dataclass(dataclass: Type, raw: bytes):
-  values = {}
+  return HeaderDecoder.of(dataclass).decode(raw)
+
+
+class HeaderDecoder:
+  """Decoder for header dataclasses (see `bytefield` and `bitfield`).
+
+  The field metadata is compiled once per dataclass into `struct`
+  formats and a generated decode function, so that decoding a header
+  is a few `unpack_from` calls and a single constructor call. For
+  recorded streams `decode_batch` decodes many headers at once into
+  a numpy structured array.
+  """
+  _decoders: dict[type, "HeaderDecoder"] = {}
 
-  for field in dataclasses.fields(dataclass):
+  _INT_CODES = {1: "b", 2: "h", 4: "i", 8: "q"}
+
+  @classmethod
+  def of(cls, dataclass: Type) -> "HeaderDecoder":
+    decoder = cls._decoders.get(dataclass)
+    if decoder is None:
+      decoder = cls._decoders[dataclass] = cls(dataclass)
+    return decoder
+
+  def __init__(self, dataclass: Type) -> None:
+    self._dataclass = dataclass
+    self._fields = [f for f in dataclasses.fields(dataclass) if f.init]
+    self.size = 0
+
+    # segment: (location, length, order, signed, is_str)
+    self._segments: list[tuple] = []
+    for field in self._fields:
+      segment = self._segment(field)
+      if segment not in self._segments:
+        self._segments.append(segment)
+      self.size = max(self.size, segment[0] + segment[1])
+
+    self._compile_structs()
+    self.decode = self._compile_decode()
+    self._batch_dtype = self._compile_batch_dtype()
+
+  @staticmethod
+  def _segment(field: dataclasses.Field) -> tuple:
     meta = field.metadata
-    segment = raw[meta["location"]:meta["location"] + meta["length"]]
-    val = None
+    if "location" not in meta:
+      raise TypeError(f"{field.name} is neither a bytefield nor a bitfield")
+
+    if "bits" in meta:
+      return (meta["location"], meta["length"], "little", False, False)
+    return (meta["location"], meta["length"], meta["order"], meta["signed"], field.type == str)
+
+  @staticmethod
+  def _shift(bits: int) -> int:
+    return bin(bits).rindex("1") - 1
+
+  def _compile_structs(self):
+    # struct formats can't overlap and have a single byte order,
+    # so segments are distributed over as many formats as needed
+    groups: list[tuple[str, list[tuple]]] = []
+    for segment in sorted(self._segments):
+      for order, members in groups:
+        last = members[-1]
+        if order == segment[2] and last[0] + last[1] <= segment[0]:
+          members.append(segment)
+          break
+      else:
+        groups.append((segment[2], [segment]))
+
+    self._structs: list[struct.Struct] = []
+    self._slots: dict[tuple, tuple[int, int]] = {}
+    for g, (order, members) in enumerate(groups):
+      fmt, pos = "<" if order == "little" else ">", 0
+      for k, (location, length, _, signed, is_str) in enumerate(members):
+        fmt += "x" * (location - pos)
+        if is_str:
+          fmt += f"{length}s"
+        elif length in self._INT_CODES:
+          code = self._INT_CODES[length]
+          fmt += code if signed else code.upper()
+        else:
+          raise TypeError(f"unsupported field length {length}")
+        pos = location + length
+        self._slots[(location, length, order, signed, is_str)] = (g, k)
+      self._structs.append(struct.Struct(fmt))
+
+  def _compile_decode(self) -> Callable[[bytes], object]:
+    args = []
+    for field in self._fields:
+      g, k = self._slots[self._segment(field)]
+      expr = f"g{g}[{k}]"
+
+      if field.type == int or field.type == bool:
+        if "bits" in field.metadata:
+          bits = field.metadata["bits"]
+          expr = f"(({expr} & {bits}) >> {self._shift(bits)})"
+        if field.type == bool:
+          expr = f"bool({expr})"
+      elif field.type == str:
+        expr = f"{expr}.decode('ascii')"
+      else:
+        expr = "None"
 
-    if field.type == int or field.type == bool:
-      if "bits" not in meta:
-        val = int.from_bytes(segment, byteorder=meta["order"], signed=meta["signed"])
+      args.append(expr)
+
+    lines = [f"  g{g} = s{g}(raw, 0)" for g in range(len(self._structs))]
+    source = "def decode(raw):\n" + "\n".join(lines) + f"\n  return cls({', '.join(args)})\n"
+
+    namespace = {f"s{g}": s.unpack_from for g, s in enumerate(self._structs)}
+    namespace["cls"] = self._dataclass
+    exec(source, namespace)
+    return namespace["decode"]
+
+  def _compile_batch_dtype(self) -> np.dtype:
+    names, formats, offsets = [], [], []
+    for i, (location, length, order, signed, is_str) in enumerate(self._segments):
+      names.append(f"s{i}")
+      offsets.append(location)
+      if is_str:
+        formats.append(f"S{length}")
       else:
-        val = int.from_bytes(segment, byteorder="little", signed=False)
-        val = (val & meta["bits"]) >> (bin(meta["bits"]).rindex("1") - 1)
+        formats.append(f"{'<' if order == 'little' else '>'}{'i' if signed else 'u'}{length}")
 
-      if field.type == bool:
-        val = bool(val)
+    return np.dtype(dict(names=names, formats=formats, offsets=offsets, itemsize=self.size))
 
-    elif field.type == str:
-      val = segment.decode("ascii")
+  def decode_batch(self, raw: bytes | memoryview | np.ndarray, stride: Optional[int] = None) -> np.ndarray:
+    """Decode all headers in `raw`, which are located every `stride` bytes
+    (e.g. the frame size for recorded streams).
 
-    values[field.name] = val
+    Returns a structured array with one column per dataclass field.
+    """
+    stride = stride or self.size
+    length = memoryview(raw).nbytes
+    count = 0 if length < self.size else (length - self.size) // stride + 1
+
+    segments = np.ndarray((count,), dtype=self._batch_dtype, buffer=raw, strides=(stride,))
+
+    out_fields = []
+    for field in self._fields:
+      if field.type == bool:
+        out_fields.append((field.name, "?"))
+      elif field.type == str:
+        out_fields.append((field.name, f"S{field.metadata['length']}"))
+      else:
+        out_fields.append((field.name, "i8"))
 
-  return dataclass(**values)
+    out = np.empty(count, dtype=out_fields)
+    for field in self._fields:
+      column = segments[f"s{self._segments.index(self._segment(field))}"]
+      if "bits" in field.metadata:
+        bits = field.metadata["bits"]
+        column = (column & bits) >> self._shift(bits)
+      out[field.name] = column
 
+    return out
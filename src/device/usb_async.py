@@ -0,0 +1,174 @@
+from collections import deque
+from ctypes import POINTER, Structure, addressof, byref, c_int, c_long, c_void_p
+import logging
+import time
+import numpy as np
+import usb.core
+import usb.backend.libusb1 as libusb1
+
+
+class _timeval(Structure):
+  _fields_ = [("tv_sec", c_long), ("tv_usec", c_long)]
+
+
+class MobirAirAsyncReader:
+  """Streams from a bulk-IN endpoint with several transfers queued at
+  once, using the asynchronous libusb api.
+
+  Keeping multiple transfers in flight removes the gap between two
+  synchronous reads, in which the device has nowhere to put its data.
+  Completed transfers are handed out in order by `read_into` and
+  resubmitted right after. Every transfer has its own buffer, so their
+  data is copied once into the buffer given to `read_into`, unlike
+  synchronous reads, which land directly in it.
+
+  Events are handled by the thread calling `read_into`, so all callbacks
+  run on that thread as well.
+  """
+
+  def __init__(self, dev: usb.core.Device, endpoint: usb.core.Endpoint, depth: int = 4,
+               transfer_size: int = 16384) -> None:
+    if not self.supported(dev):
+      raise RuntimeError("async transfers require the libusb1 backend")
+
+    backend = dev._ctx.backend
+    self._lib = backend.lib
+    self._ctx = backend.ctx
+    self._handle = dev._ctx.managed_open()
+    self._endpoint = endpoint.bEndpointAddress
+
+    self.depth = depth
+    self.transfer_size = transfer_size
+
+    self._lib.libusb_cancel_transfer.argtypes = [POINTER(libusb1._libusb_transfer)]
+    self._lib.libusb_handle_events_timeout_completed.argtypes = [
+      c_void_p, POINTER(_timeval), POINTER(c_int)]
+
+    # the callback object needs to outlive all transfers
+    self._callback = libusb1._libusb_transfer_cb_fn_p(self._on_complete)
+
+    self._pending = set()
+    # (transfer, completion time) in order
+    self._completed: deque[tuple[int, int]] = deque()
+    # completion time of the transfer last read (`time.monotonic_ns`)
+    self.completed_ns = 0
+    self._running = False
+
+    self._buffers = [np.empty(transfer_size, dtype="u1") for _ in range(depth)]
+    self._transfers = []
+    self._index = {}
+    for i, buffer in enumerate(self._buffers):
+      transfer = self._lib.libusb_alloc_transfer(0)
+      if not transfer:
+        raise MemoryError("libusb_alloc_transfer failed")
+      self._fill_transfer(transfer.contents, buffer)
+      self._transfers.append(transfer)
+      self._index[addressof(transfer.contents)] = i
+
+  @staticmethod
+  def supported(dev: usb.core.Device) -> bool:
+    """Whether the device is opened by the libusb1 backend
+    """
+    return isinstance(dev._ctx.backend, libusb1._LibUSB)
+
+  def _fill_transfer(self, transfer: libusb1._libusb_transfer, buffer: np.ndarray):
+    transfer.dev_handle = self._handle.handle
+    transfer.endpoint = self._endpoint
+    transfer.type = libusb1._LIBUSB_TRANSFER_TYPE_BULK
+    transfer.timeout = 0
+    transfer.length = buffer.size
+    transfer.buffer = buffer.ctypes.data
+    transfer.callback = self._callback
+
+  def _on_complete(self, transfer):
+    i = self._index[addressof(transfer.contents)]
+    self._pending.discard(i)
+    self._completed.append((i, time.monotonic_ns()))
+
+  def _submit(self, i: int):
+    self._pending.add(i)
+    try:
+      libusb1._check(self._lib.libusb_submit_transfer(self._transfers[i]))
+    except usb.core.USBError:
+      self._pending.discard(i)
+      raise
+
+  def _handle_events(self, timeout: float):
+    tv = _timeval(int(timeout), int((timeout % 1) * 1e6))
+    libusb1._check(self._lib.libusb_handle_events_timeout_completed(self._ctx, byref(tv), None))
+
+  @property
+  def running(self) -> bool:
+    return self._running
+
+  def start(self):
+    if self._running:
+      return
+
+    self._completed.clear()
+    self._running = True
+    # transfers that couldn't be cancelled are still in flight
+    for i in range(self.depth):
+      if i not in self._pending:
+        self._submit(i)
+
+  def stop(self, timeout: float = 1):
+    """Cancel all transfers in flight and wait for their cancellation.
+    Data that has already been received, but not read, is discarded.
+    """
+    self._running = False
+    for i in list(self._pending):
+      self._lib.libusb_cancel_transfer(self._transfers[i])
+
+    deadline = time.monotonic() + timeout
+    while self._pending and time.monotonic() < deadline:
+      self._handle_events(0.1)
+
+    if self._pending:
+      logging.warn(f"async reader: {len(self._pending)} transfers couldn't be cancelled")
+    self._completed.clear()
+
+  def read_into(self, buffer: np.ndarray, timeout: int = 200) -> int:
+    """Wait for the next completed transfer and copy its data into `buffer`,
+    which needs to hold at least `transfer_size` bytes.
+
+    Returns the number of bytes received. Raises a `USBTimeoutError` when no
+    transfer completed within `timeout` ms.
+    """
+    if not self._running:
+      self.start()
+
+    deadline = time.monotonic() + timeout / 1e3
+    while not self._completed:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        raise usb.core.USBTimeoutError("async reader: timeout", libusb1.LIBUSB_ERROR_TIMEOUT, None)
+      self._handle_events(remaining)
+
+    i, self.completed_ns = self._completed.popleft()
+    transfer = self._transfers[i].contents
+    status, length = transfer.status, transfer.actual_length
+
+    if status == libusb1.LIBUSB_TRANSFER_CANCELLED:
+      return 0
+
+    if status != libusb1.LIBUSB_TRANSFER_COMPLETED:
+      # leave no transfer in flight, so that the next read can start over
+      self.stop()
+      raise usb.core.USBError(
+        libusb1._str_transfer_error[status], status, libusb1._transfer_errno[status])
+
+    buffer[:length] = self._buffers[i][:length]
+    if self._running:
+      self._submit(i)
+    return length
+
+  def __del__(self):
+    if getattr(self, "_pending", None):
+      self.stop()
+
+    # transfers that couldn't be cancelled have to be leaked
+    for i, transfer in enumerate(getattr(self, "_transfers", [])):
+      if i not in self._pending:
+        self._lib.libusb_free_transfer(transfer)
+    self._transfers = []
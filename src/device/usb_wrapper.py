@@ -1,22 +1,75 @@
+from typing import Optional
+import time
+import usb.backend
 import usb.core
 import usb.util
+import numpy as np
 import logging
 
+from .usb_async import MobirAirAsyncReader
+
+
+# reading into a given buffer relies on pyusb internals (the resource
+# manager and the backend's bulk_read), as found in pyusb 1.x
+_DIRECT_READS = usb.version_info[0] == 1 \
+  and hasattr(usb.core._ResourceManager, "setup_request") \
+  and hasattr(usb.backend.IBackend, "bulk_read")
+
+
+class _BufferRegion:
+  """Stand-in for the `array.array` objects the pyusb backends read into,
+  pointing to a region of an existing buffer instead.
+  """
+  itemsize = 1
+
+  def __init__(self, buffer: np.ndarray) -> None:
+    if buffer.dtype != np.uint8 or not buffer.flags.c_contiguous:
+      raise ValueError("buffer needs to be a contiguous uint8 array")
+    self._buffer = buffer
+
+  def buffer_info(self) -> tuple[int, int]:
+    return self._buffer.ctypes.data, self._buffer.size
+
 
 class MobirAirUSBWrapper:
-  def __init__(self, dev: usb.core.Device) -> None:
+  # timeout (ms) of parameter reads, grown with the read size assuming
+  # the device delivers at least MIN_TRANSFER_RATE bytes/s
+  READ_TIMEOUT = 200
+  MIN_TRANSFER_RATE = 256 * 1024
+
+  # completion of the last stream transfer read (`time.monotonic_ns`)
+  last_completion_ns = 0
+
+  def __init__(self, dev: usb.core.Device, async_depth: int = 0, transfer_size: int = 8192,
+               reset: bool = True) -> None:
+    """`async_depth` selects the number of bulk transfers kept in flight
+    on the stream endpoint. With 0 the stream is read synchronously.
+
+    Without `reset` the device is used as configured, e.g. to only query
+    it. Claiming its interface then fails with an `USBError`, if another
+    process uses the device.
+    """
     self._dev = dev
-    self._init()
+    self.async_depth = async_depth
+    self.transfer_size = transfer_size
+    self._async_reader: Optional[MobirAirAsyncReader] = None
+    self._init(reset)
 
-  def _init(self):
-    # reset device state
-    self._dev.reset()
+  def _init(self, reset: bool = True):
+    if reset:
+      # reset device state
+      self._dev.reset()
 
-    # set active configuration, as there's only one use that
-    self._dev.set_configuration()
+      # set active configuration, as there's only one use that
+      self._dev.set_configuration()
 
     # get and store endpoint instance
-    cfg: usb.core.Configuration = self._dev.get_active_configuration()
+    try:
+      cfg: usb.core.Configuration = self._dev.get_active_configuration()
+    except usb.core.USBError:
+      # not configured yet, so not in use either
+      self._dev.set_configuration()
+      cfg = self._dev.get_active_configuration()
     self._interface = cfg[(1,1)]
 
     # TODO: why is this the solution
@@ -46,39 +99,112 @@ class MobirAirUSBWrapper:
   def epi(self) -> usb.core.Endpoint:
     return self._endpoint_in
 
+  def read_into(self, buffer: np.ndarray, timeout: int = 200) -> int:
+    """Read from the input endpoint directly into `buffer`, without
+    allocating a new array for each transfer.
+
+    Returns the number of bytes received.
+    """
+    if self.async_depth > 0 and self._async_reader is None and not MobirAirAsyncReader.supported(self._dev):
+      logging.warn("async transfers require the libusb1 backend, reading synchronously")
+      self.async_depth = 0
+
+    if self.async_depth > 0:
+      if self._async_reader is None:
+        self._async_reader = MobirAirAsyncReader(
+          self._dev, self.epi, depth=self.async_depth, transfer_size=self.transfer_size)
+      length = self._async_reader.read_into(buffer, timeout)
+      self.last_completion_ns = self._async_reader.completed_ns
+      return length
+
+    length = self._read_into_sync(buffer, timeout)
+    self.last_completion_ns = time.monotonic_ns()
+    return length
+
+  def _read_into_sync(self, buffer: np.ndarray, timeout: int) -> int:
+    if not _DIRECT_READS:
+      data = self.epi.read(buffer.size, timeout)
+      buffer[:len(data)] = data
+      return len(data)
+
+    ctx = self._dev._ctx
+    intf, ep = ctx.setup_request(self._dev, self.epi)
+    return ctx.backend.bulk_read(
+      ctx.handle, ep.bEndpointAddress, intf.bInterfaceNumber, _BufferRegion(buffer), timeout)
+
+  def cancel_stream(self):
+    """Cancel all stream transfers still in flight, so that the input
+    endpoint can be read synchronously again.
+    """
+    if self._async_reader is not None:
+      self._async_reader.stop()
+
+  def drain(self):
+    """Discard the data left on the input endpoint
+    """
+    while True:
+      try:
+        self.epi.read(self.epi.wMaxPacketSize, 100)
+      except usb.core.USBTimeoutError:
+        return
+
   def __del__(self):
     logging.info("disposing")
+    if self._async_reader is not None:
+      self._async_reader.stop()
+      self._async_reader = None
     usb.util.dispose_resources(self._dev)
 
 
-  def retrieve_data(self, command: bytes, length: int, timeouts: int = 3):
+  def padded_length(self, length: int) -> int:
+    """Buffer size needed to receive `length` bytes in full packets
+    """
+    packet = self.epi.wMaxPacketSize
+    return -(-length // packet) * packet
+
+  def read_timeout(self, size: int) -> int:
+    """Timeout (ms) for a parameter read of `size` bytes
+    """
+    return self.READ_TIMEOUT + size * 1000 // self.MIN_TRANSFER_RATE
+
+  def retrieve_data(self, command: bytes, length: int, timeouts: int = 3,
+                    out: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
     """Retrieve data with specified length from usb device using
     a command.
 
     Using the .read command can timeout, so one can specify the amount of
     max. allowed timeouts. Will return None if the limit has been archieved.
 
+    The data is read in transfers as large as possible directly into `out`
+    (a uint8 buffer with at least `padded_length(length)` bytes) or a newly
+    allocated buffer, of which a view of the first `length` bytes is returned.
+
+    The read timeout grows with the size of the read (`read_timeout`),
+    so that a large read doesn't time out while data is still arriving.
+
     This method is blocking, until all data has been received or
     timeouts have all been used up.
     """
-    #
+    size = self.padded_length(length)
+    buffer = np.empty(size, dtype="u1") if out is None else out[:size]
+    if buffer.size < size:
+      raise ValueError(f"output buffer needs to hold at least {size} bytes")
+
     self.epo.write(command)
-    buffer = bytearray()
-    while len(buffer) < length:
+    received = 0
+    while received < length:
       try:
-        #data = usb.core.array.array('B')
-        data = self.epi.read(self.epi.wMaxPacketSize, timeout=200)
-        buffer.extend(data.tobytes())
+        received += self._read_into_sync(buffer[received:], timeout=self.read_timeout(size - received))
 
       except usb.core.USBTimeoutError:
         timeouts -= 1
 
       if timeouts == 0:
-        logging.warn(f"run into timeout limit. Received {len(buffer)} bytes")
+        logging.warn(f"run into timeout limit. Received {received} bytes")
         return None
 
-    if len(buffer) > length:
-      logging.warn(f"expected buffer with length {length}, but got {len(buffer)}")
+    if received > length:
+      logging.warn(f"expected buffer with length {length}, but got {received}")
     return buffer[:length]
 
 
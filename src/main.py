@@ -1,11 +1,24 @@
 #!/usr/bin/env python3
 from device import MobirAirDriver, Frame
-from video.loopback import create_loopback
+from device.device_state import MobirAirConfig, ShutterGating
+from device.temputils import Precision
+from device.stream_server import StreamFormat
+from device.frame_queue import DropPolicy
+from device.calibration_cache import default_cache_dir
+from device.capture import CaptureWriter, RecordingUSBWrapper, ReplayUSBWrapper
+from device.manager import MobirAirDeviceManager
+from device.pipeline import TemporalDenoise
+from device.roi import Rect, Region
+from device.usb_wrapper import MobirAirUSBWrapper
+from video.colormap import PALETTES, PIXEL_FORMATS, AutoGain, ColorMapper
+from video.loopback import MmapLoopbackSink, create_loopback
 import signal
 import sys
 import numpy as np
 import logging
 import argparse
+from pathlib import Path
+from typing import Callable, Optional, Sequence
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -16,46 +29,260 @@ def abs_diff(img1, img2):
 
 
 driver = None
+manager = None
 
 def sigint_handler(sig, frame):
   logging.info("Handled sigint")
   try:
     if driver is not None:
       driver.stop()
+    if manager is not None:
+      manager.stop()
   finally:
     sys.exit(0)
 
 
-def main(video_device: str):
-  global driver
-  signal.signal(signal.SIGINT, sigint_handler)
+def parse_roi(value: str) -> tuple[str, Region]:
+  """`NAME=X,Y,WIDTH,HEIGHT` into a named rectangle
+  """
+  name, _, rect = value.partition("=")
+  try:
+    x, y, w, h = (int(v) for v in rect.split(","))
+  except ValueError:
+    raise argparse.ArgumentTypeError(f"expected NAME=X,Y,WIDTH,HEIGHT, got {value}")
+  return name, Rect(x, y, w, h)
+
+
+def attach_output(driver: MobirAirDriver, video_device: Optional[str], io: str = "mmap",
+                  mapper: Optional[ColorMapper] = None, rois: Sequence[tuple[str, Region]] = (),
+                  denoise: Optional[float] = None):
+  width, height = MobirAirDriver.WIDTH, MobirAirDriver.HEIGHT - MobirAirDriver.REF_HEIGHT
+  if denoise is not None:
+    driver.pipeline.add(TemporalDenoise(denoise), after="shutter_gate")
+  driver.add_region("frame", Rect(0, 0, width, height))
+  for name, region in rois:
+    driver.add_region(name, region)
 
-  stream = create_loopback(video_device, MobirAirDriver.WIDTH, MobirAirDriver.HEIGHT - MobirAirDriver.REF_HEIGHT)
+  stream = sink = None
+  if video_device is not None and io == "mmap":
+    sink = MmapLoopbackSink(video_device, width, height, mapper=mapper)
+  elif video_device is not None:
+    stream = create_loopback(video_device, width, height, "Y16" if mapper is None else mapper.pixelformat)
   frame_count = 0
   def listener(f: Frame):
     nonlocal frame_count
 
     if frame_count % 25 == 0:
-      logging.debug(f"Δtemps = {np.min(f.image) / 100 - 273.15:.2f} - {np.max(f.image) / 100 - 273.15:.2f} °C")
+      for name, s in f.regions.items():
+        logging.debug(
+          f"{name}: Δtemps = {s.min / 100 - 273.15:.2f} - {s.max / 100 - 273.15:.2f} °C, "
+          f"mean {s.mean / 100 - 273.15:.2f} °C, hotspot {s.hotspot}")
     frame_count += 1
 
-    stream.write(f.image.tobytes(order='C'))
+    if stream is not None and mapper is not None:
+      stream.write(mapper.apply(f.image).tobytes())
+    elif stream is not None:
+      stream.write(f.image.tobytes(order='C'))
 
-  driver = MobirAirDriver()
   driver.set_frame_listener(listener)
+  driver.set_video_sink(sink)
+
+
+def main(video_device: Optional[str], config: MobirAirConfig, usb: Optional[MobirAirUSBWrapper] = None,
+         io: str = "mmap", mapper: Optional[ColorMapper] = None, rois: Sequence[tuple[str, Region]] = (),
+         denoise: Optional[float] = None):
+  global driver
+  signal.signal(signal.SIGINT, sigint_handler)
+
+  driver = MobirAirDriver(config, usb)
+  attach_output(driver, video_device, io, mapper, rois, denoise)
   driver.stop_stream()
-  logging.info(f"Device: {driver._protocol.getDeviceSN().decode('UTF-8')}")
+  logging.info(f"Device: {driver.serial.decode('UTF-8')}")
 
   driver.start_stream()
 
 
+def main_cameras(cameras: list[str], config: MobirAirConfig, io: str = "mmap",
+                 make_mapper: Callable[[], Optional[ColorMapper]] = lambda: None,
+                 rois: Sequence[tuple[str, Region]] = (), denoise: Optional[float] = None):
+  """Run several cameras, given as `<location or serial>[=<loopback device>]`
+  """
+  global manager
+  signal.signal(signal.SIGINT, sigint_handler)
+
+  manager = MobirAirDeviceManager(config)
+  for camera in cameras:
+    selector, _, video_device = camera.partition("=")
+    attach_output(manager.open(selector), video_device or None, io, make_mapper(), rois, denoise)
+
+  manager.start()
+
+
+def list_cameras():
+  for camera in MobirAirDeviceManager().enumerate():
+    print(f"{camera.location}\t{camera.serial or '(in use)'}")
+
+
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
   parser.add_argument(
     "-l", "--loopback",
-    help="Path to the loopback device (e.g. /dev/videoX)", required=True
+    help="Path to the loopback device (e.g. /dev/videoX)"
+  )
+
+  parser.add_argument(
+    "--camera", action="append", metavar="LOCATION|SERIAL[=/dev/videoX]",
+    help="Camera to use with its loopback device. Can be given multiple times to run several cameras"
+  )
+  parser.add_argument(
+    "--list-cameras", action="store_true",
+    help="List the connected cameras (USB location and serial) and exit"
+  )
+  parser.add_argument(
+    "--io", choices=["mmap", "write"], default="mmap",
+    help="Write frames to the loopback device using mmap'd buffers or plain writes"
+  )
+  parser.add_argument(
+    "--format", choices=list(PIXEL_FORMATS), default="Y16",
+    help="Pixel format of the loopback device. All but Y16 are auto gained 8 bit images"
+  )
+  parser.add_argument(
+    "--palette", choices=list(PALETTES), default="iron",
+    help="Palette used for the 8 bit formats"
+  )
+  parser.add_argument(
+    "--agc", choices=["percentile", "equalize"], default="percentile",
+    help="Auto gain used for the 8 bit formats"
+  )
+  parser.add_argument(
+    "--roi", type=parse_roi, action="append", default=[], metavar="NAME=X,Y,WIDTH,HEIGHT",
+    help="Region to compute statistics (min, max, mean, hotspot) for. Can be given multiple times"
+  )
+  parser.add_argument(
+    "--stats-only", action="store_true",
+    help="Only compute the region statistics, without temperature images (no video output)"
+  )
+  parser.add_argument(
+    "--denoise", type=float, metavar="ALPHA",
+    help="Temporal denoising (moving average with weight ALPHA of the new frame, 0 < ALPHA <= 1)"
+  )
+  parser.add_argument(
+    "--queue-size", type=int, default=4,
+    help="Number of frames buffered between acquisition and processing"
+  )
+  parser.add_argument(
+    "--drop-policy", choices=[p.value for p in DropPolicy], default=DropPolicy.DROP_OLDEST.value,
+    help="What to do with frames when the processing falls behind"
+  )
+  parser.add_argument(
+    "--shutter-gating", choices=[g.value for g in ShutterGating], default=ShutterGating.SKIP.value,
+    help="Skip frames captured during a shutter calibration or flag them"
+  )
+  parser.add_argument(
+    "--precision", choices=[p.value for p in Precision], default=Precision.FLOAT64.value,
+    help="Arithmetic of the temperature conversion"
+  )
+  parser.add_argument(
+    "--cache-dir", type=Path, default=default_cache_dir(),
+    help="Directory the calibration data of the camera is cached in"
+  )
+  parser.add_argument(
+    "--no-cache", action="store_true",
+    help="Don't use the calibration cache"
+  )
+  parser.add_argument(
+    "--refresh-calibration", action="store_true",
+    help="Download the calibration data, even if it is cached"
+  )
+  parser.add_argument(
+    "--progressive", action="store_true",
+    help="Stream right away, without NUC and temperatures until the calibration data is downloaded"
+  )
+  parser.add_argument(
+    "--record", type=Path,
+    help="Record the raw USB traffic of the camera into a capture file"
+  )
+  parser.add_argument(
+    "--replay", type=Path,
+    help="Replay a capture file instead of using a connected camera"
+  )
+  parser.add_argument(
+    "--replay-fast", action="store_true",
+    help="Replay the capture as fast as possible instead of at recorded speed"
+  )
+  parser.add_argument(
+    "--frame-bus", metavar="NAME",
+    help="Publish frames into the shared memory segment NAME for other processes"
+  )
+  parser.add_argument(
+    "--stream-port", type=int,
+    help="Stream the frames over TCP / WebSocket on this port (see device/stream_server.py)"
+  )
+  parser.add_argument(
+    "--stream-host", default="127.0.0.1",
+    help="Address the stream is served on, e.g. 0.0.0.0 for all interfaces"
+  )
+  parser.add_argument(
+    "--stream-format", choices=[f.value for f in StreamFormat], default=StreamFormat.KELVIN.value,
+    help="Values streamed: raw sensor values, NUC corrected Y16 or temperatures"
+  )
+  parser.add_argument(
+    "--record-frames", type=Path, metavar="PATH",
+    help="Record all frames with their calibration data into a compressed radiometric recording"
+  )
+  parser.add_argument(
+    "--metrics-port", type=int,
+    help="Serve prometheus metrics on http://127.0.0.1:<port>/metrics"
+  )
+  parser.add_argument(
+    "--metrics-file", type=Path,
+    help="Periodically write prometheus metrics into this file"
   )
 
   args = parser.parse_args()
+  if args.stats_only and (args.loopback or args.frame_bus or args.stream_port or any("=" in c for c in args.camera or [])):
+    parser.error("--stats-only has no image output")
+  if args.camera and (args.replay is not None or args.replay_fast or args.record is not None):
+    parser.error("--camera can't be combined with --replay, --replay-fast or --record")
+
+  config = MobirAirConfig(
+    frameQueueSize=args.queue_size,
+    frameDropPolicy=DropPolicy(args.drop_policy),
+    shutterGating=ShutterGating(args.shutter_gating),
+    precision=Precision(args.precision),
+    statsOnly=args.stats_only,
+    calibrationCacheDir=None if args.no_cache else args.cache_dir,
+    refreshCalibration=args.refresh_calibration,
+    progressiveStartup=args.progressive,
+    metricsPort=args.metrics_port,
+    metricsFile=args.metrics_file,
+    frameBusName=args.frame_bus,
+    streamPort=args.stream_port,
+    streamHost=args.stream_host,
+    streamFormat=StreamFormat(args.stream_format),
+    recordingPath=args.record_frames,
+  )
+
+  usb = None
+  if args.replay is not None:
+    usb = ReplayUSBWrapper(args.replay, realtime=not args.replay_fast)
+  elif args.record is not None:
+    # the capture needs to contain the full calibration download
+    config.refreshCalibration = True
+    usb = RecordingUSBWrapper(
+      MobirAirUSBWrapper.find_device(), CaptureWriter(args.record),
+      async_depth=config.asyncTransfers, transfer_size=config.transferSize)
+
+  def make_mapper() -> Optional[ColorMapper]:
+    if args.format == "Y16":
+      return None
+    return ColorMapper(
+      MobirAirDriver.WIDTH, MobirAirDriver.HEIGHT - MobirAirDriver.REF_HEIGHT,
+      args.format, args.palette, AutoGain(args.agc))
 
-  main(args.loopback)
+  if args.list_cameras:
+    list_cameras()
+  elif args.camera:
+    main_cameras(args.camera, config, args.io, make_mapper, args.roi, args.denoise)
+  else:
+    main(args.loopback, config, usb, args.io, make_mapper(), args.roi, args.denoise)
@@ -0,0 +1,200 @@
+from typing import Optional
+import numpy as np
+
+
+# palettes as evenly spaced RGB control points
+PALETTES: dict[str, list[tuple[int, int, int]]] = {
+  "grey": [(0, 0, 0), (255, 255, 255)],
+  "iron": [
+    (0, 0, 0), (32, 0, 140), (204, 0, 119), (255, 80, 0),
+    (255, 170, 0), (255, 240, 100), (255, 255, 255),
+  ],
+  "rainbow": [
+    (0, 0, 128), (0, 0, 255), (0, 255, 255), (0, 255, 0),
+    (255, 255, 0), (255, 0, 0), (128, 0, 0),
+  ],
+  "hot": [(0, 0, 0), (255, 0, 0), (255, 255, 0), (255, 255, 255)],
+}
+
+
+def v4l2_fourcc(a: str, b: str, c: str, d: str) -> int:
+  return ord(a) | (ord(b) << 8) | (ord(c) << 16) | (ord(d) << 24)
+
+
+# pixel format name -> (fourcc, bytes per pixel), defined here as not
+# every v4l2py version has the V4L2_PIX_FMT constants
+PIXEL_FORMATS: dict[str, tuple[int, int]] = {
+  "Y16": (v4l2_fourcc("Y", "1", "6", " "), 2),
+  "GREY": (v4l2_fourcc("G", "R", "E", "Y"), 1),
+  "YUYV": (v4l2_fourcc("Y", "U", "Y", "V"), 2),
+  "RGB24": (v4l2_fourcc("R", "G", "B", "3"), 3),
+}
+
+
+def make_palette(name: str) -> np.ndarray:
+  """256 entry RGB palette interpolated from the control points
+  """
+  points = np.array(PALETTES[name], dtype="f8")
+  x = np.linspace(0, 255, len(points))
+  return np.stack([
+    np.interp(np.arange(256), x, points[:, c]) for c in range(3)
+  ], axis=1).round().astype("u1")
+
+
+def rgb_to_yuv(rgb: np.ndarray) -> np.ndarray:
+  """BT.601 limited range conversion
+  """
+  r, g, b = (rgb[..., c].astype("i4") for c in range(3))
+  y = ((66 * r + 129 * g + 25 * b + 128) >> 8) + 16
+  u = ((-38 * r - 74 * g + 112 * b + 128) >> 8) + 128
+  v = ((112 * r - 94 * g - 18 * b + 128) >> 8) + 128
+  return np.stack([y, u, v], axis=-1).astype("u1")
+
+
+class AutoGain:
+  """Automatic gain control for Y16 images, mapping them to 8 bit.
+
+  Values are binned into `2¹⁶ >> shift` bins. The histogram of these
+  bins is updated incrementally (exponentially decayed with `decay`)
+  instead of sorting every frame, which also keeps the gain from
+  flickering. With `mode="percentile"` the range between the `low` and
+  `high` percentile is mapped linearly, with `mode="equalize"` the
+  histogram is equalized.
+
+  The gain curve (bin -> 8 bit) is only recomputed, when the percentile
+  limits change or, for equalization, every `interval` frames.
+  """
+
+  def __init__(self, mode: str = "percentile", low: float = 1, high: float = 99,
+               decay: float = 0.8, shift: int = 4, interval: int = 5) -> None:
+    if mode not in ("percentile", "equalize"):
+      raise ValueError(f"unknown agc mode {mode}")
+
+    self.mode = mode
+    self.low = low / 100
+    self.high = high / 100
+    self.decay = decay
+    self.shift = shift
+    self.interval = interval
+
+    self.bins = 2**16 >> shift
+    self._hist = np.zeros(self.bins, dtype="f8")
+    self._limits: Optional[tuple[int, int]] = None
+    self._frames = 0
+
+    self.curve = np.zeros(self.bins, dtype="u1")
+    # incremented, whenever `curve` changes
+    self.version = 0
+
+  def update(self, bins: np.ndarray) -> bool:
+    """Add image (already binned) to the histogram. Returns True, if
+    the gain curve changed.
+    """
+    hist = np.bincount(bins.ravel(), minlength=self.bins)
+    self._hist *= self.decay
+    self._hist += hist
+    self._frames += 1
+
+    if self.mode == "percentile":
+      return self._update_percentile()
+    elif (self._frames - 1) % self.interval == 0:
+      return self._update_equalize()
+    return False
+
+  def _update_percentile(self) -> bool:
+    cdf = np.cumsum(self._hist)
+    lo, hi = np.searchsorted(cdf, [self.low * cdf[-1], self.high * cdf[-1]])
+    hi = max(hi, lo + 1)
+
+    if self._limits == (lo, hi):
+      return False
+
+    self._limits = (lo, hi)
+    ramp = (np.arange(self.bins, dtype="f8") - lo) * 255 / (hi - lo)
+    self.curve = ramp.clip(0, 255).astype("u1")
+    self.version += 1
+    return True
+
+  def _update_equalize(self) -> bool:
+    cdf = np.cumsum(self._hist)
+    first = cdf[np.searchsorted(cdf, 0, side="right")]
+    span = max(cdf[-1] - first, 1e-9)
+    self.curve = ((cdf - first) * 255 / span).clip(0, 255).astype("u1")
+    self.version += 1
+    return True
+
+
+class ColorMapper:
+  """Converts Y16 images into 8 bit GREY, YUYV or RGB24 images for
+  video consumers, using an `AutoGain` and a palette.
+
+  The gain curve and palette are combined into a single lookup table
+  per output format, that is only rebuilt when the gain curve changes.
+  A frame therefore costs a shift, a histogram and a table lookup.
+  """
+
+  def __init__(self, width: int, height: int, pixelformat: str = "RGB24",
+               palette: str = "iron", agc: Optional[AutoGain] = None) -> None:
+    if pixelformat not in PIXEL_FORMATS or pixelformat == "Y16":
+      raise ValueError(f"unsupported pixel format {pixelformat}")
+    if pixelformat == "YUYV" and width % 2:
+      raise ValueError("YUYV needs an even width")
+
+    self.width = width
+    self.height = height
+    self.pixelformat = pixelformat
+    self.agc = agc or AutoGain()
+
+    self._palette = make_palette(palette)
+    self._bins = np.empty((height, width), dtype="u2")
+    if pixelformat == "YUYV":
+      # odd pixels use the second half of the table
+      self._parity = np.tile(np.array([0, self.agc.bins], dtype="u4"), width // 2)
+      self._index = np.empty((height, width), dtype="u4")
+    self._lut: Optional[np.ndarray] = None
+    self._lut_version = -1
+
+  @property
+  def shape(self) -> tuple[int, ...]:
+    """Shape (uint8) of the output image
+    """
+    if self.pixelformat == "RGB24":
+      return (self.height, self.width, 3)
+    if self.pixelformat == "YUYV":
+      return (self.height, self.width, 2)
+    return (self.height, self.width)
+
+  @property
+  def nbytes(self) -> int:
+    return int(np.prod(self.shape))
+
+  def _build_lut(self) -> np.ndarray:
+    colors = self._palette[self.agc.curve]
+
+    if self.pixelformat == "RGB24":
+      return colors
+    if self.pixelformat == "GREY":
+      # full range luma
+      return ((colors.astype("u4") @ np.array([77, 150, 29], dtype="u4") + 128) >> 8).astype("u1")
+    # YUYV: (Y, U) for even and (Y, V) for odd pixels
+    yuv = rgb_to_yuv(colors)
+    return np.concatenate([yuv[:, [0, 1]], yuv[:, [0, 2]]])
+
+  def apply(self, image: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    if out is None:
+      out = np.empty(self.shape, dtype="u1")
+
+    np.right_shift(image, self.agc.shift, out=self._bins)
+    self.agc.update(self._bins)
+
+    if self._lut_version != self.agc.version:
+      self._lut = self._build_lut()
+      self._lut_version = self.agc.version
+
+    if self.pixelformat == "YUYV":
+      np.add(self._bins, self._parity, out=self._index)
+      np.take(self._lut, self._index, axis=0, out=out, mode="clip")
+    else:
+      np.take(self._lut, self._bins, axis=0, out=out, mode="clip")
+
+    return out
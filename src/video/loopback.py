@@ -1,19 +1,33 @@
+from collections import deque
 from pathlib import Path
+from typing import Optional
+import ctypes
+import errno
+import mmap
+import os
 import time
 import fcntl
+import logging
+import numpy as np
 import v4l2py.raw as vraw
 
+from .colormap import PIXEL_FORMATS, ColorMapper
+
+V4L2_BUF_FLAG_TIMESTAMP_COPY = 0x4000
+
+
+def get_format(width, height, pixelformat: str = "Y16") -> vraw.v4l2_format:
+  fourcc, bpp = PIXEL_FORMATS[pixelformat]
 
-def get_format(width, height) -> vraw.v4l2_format:
   f = vraw.v4l2_format()
   f.type = vraw.V4L2_BUF_TYPE_VIDEO_OUTPUT
-  f.fmt.pix.pixelformat = vraw.V4L2_PIX_FMT_Y16
+  f.fmt.pix.pixelformat = fourcc
   f.fmt.pix.width = width
   f.fmt.pix.height = height
   f.fmt.pix.field = vraw.V4L2_FIELD_NONE
-  f.fmt.pix.bytesperline = width * 2
-  f.fmt.pix.sizeimage = width * height * 2
-  f.fmt.pix.colorspace = vraw.V4L2_COLORSPACE_RAW
+  f.fmt.pix.bytesperline = width * bpp
+  f.fmt.pix.sizeimage = width * height * bpp
+  f.fmt.pix.colorspace = vraw.V4L2_COLORSPACE_RAW if pixelformat == "Y16" else vraw.V4L2_COLORSPACE_SRGB
   return f
 
 
@@ -30,12 +44,132 @@ def main(device: Path | str):
     i = (i + 1) % (100 * 100)
 
 
-def create_loopback(device: Path | str, width: int, height: int):
+def create_loopback(device: Path | str, width: int, height: int, pixelformat: str = "Y16"):
   stream = open(device, "wb")
 
   # set video format
-  format = get_format(width, height)
+  format = get_format(width, height, pixelformat)
   fcntl.ioctl(stream, vraw.VIDIOC_S_FMT, format)
 
   return stream
 
+
+class MmapLoopbackSink:
+  """Y16 output to a v4l2 loopback device using streaming I/O with
+  mmap'd buffers.
+
+  Frames are written directly into a free buffer returned by `dequeue`
+  and handed over to the device with `queue`. When the reader falls
+  behind and no buffer is free, `dequeue` returns None instead of
+  blocking and the frame is counted as dropped.
+
+  With a `mapper`, the device gets the 8 bit output of the mapper
+  instead. `dequeue` then returns a Y16 scratch image belonging to the
+  buffer, which is mapped into the buffer by `queue`.
+  """
+
+  def __init__(self, device: Path | str, width: int, height: int, buffers: int = 4,
+               mapper: Optional[ColorMapper] = None) -> None:
+    self._fd = os.open(device, os.O_RDWR | os.O_NONBLOCK)
+    self.width = width
+    self.height = height
+    self.mapper = mapper
+
+    pixelformat = "Y16" if mapper is None else mapper.pixelformat
+    fcntl.ioctl(self._fd, vraw.VIDIOC_S_FMT, get_format(width, height, pixelformat))
+
+    req = vraw.v4l2_requestbuffers()
+    req.count = buffers
+    req.type = vraw.V4L2_BUF_TYPE_VIDEO_OUTPUT
+    req.memory = vraw.V4L2_MEMORY_MMAP
+    fcntl.ioctl(self._fd, vraw.VIDIOC_REQBUFS, req)
+
+    self._mmaps: list[mmap.mmap] = []
+    self._outputs: list[np.ndarray] = []
+    self._images: list[np.ndarray] = []
+    self._index: dict[int, int] = {}
+    for i in range(req.count):
+      buf = self._buffer(i)
+      fcntl.ioctl(self._fd, vraw.VIDIOC_QUERYBUF, buf)
+
+      mm = mmap.mmap(self._fd, buf.length, mmap.MAP_SHARED,
+                     mmap.PROT_READ | mmap.PROT_WRITE, offset=buf.m.offset)
+      if mapper is None:
+        image = output = np.ndarray((height, width), dtype="<u2", buffer=mm)
+      else:
+        output = np.ndarray(mapper.shape, dtype="u1", buffer=mm)
+        image = np.empty((height, width), dtype="<u2")
+      self._mmaps.append(mm)
+      self._outputs.append(output)
+      self._images.append(image)
+      self._index[id(image)] = i
+
+    self._free = deque(range(req.count))
+    self._streaming = False
+    self.sequence = 0
+    self.dropped = 0
+
+  def _buffer(self, index: int) -> vraw.v4l2_buffer:
+    buf = vraw.v4l2_buffer()
+    buf.index = index
+    buf.type = vraw.V4L2_BUF_TYPE_VIDEO_OUTPUT
+    buf.memory = vraw.V4L2_MEMORY_MMAP
+    return buf
+
+  def dequeue(self) -> Optional[np.ndarray]:
+    """Returns a free buffer to write the next frame into, or None if
+    all buffers are still in use by the device.
+    """
+    if not self._free:
+      buf = self._buffer(0)
+      try:
+        fcntl.ioctl(self._fd, vraw.VIDIOC_DQBUF, buf)
+      except OSError as e:
+        if e.errno not in (errno.EAGAIN, errno.EINVAL):
+          raise
+        self.dropped += 1
+        return None
+      self._free.append(buf.index)
+
+    return self._images[self._free.popleft()]
+
+  def queue(self, image: np.ndarray, timestamp_ns: Optional[int] = None):
+    """Hand a buffer returned by `dequeue` over to the device
+    """
+    index = self._index[id(image)]
+    output = self._outputs[index]
+    if self.mapper is not None:
+      self.mapper.apply(image, out=output)
+
+    buf = self._buffer(index)
+    buf.bytesused = output.nbytes
+    buf.field = vraw.V4L2_FIELD_NONE
+    buf.flags = V4L2_BUF_FLAG_TIMESTAMP_COPY
+    buf.sequence = self.sequence
+
+    timestamp_ns = time.monotonic_ns() if timestamp_ns is None else timestamp_ns
+    buf.timestamp.secs = timestamp_ns // 1_000_000_000
+    buf.timestamp.usecs = (timestamp_ns // 1000) % 1_000_000
+
+    fcntl.ioctl(self._fd, vraw.VIDIOC_QBUF, buf)
+    self.sequence += 1
+
+    if not self._streaming:
+      fcntl.ioctl(self._fd, vraw.VIDIOC_STREAMON, ctypes.c_int(vraw.V4L2_BUF_TYPE_VIDEO_OUTPUT))
+      self._streaming = True
+
+  def close(self):
+    if self._streaming:
+      fcntl.ioctl(self._fd, vraw.VIDIOC_STREAMOFF, ctypes.c_int(vraw.V4L2_BUF_TYPE_VIDEO_OUTPUT))
+      self._streaming = False
+
+    # the views need to be gone, before the buffers can be unmapped
+    self._outputs, self._images, self._index = [], [], {}
+    self._free.clear()
+    for mm in self._mmaps:
+      try:
+        mm.close()
+      except BufferError:
+        logging.warn("loopback: buffer still in use, not unmapped")
+    self._mmaps = []
+    os.close(self._fd)